@@ -6,7 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'playground.settings')
+    # the test runner also needs the replica alias, see playground/test_settings.py
+    default = 'playground.test_settings' if sys.argv[1:2] == ['test'] else 'playground.settings'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', default)
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
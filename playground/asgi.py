@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'playground.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once Django is set up
+from store.async_api import AsyncApiApplication  # noqa: E402
+from store.feed import ProductFeedApplication  # noqa: E402
+
+application = ProductFeedApplication(AsyncApiApplication(django_application))
@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 
 from datetime import timedelta
 from pathlib import Path
-from os import path
+from os import environ, path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -49,12 +49,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that it times everything below it
+    'store.middleware.ProfilingMiddleware',
+    # before anything reads the database
+    'store.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # after authentication, which decides who may profile
+    'store.middleware.OnDemandProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware'
@@ -88,13 +94,97 @@ WSGI_APPLICATION = 'playground.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite in development. Production sets DATABASE_ENGINE and DATABASE_NAME,
+# USER, PASSWORD, HOST and PORT. DATABASE_CONN_MAX_AGE keeps connections
+# open between requests for that many seconds. For a pooler in transaction
+# mode such as pgbouncer, point HOST and PORT at it and set
+# DATABASE_DISABLE_SERVER_SIDE_CURSORS. DATABASE_REPLICA_HOST (or _NAME)
+# adds a read replica, see store.routers.
+
+DATABASE_ENGINE = environ.get('DATABASE_ENGINE', 'django.db.backends.sqlite3')
+
+if DATABASE_ENGINE == 'django.db.backends.sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': DATABASE_ENGINE,
+            'NAME': environ.get('DATABASE_NAME', BASE_DIR / 'db.sqlite3'),
+            # a file rather than shared-cache memory, so that concurrent tests
+            # wait on locks like production does instead of failing at once
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': DATABASE_ENGINE,
+            'NAME': environ['DATABASE_NAME'],
+            'USER': environ.get('DATABASE_USER', ''),
+            'PASSWORD': environ.get('DATABASE_PASSWORD', ''),
+            'HOST': environ.get('DATABASE_HOST', ''),
+            'PORT': environ.get('DATABASE_PORT', ''),
+            'DISABLE_SERVER_SIDE_CURSORS': bool(environ.get('DATABASE_DISABLE_SERVER_SIDE_CURSORS')),
+        }
     }
+
+DATABASES['default']['CONN_MAX_AGE'] = int(environ.get('DATABASE_CONN_MAX_AGE', 0))
+
+# Set on every new SQLite connection by store.sqlite; an empty dict leaves
+# SQLite's defaults. WAL lets catalog reads go on while bids are written.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    # bytes of the database file read through memory mapping
+    'mmap_size': 256 * 1024 * 1024,
+    # page cache per connection, in KiB when negative
+    'cache_size': -64000,
+    # milliseconds a writer waits for the lock before "database is locked"
+    'busy_timeout': 5000,
 }
 
+if environ.get('DATABASE_REPLICA_HOST') or environ.get('DATABASE_REPLICA_NAME'):
+    DATABASES['replica'] = dict(
+        DATABASES['default'],
+        HOST=environ.get('DATABASE_REPLICA_HOST', DATABASES['default'].get('HOST', '')),
+        NAME=environ.get('DATABASE_REPLICA_NAME', DATABASES['default']['NAME']),
+        # tests run against the primary's test database through this alias
+        TEST={'MIRROR': 'default'},
+    )
+    DATABASE_ROUTERS = ['store.routers.ReplicaRouter']
+
+# how long a client that wrote keeps reading from the primary; pins are kept
+# in REPLICA_PIN_CACHE, which should be shared by all workers in production
+REPLICA_STICKY_SECONDS = int(environ.get('REPLICA_STICKY_SECONDS', 10))
+REPLICA_PIN_CACHE = 'default'
+
+
+# Caches
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Anonymous catalog responses are cached in CATALOG_CACHE. Local memory is
+# per process; set CATALOG_CACHE_DIR to share one file based cache between
+# the workers of a host so that invalidations reach all of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+if environ.get('CATALOG_CACHE_DIR'):
+    CACHES['catalog'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': environ['CATALOG_CACHE_DIR'],
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+
+CATALOG_CACHE = 'catalog'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -136,6 +226,27 @@ STATIC_URL = 'static/'
 MEDIA_ROOT = path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Uploads are named by the hash of their content, see store.storage. Media
+# is served by store.media; point MEDIA_ACCEL_REDIRECT at an nginx internal
+# location aliased to MEDIA_ROOT to let nginx send the files instead.
+DEFAULT_FILE_STORAGE = 'store.storage.ContentAddressedStorage'
+MEDIA_ACCEL_REDIRECT = environ.get('MEDIA_ACCEL_REDIRECT')
+
+# X-Profile requests also save their cProfile output here when set
+PROFILING_DIR = environ.get('PROFILING_DIR')
+# Besides staff, /metrics/, X-Profile and Server-Timing are open to requests
+# carrying this value in an X-Metrics-Token header, for the scraper
+METRICS_TOKEN = environ.get('METRICS_TOKEN')
+
+# Resized copies of product photos, made by a background pool of
+# PRODUCT_IMAGE_WORKERS threads after the upload commits. WebP when Pillow
+# was built with it, JPEG otherwise.
+PRODUCT_IMAGE_VARIANTS = {
+    'thumb': (200, 200),
+    'medium': (800, 800),
+}
+PRODUCT_IMAGE_WORKERS = 2
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -143,8 +254,17 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
+    'DEFAULT_RENDERER_CLASSES': (
+        'store.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'store.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'store.authentication.CachedJWTAuthentication',
     ),
     # 'DEFAULT_PERMISSION_CLASSES': [
     #     'rest_framework.permissions.IsAuthenticated'
@@ -163,6 +283,14 @@ SIMPLE_JWT = {
    'ACCESS_TOKEN_LIFETIME': timedelta(days=7)
 }
 
+# Users behind JWTs are cached in JWT_USER_CACHE by store.authentication.
+# Saves forget them in every worker sharing that cache, so like
+# REPLICA_PIN_CACHE it should be shared by all workers in production (with
+# the local memory default, other workers see saves after the TTL). Changes
+# made with update() show after the TTL (seconds) everywhere.
+JWT_USER_CACHE = 'default'
+JWT_USER_CACHE_TTL = 300
+
 AUTH_USER_MODEL = 'core.User'
 
 CORS_ALLOW_ALL_ORIGINS = True
@@ -171,3 +299,16 @@ CSRF_TRUSTED_ORIGINS = [
     'http://localhost:3000',
     'http://127.0.0.1:3000',
 ]
+
+BLOCKCHAIN_NODE = {
+    'URL': 'http://localhost:8080',
+    'CONNECT_TIMEOUT': 2,
+    'READ_TIMEOUT': 5,
+    'RETRIES': 2,
+    'BACKOFF_FACTOR': 0.2,
+    'POOL_SIZE': 20,
+    'FAILURE_THRESHOLD': 5,
+    'RESET_TIMEOUT': 30,
+    'OWNER_CACHE_TTL': 10,
+    'OWNER_CACHE_SIZE': 10000,
+}
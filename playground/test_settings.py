@@ -0,0 +1,17 @@
+"""
+Settings for `manage.py test`, which picks this module unless
+DJANGO_SETTINGS_MODULE says otherwise.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+# a second SQLite file standing in for the replica, so that the test runner
+# creates and migrates it along with the primary. It is not a mirror: the
+# routing tests copy the primary over only when they mean replication to
+# have caught up. Only those tests install ReplicaRouter.
+DATABASES['replica'] = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': BASE_DIR / 'replica.sqlite3',
+    'TEST': {'NAME': BASE_DIR / 'test_replica.sqlite3'},
+}
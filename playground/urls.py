@@ -17,7 +17,8 @@ import debug_toolbar
 from django.contrib import admin
 from django.urls import include, path
 from django.conf import settings
-from django.conf.urls.static import static
+
+from store import media, metrics
 
 admin.site.site_header = "StoreFront Admin"
 admin.site.index_title = "Admin"
@@ -28,6 +29,9 @@ urlpatterns = [
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.jwt')),
     path('__debug__', include(debug_toolbar.urls)),
+    path('metrics/', metrics.metrics, name='metrics'),
 ]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+urlpatterns += [
+    path(settings.MEDIA_URL.lstrip('/') + '<path:path>', media.serve, name='media'),
+]
@@ -1,5 +1,4 @@
 from django.contrib import admin, messages
-from django.db.models import Count
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.http import urlencode
@@ -9,10 +8,12 @@ from . import models
 @admin.register(models.Collection)
 class CollectionAdmin(admin.ModelAdmin):
     list_per_page = 20
-    list_display = ['title', 'product_count']
+    list_display = ['title', 'products', 'visible_product_count']
     search_fields = ['title']
+    readonly_fields = ['product_count', 'visible_product_count']
 
-    def product_count(self, collection):
+    @admin.display(ordering='product_count')
+    def products(self, collection):
         return format_html('<a href={}>{}</a>',\
             reverse('admin:store_product_changelist')
             + '?'\
@@ -20,10 +21,6 @@ class CollectionAdmin(admin.ModelAdmin):
                 'collection__id': str(collection.id)
             }), collection.product_count)
 
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            product_count=Count('products'))
-
 
 @admin.register(models.Product)
 class ProductAdmin(admin.ModelAdmin):
@@ -51,4 +48,6 @@ class CustomerAdmin(admin.ModelAdmin):
 
 admin.site.register(models.Comment)
 admin.site.register(models.Bid)
-admin.site.register(models.Transfer)
\ No newline at end of file
+admin.site.register(models.Transfer)
+admin.site.register(models.JobCheckpoint)
+
@@ -0,0 +1,138 @@
+import threading
+from contextlib import contextmanager
+
+from collections import defaultdict
+
+from django.db.models import Case, Count, DecimalField, F, Max, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from . import caching
+from .models import Bid, Collection, Comment, Product
+
+_state = threading.local()
+
+
+@contextmanager
+def signals_paused():
+    """
+    Lets bulk helpers delete bids or comments without the per row signal
+    handlers touching the product counters; the helper fixes them up itself.
+    """
+    previous = is_paused()
+    _state.paused = True
+    try:
+        yield
+    finally:
+        _state.paused = previous
+
+
+def is_paused():
+    return getattr(_state, 'paused', False)
+
+
+def bid_added(bid):
+    price = Value(bid.price, output_field=DecimalField(max_digits=10, decimal_places=2))
+    Product.objects.filter(pk=bid.product_id).update(
+        bid_count=F('bid_count') + 1,
+        highest_bid=Case(
+            When(Q(highest_bid__isnull=True) | Q(highest_bid__lt=price), then=price),
+            default=F('highest_bid')))
+
+
+def bid_removed(bid):
+    highest = Bid.objects.filter(product_id=OuterRef('pk')).order_by('-price').values('price')[:1]
+    Product.objects.filter(pk=bid.product_id, bid_count__gt=0).update(
+        bid_count=F('bid_count') - 1,
+        highest_bid=Subquery(highest))
+
+
+def comment_added(comment):
+    Product.objects.filter(pk=comment.product_id).update(comment_count=F('comment_count') + 1)
+
+
+def comment_removed(comment):
+    Product.objects.filter(pk=comment.product_id, comment_count__gt=0) \
+        .update(comment_count=F('comment_count') - 1)
+
+
+def clear_bids(product_ids):
+    """Deletes every bid on the given products. Call inside a transaction."""
+    # one DELETE without loading the rows. QuerySet.delete() cannot fast
+    # delete bids because they have post_delete receivers: it would select
+    # every bid and send a signal per row, even with the signals paused.
+    # Nothing references bids, and the counters are reset below.
+    bids = Bid.objects.filter(product_id__in=product_ids)
+    bids._raw_delete(bids.db)
+    Product.objects.filter(pk__in=product_ids).update(bid_count=0, highest_bid=None)
+    caching.products_changed(product_ids)
+
+
+def count_products(deltas):
+    """
+    Adds to the collections' product counters. `deltas` maps collection ids
+    to (products, visible products) changes; code that adds, moves, hides or
+    removes products without signals sums its changes with
+    collection_deltas and passes them here once.
+    """
+    for collection_id, changes in deltas.items():
+        # a counter that drifted low stays at zero, refresh_collection_counts repairs it
+        counters = {name: Greatest(F(name) + change, 0)
+                    for name, change in zip(('product_count', 'visible_product_count'), changes) if change}
+        if collection_id is not None and counters:
+            Collection.objects.filter(pk=collection_id).update(**counters)
+
+
+def collection_deltas(products, sign=1):
+    """Counter changes for adding (sign 1) or removing (sign -1) `products`, instances or values() rows"""
+    deltas = defaultdict(lambda: [0, 0])
+    for product in products:
+        if isinstance(product, dict):
+            collection_id, visible = product['collection_id'], product['visible']
+        else:
+            collection_id, visible = product.collection_id, product.visible
+        deltas[collection_id][0] += sign
+        deltas[collection_id][1] += sign if visible else 0
+    return deltas
+
+
+def product_saved(product, created, previous_collection_id=None, previous_visible=None):
+    if created:
+        deltas = collection_deltas([product])
+    elif previous_collection_id is None:
+        # the row was not there before the save
+        return
+    elif (previous_collection_id, previous_visible) == (product.collection_id, product.visible):
+        return
+    else:
+        deltas = collection_deltas([{'collection_id': previous_collection_id, 'visible': previous_visible}], -1)
+        for collection_id, (products, visible) in collection_deltas([product]).items():
+            deltas[collection_id][0] += products
+            deltas[collection_id][1] += visible
+    count_products(deltas)
+
+
+def product_deleted(product):
+    count_products(collection_deltas([product], -1))
+
+
+def refresh_collection_counts(queryset=None):
+    """Recomputes the product counters of `queryset` (every collection by default) from scratch."""
+    if queryset is None:
+        queryset = Collection.objects.all()
+    products = Product.objects.filter(collection_id=OuterRef('pk')).order_by().values('collection_id')
+    queryset.update(
+        product_count=Coalesce(Subquery(products.annotate(count=Count('id')).values('count')), 0),
+        visible_product_count=Coalesce(Subquery(
+            products.filter(visible=True).annotate(count=Count('id')).values('count')), 0))
+
+
+def refresh_aggregates(queryset=None):
+    """Recomputes the counters of `queryset` (every product by default) from scratch."""
+    if queryset is None:
+        queryset = Product.objects.all()
+    bids = Bid.objects.filter(product_id=OuterRef('pk')).values('product_id')
+    comments = Comment.objects.filter(product_id=OuterRef('pk')).values('product_id')
+    queryset.update(
+        highest_bid=Subquery(bids.annotate(highest=Max('price')).values('highest')),
+        bid_count=Coalesce(Subquery(bids.annotate(count=Count('id')).values('count')), 0),
+        comment_count=Coalesce(Subquery(comments.annotate(count=Count('id')).values('count')), 0))
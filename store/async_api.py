@@ -0,0 +1,234 @@
+import re
+import tempfile
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signals
+from django.core.handlers.asgi import ASGIRequest
+from django.db import DatabaseError, connections
+from django.http import HttpResponse
+from rest_framework.exceptions import APIException, NotAuthenticated, PermissionDenied
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.views import exception_handler
+
+from .blockchain import BlockchainError, get_async_client
+from .middleware import ReplicaRoutingMiddleware
+from .models import Product, Transfer
+from .routers import REPLICA
+from .serializers import CreateProductSerializer, ProductSerializer
+from .transfers import buyer_owns_async, complete_transfer as complete
+
+# Coroutine versions of the endpoints that mostly wait on the blockchain node:
+# product creation, token verification and transfer completion. Under ASGI a
+# request waiting on the node is a suspended coroutine rather than a blocked
+# worker thread; the ORM work around the node call still runs synchronously,
+# through sync_to_async. Responses are the same as the viewsets' in views.py.
+
+NODE_UNREACHABLE = {'error': 'Could not reach the blockchain node'}
+
+
+@sync_to_async
+def get_transfer(pk):
+    return Transfer.objects.select_related('product', 'buyer').only(
+        'product', 'buyer', 'product__product_hash', 'buyer__user').filter(pk=pk).first()
+
+
+@sync_to_async
+def save_product(request):
+    serializer = CreateProductSerializer(data=request.data, context={'user': request.user})
+    if not serializer.is_valid():
+        return 400, serializer.errors
+    serializer.save()
+    return 201, serializer.data
+
+
+@sync_to_async
+def issued_token(user):
+    # read fresh, get_token may have just issued it through another worker
+    return type(user).objects.filter(pk=user.pk).values_list('randomString', flat=True).get()
+
+
+@sync_to_async
+def mark_verified(user):
+    user.verified = True
+    user.save(update_fields=['verified'])
+
+
+@sync_to_async
+def finish_transfer(transfer, client):
+    try:
+        complete(transfer, client)
+    except DatabaseError:
+        return 500, {'error': 'Internal Server Error'}
+    return 200, ProductSerializer(Product.objects.get(pk=transfer.product_id)).data
+
+
+async def create_product(request):
+    product_hash = request.data.get('product_hash')
+    if not product_hash:
+        return 400, {'error': 'product_hash is required'}
+    try:
+        owner = await get_async_client().item_owner(product_hash)
+    except BlockchainError:
+        return 503, NODE_UNREACHABLE
+    if owner is None or request.user.public_key_hash != owner:
+        return 400, {'error': 'Item not registered under the provided user\'s address'}
+    return await save_product(request)
+
+
+async def verify_token(request):
+    user = request.user
+    token = await issued_token(user)
+    try:
+        verified = await get_async_client().verify_token(
+            token, request.data.get('signed_token'), user.public_key)
+    except BlockchainError:
+        return 503, NODE_UNREACHABLE
+    if not verified:
+        return 400, {'error': 'Token could not be verified '}
+    await mark_verified(user)
+    return 202, {'success': 'User Verified Successfully '}
+
+
+async def complete_transfer(request, pk):
+    transfer = await get_transfer(pk)
+    if transfer is None:
+        return 404, {'detail': 'Not found.'}
+    # what IsBuyer checks for TransferViewset
+    if transfer.buyer.user_id != request.user.id:
+        return 403, {'detail': PermissionDenied.default_detail}
+    client = get_async_client()
+    try:
+        owned = await buyer_owns_async(client, transfer.product.product_hash, request.user.public_key_hash)
+    except BlockchainError:
+        return 503, NODE_UNREACHABLE
+    if not owned:
+        return 402, {'error': 'Error verifying from blockchain'}
+    return await finish_transfer(transfer, client)
+
+
+ROUTES = [
+    ('POST', re.compile(r'^/store/products/$'), create_product),
+    ('POST', re.compile(r'^/store/customers/verify_token/$'), verify_token),
+    ('PUT', re.compile(r'^/store/transfers/(?P<pk>\d+)/$'), complete_transfer),
+]
+
+
+@sync_to_async
+def prepare(scope, body):
+    """
+    Builds the DRF request and authenticates it, as APIView.initial does.
+    Returns the request, or (status, data, headers) when it is refused.
+    """
+    signals.request_started.send(sender=AsyncApiApplication, scope=scope)
+    request = Request(ASGIRequest(scope, body),
+                      parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+                      authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        if not request.user.is_authenticated:
+            raise NotAuthenticated
+        # parse now, handlers read request.data on the event loop
+        request.data
+    except APIException as exc:
+        if request.authenticators:
+            exc.auth_header = request.authenticators[0].authenticate_header(request)
+        response = exception_handler(exc, {})
+        return response.status_code, response.data, dict(response.items())
+    return request
+
+
+@sync_to_async
+def pin_to_primary(replica_routing, request):
+    """Pins the writer as ReplicaRoutingMiddleware would, returns the Set-Cookie value"""
+    response = HttpResponse()
+    replica_routing.pin(request, response)
+    return response.cookies[replica_routing.cookie_name].output(header='').strip()
+
+
+class AsyncApiApplication:
+    """
+    ASGI application serving ROUTES with the coroutines above and passing
+    every other request on to `application`. These requests skip Django's
+    middleware: synchronous middleware would pin each one to a thread for
+    as long as it waits.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        renderer = api_settings.DEFAULT_RENDERER_CLASSES[0]()
+        self.render = renderer.render
+        self.content_type = renderer.media_type
+        self.replica_routing = ReplicaRoutingMiddleware(application)
+
+    def resolve(self, scope):
+        if scope['type'] != 'http':
+            return None
+        for method, pattern, handler in ROUTES:
+            match = pattern.match(scope['path'])
+            if match is not None and scope['method'] == method:
+                return handler, match.groupdict()
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        route = self.resolve(scope)
+        if route is None:
+            return await self.application(scope, receive, send)
+        handler, kwargs = route
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        try:
+            request = await prepare(scope, body)
+            if isinstance(request, tuple):
+                status, data, headers = request
+            else:
+                status, data = await handler(request, **kwargs)
+                headers = {}
+                if status < 400 and REPLICA in connections.databases:
+                    # every route writes, and none of them pass through the middleware
+                    headers['set-cookie'] = await pin_to_primary(self.replica_routing, request)
+            await self.respond(scope, send, status, data, headers)
+        finally:
+            body.close()
+            await sync_to_async(signals.request_finished.send)(sender=AsyncApiApplication)
+
+    async def lifespan(self, receive, send):
+        # Django's handler refuses lifespan scopes; the node's connections
+        # belong to the server's loop and have to close before it does
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await get_async_client().close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        # spooled like Django's ASGIHandler, large uploads go to disk
+        body = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, mode='w+b')
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        return body
+
+    async def respond(self, scope, send, status, data, headers):
+        content = self.render(data)
+        headers = {name.lower(): value for name, value in headers.items()}
+        headers.update({'content-type': self.content_type, 'content-length': str(len(content))})
+        if getattr(settings, 'CORS_ALLOW_ALL_ORIGINS', False) and any(
+                name == b'origin' for name, _ in scope['headers']):
+            # what CorsMiddleware adds to the responses it lets through
+            headers['access-control-allow-origin'] = '*'
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.encode(), value.encode()) for name, value in headers.items()]})
+        await send({'type': 'http.response.body', 'body': content})
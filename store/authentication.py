@@ -0,0 +1,73 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import Customer
+
+
+def get_user_cache():
+    return caches[getattr(settings, 'JWT_USER_CACHE', 'default')]
+
+
+def user_key(user_id):
+    return 'jwt-user:%s' % user_id
+
+
+def forget_user(user_id):
+    get_user_cache().delete(user_key(user_id))
+
+
+def field_names(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that remembers the user behind a token, along with
+    their Customer, for a short while instead of loading them on every
+    request. The cache holds column values and every request gets model
+    instances of its own, so a view changing request.user changes nothing
+    for the others. Saving or deleting a User or Customer forgets it (see
+    store.signals.handlers), in every worker sharing JWT_USER_CACHE;
+    changes made with update() show after JWT_USER_CACHE_TTL.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        cache = get_user_cache()
+        row = cache.get(user_key(user_id))
+        if row is None:
+            row = self.load(user_id)
+            cache.set(user_key(user_id), row, getattr(settings, 'JWT_USER_CACHE_TTL', 300))
+        user = self.build(*row)
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
+
+    def load(self, user_id):
+        User = self.user_model
+        try:
+            user = User.objects.select_related('customer').get(**{api_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        customer = getattr(user, 'customer', None)
+        return (user._state.db, tuple(getattr(user, name) for name in field_names(User)),
+                None if customer is None else tuple(getattr(customer, name) for name in field_names(Customer)))
+
+    def build(self, db, user_values, customer_values):
+        User = self.user_model
+        user = User.from_db(db, field_names(User), user_values)
+        customer = None
+        if customer_values is not None:
+            customer = Customer.from_db(db, field_names(Customer), customer_values)
+            Customer.user.field.set_cached_value(customer, user)
+        # as select_related('customer') leaves it, a missing customer is cached too
+        User.customer.related.set_cached_value(user, customer)
+        return user
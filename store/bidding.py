@@ -0,0 +1,50 @@
+from django.db import transaction
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+
+from . import caching
+from .aggregates import signals_paused
+from .models import Bid, Product
+
+
+def place_bid(product_id, user, price, description):
+    """
+    Places a bid on a visible product the user does not own, if it beats the
+    current high bid by the product's minimum increment.
+
+    The checks and the high bid bookkeeping are one conditional UPDATE of the
+    product row, which also serializes concurrent bidders on it: each one
+    sees the high bid the previous one left, so two bids can never both win
+    against the same amount.
+    """
+    # loaded with the user by the authentication class
+    customer = getattr(user, 'customer', None)
+    if customer is None:
+        raise PermissionDenied
+    customer_id = customer.id
+    with transaction.atomic():
+        claimed = Product.objects \
+            .filter(pk=product_id, visible=True) \
+            .exclude(owner_id=customer_id) \
+            .filter(Q(highest_bid__isnull=True) | Q(highest_bid__lte=price - F('min_bid_increment'))) \
+            .update(highest_bid=price, bid_count=F('bid_count') + 1)
+        if not claimed:
+            raise rejection(product_id, customer_id)
+        # the counters were updated above, keep the signal handlers from doing it again
+        with signals_paused():
+            bid = Bid.objects.create(product_id=product_id, customer_id=customer_id,
+                                     price=price, description=description)
+        caching.products_changed([product_id])
+    return bid
+
+
+def rejection(product_id, customer_id):
+    """Works out why a bid was not placed; only runs on the failure path"""
+    product = Product.objects.filter(pk=product_id) \
+        .values('visible', 'owner_id', 'highest_bid', 'min_bid_increment').first()
+    if product is None:
+        return NotFound
+    if not product['visible'] or product['owner_id'] == customer_id:
+        return PermissionDenied
+    return ValidationError({'price': [
+        'Must be at least %s' % (product['highest_bid'] + product['min_bid_increment'])]})
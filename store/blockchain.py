@@ -0,0 +1,361 @@
+import asyncio
+import json
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import aiohttp
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from store import metrics
+from store.cache import TTLCache
+
+
+DEFAULTS = {
+    'URL': 'http://localhost:8080',
+    'CONNECT_TIMEOUT': 2,
+    'READ_TIMEOUT': 5,
+    'RETRIES': 2,
+    'BACKOFF_FACTOR': 0.2,
+    'POOL_SIZE': 20,
+    # connections the async client may hold open, so requests it may have in flight
+    'ASYNC_POOL_SIZE': 1000,
+    'FAILURE_THRESHOLD': 5,
+    'RESET_TIMEOUT': 30,
+    'OWNER_CACHE_TTL': 10,
+    'OWNER_CACHE_SIZE': 10000,
+}
+
+
+RETRY_STATUSES = [502, 503, 504]
+
+
+class BlockchainError(Exception):
+    pass
+
+
+class BlockchainUnavailable(BlockchainError):
+    pass
+
+
+def owner_path(product_hash):
+    # the hash comes from users: a '/', '?' or '#' in it must not reach another endpoint
+    return '/item/owner/' + quote(product_hash, safe='')
+
+
+def node_url(base_url, path):
+    """`path` may hold segments quoted by the caller, such as owner_path's"""
+    return base_url + quote(path, safe='/%')
+
+
+def check_reply(data):
+    # both endpoints answer with an object, anything else is not the node talking
+    if not isinstance(data, dict):
+        raise BlockchainError('Blockchain node returned %s instead of an object' % type(data).__name__)
+    return data
+
+
+class CircuitBreaker:
+    """
+    Stops calling the node after `failure_threshold` consecutive failures.
+    After `reset_timeout` seconds a single trial call is let through; if it
+    succeeds the circuit closes again, otherwise it stays open.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class BlockchainClient:
+    """
+    Thin client for the blockchain node. A single keep-alive session with a
+    bounded connection pool is shared by every request thread.
+    """
+
+    def __init__(self, base_url, connect_timeout=2, read_timeout=5, retries=2,
+                 backoff_factor=0.2, pool_size=20, failure_threshold=5, reset_timeout=30,
+                 owner_cache_ttl=10, owner_cache_size=10000, async_pool_size=1000):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.async_pool_size = async_pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.owners = TTLCache(maxsize=owner_cache_size, ttl=owner_cache_ttl)
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            # both endpoints are read-only on the node side
+            allowed_methods=['GET', 'POST'],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'BLOCKCHAIN_NODE', {})}
+        return cls(
+            config['URL'],
+            connect_timeout=config['CONNECT_TIMEOUT'],
+            read_timeout=config['READ_TIMEOUT'],
+            retries=config['RETRIES'],
+            backoff_factor=config['BACKOFF_FACTOR'],
+            pool_size=config['POOL_SIZE'],
+            failure_threshold=config['FAILURE_THRESHOLD'],
+            reset_timeout=config['RESET_TIMEOUT'],
+            owner_cache_ttl=config['OWNER_CACHE_TTL'],
+            owner_cache_size=config['OWNER_CACHE_SIZE'],
+            async_pool_size=config['ASYNC_POOL_SIZE'],
+        )
+
+    def request(self, method, path, **kwargs):
+        if not self.breaker.allow():
+            raise BlockchainUnavailable('Blockchain node circuit is open')
+        try:
+            with metrics.timed('node'):
+                response = self.session.request(
+                    method, node_url(self.base_url, path), timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise BlockchainUnavailable(str(e)) from e
+        except BaseException:
+            # whatever went wrong, a half-open trial must end or the circuit never closes
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            raise BlockchainUnavailable(
+                'Blockchain node returned %s' % response.status_code)
+        self.breaker.record_success()
+        try:
+            data = response.json()
+        except ValueError as e:
+            raise BlockchainError('Blockchain node returned invalid JSON') from e
+        return check_reply(data)
+
+    def item_owner(self, product_hash, refresh=False):
+        """
+        Public key hash the node has on record as owner of the item. Answers
+        are cached for a short while; pass `refresh` to skip the cache.
+        """
+        if not refresh:
+            owner = self.owners.get(product_hash)
+            if owner is not None:
+                return owner
+        owner = self.request('GET', owner_path(product_hash)).get('item_owner')
+        # unregistered items are not cached, they may be registered any moment
+        if owner is not None:
+            self.owners.set(product_hash, owner)
+        return owner
+
+    def item_owners(self, product_hashes, workers=None, refresh=False):
+        """
+        Looks up the owners of many items at once, at most `workers` (the
+        pool size by default) at a time. Lookups that failed map to their
+        BlockchainError instead of an owner.
+        """
+        product_hashes = list(dict.fromkeys(product_hashes))
+        if not product_hashes:
+            return {}
+
+        def lookup(product_hash):
+            try:
+                return self.item_owner(product_hash, refresh=refresh)
+            except BlockchainError as e:
+                return e
+
+        workers = min(workers or self.pool_size, len(product_hashes))
+        # the lookups run on other threads, time the whole wait here
+        with metrics.timed('node'), \
+                ThreadPoolExecutor(max_workers=workers, thread_name_prefix='item-owners') as executor:
+            return dict(zip(product_hashes, executor.map(lookup, product_hashes)))
+
+    def forget_owner(self, product_hash):
+        self.owners.delete(product_hash)
+
+    def verify_token(self, token, signed_token, public_key):
+        payload = {
+            'token': str(token),
+            'signed_token': str(signed_token),
+            'public_key': public_key,
+        }
+        return 'verified' in self.request('POST', '/token/verify', json=payload)
+
+
+class AsyncBlockchainClient:
+    """
+    Coroutine counterpart of BlockchainClient for code running on an event
+    loop, so waiting on the node holds no thread. Requests go through an
+    aiohttp session per event loop, keeping up to `async_pool_size`
+    connections alive. Timeouts, retries and backoff are the sync client's,
+    as are the circuit breaker and owner cache, so both see the same node.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        # sessions belong to the loop that opened their connections
+        self.sessions = weakref.WeakKeyDictionary()
+
+    def session(self):
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session is None:
+            connect_timeout, read_timeout = self.client.timeout
+            session = self.sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.client.async_pool_size),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+                headers={'Accept': 'application/json'},
+            )
+        return session
+
+    async def close(self):
+        """Closes the current loop's connections, before the loop itself closes"""
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def request(self, method, path, payload=None):
+        breaker = self.client.breaker
+        if not breaker.allow():
+            raise BlockchainUnavailable('Blockchain node circuit is open')
+        try:
+            status, content = await self.send_with_retries(method, node_url(self.client.base_url, path), payload)
+        except CONNECTION_ERRORS as e:
+            breaker.record_failure()
+            raise BlockchainUnavailable(str(e) or type(e).__name__) from e
+        except BaseException:
+            # cancelled included, see BlockchainClient.request
+            breaker.record_failure()
+            raise
+        if status >= 500:
+            breaker.record_failure()
+            raise BlockchainUnavailable('Blockchain node returned %s' % status)
+        breaker.record_success()
+        try:
+            data = json.loads(content)
+        except ValueError as e:
+            raise BlockchainError('Blockchain node returned invalid JSON') from e
+        return check_reply(data)
+
+    async def send_with_retries(self, method, url, payload):
+        # the same schedule urllib3 follows for the sync client
+        retries = self.client.retries
+        for attempt in range(retries + 1):
+            if attempt > 1:
+                await asyncio.sleep(self.client.backoff_factor * 2 ** (attempt - 1))
+            try:
+                status, content = await self.send(method, url, payload)
+            except CONNECTION_ERRORS:
+                if attempt == retries:
+                    raise
+                continue
+            if status not in RETRY_STATUSES or attempt == retries:
+                return status, content
+
+    async def send(self, method, url, payload):
+        async with self.session().request(method, url, json=payload) as response:
+            return response.status, await response.read()
+
+    async def item_owner(self, product_hash, refresh=False):
+        """Same as BlockchainClient.item_owner, sharing its cache"""
+        owners = self.client.owners
+        if not refresh:
+            owner = owners.get(product_hash)
+            if owner is not None:
+                return owner
+        owner = (await self.request('GET', owner_path(product_hash))).get('item_owner')
+        if owner is not None:
+            owners.set(product_hash, owner)
+        return owner
+
+    def forget_owner(self, product_hash):
+        self.client.forget_owner(product_hash)
+
+    async def verify_token(self, token, signed_token, public_key):
+        payload = {
+            'token': str(token),
+            'signed_token': str(signed_token),
+            'public_key': public_key,
+        }
+        return 'verified' in await self.request('POST', '/token/verify', payload)
+
+
+# what a failed exchange with the node may raise
+CONNECTION_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+_client = None
+_client_lock = threading.Lock()
+_async_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = BlockchainClient.from_settings()
+    return _client
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        client = get_client()
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncBlockchainClient(client)
+    return _async_client
@@ -0,0 +1,206 @@
+import csv
+import json
+from collections import defaultdict
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import aggregates, caching
+from .blockchain import BlockchainError
+from .models import Collection, Product, Transfer
+from .rows import row_serializer
+from .search import reindex_batch
+from .serializers import ImportProductSerializer, ProductSerializer
+
+NDJSON = 'application/x-ndjson'
+CSV = 'text/csv'
+EXPORT_FIELDS = ['id', 'title', 'description', 'unit_price', 'collection', 'product_hash', 'visible']
+
+
+def read_rows(stream, content_type):
+    """
+    Yields (row number, row) from an NDJSON or CSV body as it arrives; a row
+    that cannot be parsed is yielded as its error message instead.
+    """
+    undecodable = set()
+
+    def decode(number, line):
+        try:
+            return line.decode('utf-8')
+        except UnicodeDecodeError:
+            undecodable.add(number)
+            return line.decode('utf-8', 'replace')
+
+    lines = (decode(number, line) for number, line in enumerate(iter(stream.readline, b''), 1))
+    if content_type == CSV:
+        reader = csv.DictReader(lines)
+        reader.fieldnames  # reads the header line
+        last = reader.line_num
+        for number, row in enumerate(reader, 1):
+            # quoted newlines spread a row over several lines
+            first, last = last + 1, reader.line_num
+            yield number, 'Invalid UTF-8' if undecodable.intersection(range(first, last + 1)) else row
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        if number in undecodable:
+            yield number, 'Invalid UTF-8'
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, 'Invalid JSON'
+            continue
+        yield number, row if isinstance(row, dict) else 'Expected a JSON object'
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def set_visibility(user_id, product_ids, visible):
+    """
+    Shows or hides those of `product_ids` the user owns that are not already
+    so, clearing their bids and open transfers as the single product
+    visibility endpoint does. Returns the changed products as values() rows
+    for ProductSerializer, in their new state.
+    """
+    lookups = row_serializer(ProductSerializer).lookups
+    changing = Product.objects.filter(pk__in=product_ids, owner__user_id=user_id).exclude(visible=visible)
+    with transaction.atomic():
+        # locked, so that the rows stay the ones the UPDATE changes
+        rows = list(changing.select_for_update(of=('self',)).order_by('id').values(*lookups))
+        if not rows:
+            return rows
+        ids = [row['id'] for row in rows]
+        changing.filter(pk__in=ids).update(visible=visible, last_update=timezone.now())
+        aggregates.clear_bids(ids)
+        Transfer.objects.filter(product_id__in=ids).delete()
+        deltas = defaultdict(lambda: [0, 0])
+        for row in rows:
+            deltas[row['collection']][1] += 1 if visible else -1
+        aggregates.count_products(deltas)
+    for row in rows:
+        row.update(visible=visible, highest_bid=None, bid_count=0)
+    return rows
+
+
+class ProductImport:
+    """
+    Imports products for `customer` batch by batch: rows are validated with
+    ImportProductSerializer, the owners of a batch's product hashes are looked
+    up concurrently on the node, and the rows that pass go in with one
+    bulk_create per batch, each batch in its own transaction. Errors are
+    collected per row and do not stop the import.
+    """
+
+    def __init__(self, customer, public_key_hash, client, batch_size=500):
+        self.customer = customer
+        self.public_key_hash = public_key_hash
+        self.client = client
+        self.batch_size = batch_size
+        # one serializer validates every row, building its fields is the slow part
+        self.serializer = ImportProductSerializer(context={'collections': Collection.objects.in_bulk()})
+        self.created = 0
+        self.errors = []
+
+    def run(self, rows):
+        for batch in batches(rows, self.batch_size):
+            self.import_batch(batch)
+        return {'created': self.created, 'errors': self.errors}
+
+    def fail(self, number, errors):
+        self.errors.append({'row': number, 'errors': errors})
+
+    def import_batch(self, batch):
+        valid = []
+        seen = set()
+        for number, row in batch:
+            if isinstance(row, str):
+                self.fail(number, {'non_field_errors': [row]})
+                continue
+            try:
+                data = self.serializer.run_validation(row)
+            except ValidationError as e:
+                self.fail(number, e.detail)
+                continue
+            if data['product_hash'] in seen:
+                self.fail(number, {'product_hash': ['Duplicate product_hash in this import.']})
+            else:
+                seen.add(data['product_hash'])
+                valid.append((number, data))
+
+        existing = set(Product.objects.filter(product_hash__in=seen).values_list('product_hash', flat=True))
+        owners = self.client.item_owners(seen - existing)
+        products = []
+        for number, data in valid:
+            owner = owners.get(data['product_hash'])
+            if data['product_hash'] in existing:
+                self.fail(number, {'product_hash': ['product with this product hash already exists.']})
+            elif isinstance(owner, BlockchainError):
+                self.fail(number, {'product_hash': ['Could not reach the blockchain node']})
+            elif owner is None or owner != self.public_key_hash:
+                self.fail(number, {'product_hash': ["Item not registered under the provided user's address"]})
+            else:
+                products.append((number, Product(owner=self.customer, **data)))
+        if products:
+            self.insert(products)
+
+    def insert(self, products):
+        try:
+            with transaction.atomic():
+                Product.objects.bulk_create([product for _, product in products])
+                self.created_all([product for _, product in products])
+        except IntegrityError:
+            # another import took some of these hashes since the batch was checked
+            for number, product in products:
+                product.pk = None
+                try:
+                    with transaction.atomic():
+                        product.save(force_insert=True)
+                except IntegrityError:
+                    self.fail(number, {'product_hash': ['product with this product hash already exists.']})
+                else:
+                    self.created += 1
+
+    def created_all(self, products):
+        # bulk_create sends no signals: index the rows and invalidate their pages here
+        inserted = list(Product.objects.filter(product_hash__in=[product.product_hash for product in products])
+                        .only('id', 'title', 'description'))
+        reindex_batch(inserted)
+        aggregates.count_products(aggregates.collection_deltas(products))
+        caching.touch(caching.PRODUCTS, *{caching.collection_products_scope(product.collection_id)
+                                          for product in products})
+        self.created += len(inserted)
+
+
+def export_rows(queryset, content_type, chunk_size=2000):
+    """Streams `queryset` as NDJSON or CSV lines without loading it into memory"""
+    rows = queryset.order_by('id').values_list(*EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+    if content_type == CSV:
+        buffer = LineBuffer()
+        writer = csv.writer(buffer)
+        yield writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow(row)
+        return
+    # the API's encoder, so prices are numbers here too and an export imports back as it was
+    encoder = JSONEncoder()
+    for row in rows:
+        yield encoder.encode(dict(zip(EXPORT_FIELDS, row))) + '\n'
+
+
+class LineBuffer:
+    """File-like object for csv.writer that hands back each line instead of storing it"""
+
+    def write(self, value):
+        return value
@@ -0,0 +1,191 @@
+import time
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from .models import Product
+from .routers import reads_from_replica
+
+# Every cached response depends on a few scopes, each with a version that is
+# the time it last changed. Keys embed the versions, so bumping a scope makes
+# every response depending on it unreachable at once.
+#
+# Validators do not come from Product.last_update: bids, comments, photo
+# variants, collections and owners change product responses without moving
+# it, and deleted products leave nothing behind to compare. Last-Modified is
+# the newest scope version instead. A version lost with the cache starts
+# again at the current time, so If-Modified-Since misses after a flush rather
+# than matching stale content. ETags are a hash of the content, the same
+# after a flush and from every worker as long as the response is.
+#
+# With a read replica, a response is cached under the versions current when
+# it is read, but the replica may not have the change behind the newest
+# version yet and would be cached as if it had. So for REPLICA_STICKY_SECONDS
+# after a version changes, the lag ReplicaRoutingMiddleware allows for too,
+# misses are read from the primary: one primary read per key and change
+# rather than a stale page kept until the next change or the cache timeout.
+# A flushed cache counts as changed.
+PRODUCTS = 'products'
+COLLECTIONS = 'collections'
+
+# What product responses show of their owner (CustomerSerializer), by model
+OWNER_FIELDS = {
+    'store.customer': ('phone',),
+    'core.user': ('first_name', 'last_name', 'wallet_address', 'public_key', 'verified'),
+}
+
+
+def product_scope(product_id):
+    return 'product:%s' % product_id
+
+
+def collection_products_scope(collection_id):
+    return 'products:collection:%s' % collection_id
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE', 'catalog')]
+
+
+def versions(scopes):
+    cache = get_cache()
+    keys = ['v:' + scope for scope in scopes]
+    found = cache.get_many(keys)
+    missing = {key: time.time() for key in keys if key not in found}
+    for key, version in missing.items():
+        # another worker may have set it first, keep theirs
+        cache.add(key, version, None)
+    if missing:
+        found.update(cache.get_many(list(missing)))
+    return [found.get(key, missing.get(key)) for key in keys]
+
+
+def touch(*scopes):
+    """
+    Marks the scopes as changed now, and again once the surrounding
+    transaction commits, so a response cached from a read that ran before
+    the commit does not outlive it.
+    """
+    def bump():
+        now = time.time()
+        get_cache().set_many({'v:' + scope: now for scope in scopes}, None)
+    bump()
+    transaction.on_commit(bump)
+
+
+def product_changed(product_id, *collection_ids):
+    touch(PRODUCTS, product_scope(product_id), *[collection_products_scope(id) for id in collection_ids if id])
+
+
+def products_changed(product_ids):
+    """For changes made with update(), which sends no signals"""
+    rows = Product.objects.filter(pk__in=product_ids).values_list('id', 'collection_id')
+    scopes = {PRODUCTS}
+    for product_id, collection_id in rows:
+        scopes.update((product_scope(product_id), collection_products_scope(collection_id)))
+    touch(*scopes)
+
+
+def owner_values(instance):
+    return tuple(getattr(instance, name) for name in OWNER_FIELDS[instance._meta.label_lower])
+
+
+def owner_changed(owned):
+    """
+    Product responses embed their owner, so a change to what they show of
+    them changes the `owned` products, and the listings these are in.
+    """
+    rows = list(owned.values_list('id', 'collection_id'))
+    if rows:
+        touch(PRODUCTS, *{scope for product_id, collection_id in rows
+                          for scope in (product_scope(product_id), collection_products_scope(collection_id))})
+
+
+def not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag in parse_etags(if_none_match) or if_none_match.strip() == '*'
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    return if_modified_since is not None and int(last_modified) <= if_modified_since
+
+
+def cached_response(view, request, scopes, respond):
+    """
+    Answers an anonymous GET from the catalog cache, calling `respond` only
+    on a miss. Conditional requests that still match a cached response get
+    a 304 without touching the database or the serializers.
+    """
+    if not scopes or request.method != 'GET' or request.user.is_authenticated:
+        return respond()
+
+    key = 'r:%s:%s' % (request.accepted_renderer.format, request.build_absolute_uri())
+    scope_versions = versions(scopes)
+    key += ':' + md5(repr(scope_versions).encode()).hexdigest()
+    last_modified = max(scope_versions)
+
+    cache = get_cache()
+    entry = cache.get(key)
+    if entry is None:
+        # If-None-Match takes precedence, and needs the content to compare with
+        if 'HTTP_IF_NONE_MATCH' not in request.META and not_modified(request, None, last_modified):
+            return conditional(HttpResponseNotModified(), None, last_modified)
+        lagging = time.time() - last_modified < getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+        token = reads_from_replica.set(reads_from_replica.get() and not lagging)
+        try:
+            response = respond()
+            if response.streaming:
+                return response
+            response.accepted_renderer = request.accepted_renderer
+            response.accepted_media_type = request.accepted_media_type
+            response.renderer_context = view.get_renderer_context()
+            response.render()
+        finally:
+            reads_from_replica.reset(token)
+        if response.status_code != 200:
+            return response
+        entry = {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'etag': quote_etag(md5(response.content).hexdigest()),
+        }
+        cache.set(key, entry)
+    else:
+        response = None
+
+    if not_modified(request, entry['etag'], last_modified):
+        response = HttpResponseNotModified()
+    elif response is None:
+        response = HttpResponse(entry['content'], content_type=entry['content_type'])
+    return conditional(response, entry['etag'], last_modified)
+
+
+def conditional(response, etag, last_modified):
+    if etag is not None:
+        response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ['Accept', 'Authorization'])
+    return response
+
+
+class CatalogCacheMixin:
+    """
+    Caches list and detail responses of a viewset for anonymous clients.
+    cache_scopes returns the scopes a response depends on; with none, as by
+    default, it is not cached.
+    """
+
+    def cache_scopes(self, request, pk=None):
+        return []
+
+    def list(self, request, *args, **kwargs):
+        return cached_response(self, request, self.cache_scopes(request),
+                               lambda: super(CatalogCacheMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return cached_response(self, request, self.cache_scopes(request, kwargs.get('pk')),
+                               lambda: super(CatalogCacheMixin, self).retrieve(request, *args, **kwargs))
@@ -0,0 +1,86 @@
+import random
+from itertools import accumulate
+from decimal import Decimal
+
+from django.db import transaction
+
+from core.models import User
+from store.aggregates import refresh_aggregates, refresh_collection_counts
+from store.models import Bid, Collection, Comment, Customer, Product, Transfer
+from store.search import index_products
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'sen', 'tor', 'vel', 'dun',
+             'pe', 'shi', 'gor', 'ban', 'tu', 'lin', 'mar', 'zo']
+# 4096 made up words drawn with a Zipf distribution, so that like in real
+# listings a few words are everywhere and most are rare
+VOCABULARY = [a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES]
+CUM_WEIGHTS = list(accumulate(1 / rank for rank in range(1, len(VOCABULARY) + 1)))
+
+
+def bulk_insert(model, rows, batch_size):
+    """Inserts the generated rows in batches without holding them all in memory."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+
+
+def phrase(rng, words):
+    return ' '.join(rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=words))
+
+
+@transaction.atomic
+def seed_store(products=1000, bids=10000, comments=5000, customers=100, collections=10,
+               transfers=100, batch_size=5000, seed=0):
+    """
+    Fills an empty database with a synthetic catalog. Customers are created
+    with bulk_create, so the post_save handler that normally creates them
+    does not run.
+    """
+    rng = random.Random(seed)
+
+    bulk_insert(Collection, (Collection(title='Collection %d' % i)
+                             for i in range(collections)), batch_size)
+    bulk_insert(User, (User(username='user%d' % i, email='user%d@example.com' % i,
+                            first_name='First%d' % i, last_name='Last%d' % i,
+                            wallet_address='wallet%d' % i, public_key='key%d' % i,
+                            public_key_hash='hash%d' % i, verified=True)
+                       for i in range(customers)), batch_size)
+    users = list(User.objects.order_by('id').values_list('id', flat=True))
+    bulk_insert(Customer, (Customer(user_id=user_id, phone='98%08d' % i)
+                           for i, user_id in enumerate(users)), batch_size)
+
+    collection_ids = list(Collection.objects.values_list('id', flat=True))
+    customer_ids = list(Customer.objects.order_by('id').values_list('id', flat=True))
+    bulk_insert(Product, (Product(title=phrase(rng, 3).title(), description=phrase(rng, 20),
+                                  unit_price=Decimal(rng.randint(100, 100000)) / 100,
+                                  collection_id=rng.choice(collection_ids),
+                                  owner_id=rng.choice(customer_ids),
+                                  photo='products/%d.jpg' % i, product_hash='%064x' % i)
+                          for i in range(products)), batch_size)
+    # bulk_create skips the post_save handlers that keep the search index and collection counters
+    index_products(Product.objects.all(), batch_size)
+    refresh_collection_counts()
+
+    product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+    bulk_insert(Bid, (Bid(product_id=product_ids[i % len(product_ids)],
+                          customer_id=rng.choice(customer_ids),
+                          price=Decimal(rng.randint(100, 100000)) / 100,
+                          description=phrase(rng, 8))
+                      for i in range(bids)), batch_size)
+    bulk_insert(Comment, (Comment(product_id=product_ids[i % len(product_ids)],
+                                  commentor_id=rng.choice(customer_ids),
+                                  description=phrase(rng, 12))
+                          for i in range(comments)), batch_size)
+    refresh_aggregates()
+
+    # every transfer goes to the customer created right after the seller
+    next_customer = dict(zip(customer_ids, customer_ids[1:] + customer_ids[:1]))
+    owners = Product.objects.order_by('id').values_list('id', 'owner_id')[:transfers]
+    bulk_insert(Transfer, (Transfer(product_id=product_id, seller_id=owner_id,
+                                    buyer_id=next_customer[owner_id])
+                           for product_id, owner_id in owners), batch_size)
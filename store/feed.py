@@ -0,0 +1,228 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+import re
+import threading
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+
+from .authentication import CachedJWTAuthentication
+from .models import Product
+
+# Live product events: new bids, approvals and comments. Model signals publish
+# them through a broker once the write commits, and ProductFeedApplication
+# streams them to subscribers as Server-Sent Events. A waiting subscriber is
+# one parked coroutine and an empty queue, so thousands of them cost little.
+
+FEED_PATH = re.compile(r'^/store/products/(?P<product_id>\d+)/events/$')
+# tells a subscriber that fell too far behind to refetch over REST
+RESET = json.dumps({'event': 'reset', 'data': {}})
+# queued by the stream itself, not by publishers
+KEEPALIVE = object()
+DISCONNECTED = object()
+
+
+def channel(product_id):
+    return 'product:%s' % product_id
+
+
+class Broker(ABC):
+    """
+    Carries messages (strings) from publishers, on any thread, to the
+    subscriptions of a channel. The local broker only reaches subscribers in
+    this process; a shared one (Redis, Postgres LISTEN/NOTIFY) implements the
+    same three methods.
+    """
+
+    @abstractmethod
+    def publish(self, channel, message):
+        pass
+
+    @abstractmethod
+    def subscribe(self, channel):
+        """Returns a Subscription; call from the event loop that will read it"""
+
+    @abstractmethod
+    def unsubscribe(self, subscription):
+        pass
+
+
+class Subscription:
+    def __init__(self, channel, loop, maxsize):
+        self.channel = channel
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, message):
+        """Call on the subscription's event loop"""
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            if message is not DISCONNECTED:
+                message = RESET
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class LocalBroker(Broker):
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+
+    def publish(self, channel, message):
+        loops = defaultdict(list)
+        with self.lock:
+            for subscription in self.subscriptions.get(channel, ()):
+                loops[subscription.loop].append(subscription)
+        # one wakeup per event loop however many subscribers it serves
+        for loop, subscriptions in loops.items():
+            try:
+                loop.call_soon_threadsafe(self.deliver, subscriptions, message)
+            except RuntimeError:
+                # the event loop is gone
+                for subscription in subscriptions:
+                    self.unsubscribe(subscription)
+
+    @staticmethod
+    def deliver(subscriptions, message):
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def subscribe(self, channel):
+        subscription = Subscription(channel, asyncio.get_running_loop(), self.maxsize)
+        with self.lock:
+            self.subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.channel]
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'FEED_BROKER', 'store.feed.LocalBroker'))()
+    return _broker
+
+
+def publish(product_id, event, data):
+    """Sends the event to the product's subscribers once the current transaction commits"""
+    # the encoder the API renders with, so events look like the REST resources
+    message = json.dumps({'event': event, 'data': data}, cls=JSONEncoder)
+    transaction.on_commit(lambda: get_broker().publish(channel(product_id), message))
+
+
+def bid_event(bid):
+    return {'id': bid.id, 'price': bid.price, 'description': bid.description,
+            'placed_at': bid.placed_at, 'customer': bid.customer_id}
+
+
+def comment_event(comment):
+    return {'id': comment.id, 'description': comment.description,
+            'date': comment.date, 'commentor': comment.commentor_id}
+
+
+def format_event(message):
+    event = json.loads(message)
+    return ('event: %s\ndata: %s\n\n' % (event['event'], json.dumps(event['data']))).encode()
+
+
+@sync_to_async
+def authorize(scope, product_id):
+    """Same rule as the bid list: any authenticated user, for a product that exists"""
+    header = dict(scope['headers']).get(b'authorization', b'').split()
+    # EventSource cannot send headers, so the token may come in the query string
+    query = parse_qs(scope.get('query_string', b'').decode())
+    raw_token = header[1] if len(header) == 2 else query.get('token', [''])[0].encode()
+    if not raw_token:
+        return 401
+    authentication = CachedJWTAuthentication()
+    try:
+        user = authentication.get_user(authentication.get_validated_token(raw_token))
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return 401
+    if not user.is_active:
+        return 401
+    if not Product.objects.filter(pk=product_id).exists():
+        return 404
+    return 200
+
+
+class ProductFeedApplication:
+    """
+    ASGI application streaming /store/products/<id>/events/ as Server-Sent
+    Events and passing every other request on to `application`.
+    """
+    keepalive = 15
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        match = FEED_PATH.match(scope.get('path', '')) if scope['type'] == 'http' else None
+        if match is None or scope['method'] != 'GET':
+            return await self.application(scope, receive, send)
+        product_id = int(match['product_id'])
+        status = await authorize(scope, product_id)
+        if status != 200:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        await self.stream(product_id, receive, send)
+
+    async def stream(self, product_id, receive, send):
+        # everything the stream waits for arrives through the one queue, so an
+        # idle subscriber is a single parked coroutine and a timer
+        broker = get_broker()
+        subscription = broker.subscribe(channel(product_id))
+        watcher = asyncio.ensure_future(self.watch_disconnect(receive, subscription))
+        loop = asyncio.get_running_loop()
+        keepalive = None
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                # keep proxies from buffering the stream
+                (b'x-accel-buffering', b'no'),
+            ]})
+            await send({'type': 'http.response.body', 'body': b': connected\n\n', 'more_body': True})
+            while True:
+                keepalive = loop.call_later(self.keepalive, subscription.put, KEEPALIVE)
+                message = await subscription.get()
+                keepalive.cancel()
+                if message is DISCONNECTED:
+                    break
+                body = b': keepalive\n\n' if message is KEEPALIVE else format_event(message)
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        finally:
+            if keepalive is not None:
+                keepalive.cancel()
+            broker.unsubscribe(subscription)
+            watcher.cancel()
+
+    async def watch_disconnect(self, receive, subscription):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        subscription.put(DISCONNECTED)
@@ -1,5 +1,7 @@
 from django_filters.rest_framework import FilterSet
+from rest_framework.filters import SearchFilter
 from .models import Product
+from .search import search_products
 
 class ProductFilter(FilterSet):
     class Meta:
@@ -7,4 +9,13 @@ class ProductFilter(FilterSet):
         fields = {
             'collection_id': ['exact'],
             'unit_price': ['gt', 'lt']
-        }
\ No newline at end of file
+        }
+
+
+class ProductSearchFilter(SearchFilter):
+    """?search= backed by the product search index instead of icontains scans"""
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        return search_products(queryset, ' '.join(terms))
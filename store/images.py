@@ -0,0 +1,129 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO
+from os import path
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.utils import timezone
+from PIL import Image, features
+
+from . import caching
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+VARIANTS_DIRECTORY = 'products/variants'
+
+DEFAULT_VARIANTS = {
+    'thumb': (200, 200),
+    'medium': (800, 800),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_variants():
+    return getattr(settings, 'PRODUCT_IMAGE_VARIANTS', DEFAULT_VARIANTS)
+
+
+def get_format():
+    return 'WEBP' if features.check('webp') else 'JPEG'
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'PRODUCT_IMAGE_WORKERS', 2),
+                    thread_name_prefix='product-images')
+    return _executor
+
+
+def variant_name(name, variant, image_format):
+    stem = path.splitext(path.basename(name))[0]
+    extension = 'webp' if image_format == 'WEBP' else 'jpg'
+    return '%s/%s_%s.%s' % (VARIANTS_DIRECTORY, stem, variant, extension)
+
+
+def render_variant(image, size, image_format):
+    variant = image.copy()
+    variant.thumbnail(size, Image.LANCZOS)
+    if variant.mode not in ('RGB', 'RGBA') or (image_format == 'JPEG' and variant.mode == 'RGBA'):
+        variant = variant.convert('RGB')
+    buffer = BytesIO()
+    variant.save(buffer, image_format, quality=82, optimize=True)
+    return buffer.getvalue()
+
+
+def generate_variants(product_id):
+    """
+    Writes every configured variant of the product's photo next to the
+    original and records their names on the product.
+    """
+    product = Product.objects.filter(pk=product_id).only('photo').first()
+    if product is None or not product.photo:
+        return {}
+    storage = product.photo.storage
+    image_format = get_format()
+    names = {}
+    with storage.open(product.photo.name) as original:
+        image = Image.open(original)
+        image.load()
+    for variant, size in get_variants().items():
+        # stored under the hash of its bytes, shared with every product that
+        # has the same photo; saving what is already there keeps it in place
+        name = variant_name(product.photo.name, variant, image_format)
+        names[variant] = storage.save(name, ContentFile(render_variant(image, size, image_format)))
+    # the photo may have been replaced while we were working
+    Product.objects.filter(pk=product_id, photo=product.photo.name).update(photo_variants=names)
+    caching.products_changed([product_id])
+    return names
+
+
+def prune_variants(storage, grace=3600):
+    """
+    Deletes the variant files no product lists any more, those of replaced
+    photos. Variants are content addressed and may be shared by products
+    with the same photo, so only a look at every product tells which are
+    unused. Files younger than `grace` seconds are kept: the product they
+    were written for may not have been updated yet. Returns how many went.
+    """
+    if not storage.exists(VARIANTS_DIRECTORY):
+        return 0
+    used = set()
+    for variants in Product.objects.exclude(photo_variants={}).values_list('photo_variants', flat=True).iterator():
+        used.update(variants.values())
+    directories, files = storage.listdir(VARIANTS_DIRECTORY)
+    names = ['%s/%s' % (VARIANTS_DIRECTORY, name) for name in files]
+    for directory in directories:
+        directory = '%s/%s' % (VARIANTS_DIRECTORY, directory)
+        names += ['%s/%s' % (directory, name) for name in storage.listdir(directory)[1]]
+    cutoff = timezone.now() - timedelta(seconds=grace)
+    removed = 0
+    for name in names:
+        if name not in used and storage.get_modified_time(name) < cutoff:
+            storage.delete(name)
+            removed += 1
+    return removed
+
+
+def run_in_background(product_id):
+    try:
+        generate_variants(product_id)
+    except Exception:
+        logger.exception('Could not generate image variants of product %s', product_id)
+    finally:
+        # connections are per thread, do not leave this one open in the pool
+        connections.close_all()
+
+
+def schedule_variants(product_id):
+    """Generates the variants on the worker pool once the upload is committed."""
+    transaction.on_commit(lambda: get_executor().submit(run_in_background, product_id))
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework_simplejwt.tokens import AccessToken
+
+from store import async_api, views
+from store.async_api import AsyncApiApplication
+from store.blockchain import AsyncBlockchainClient, BlockchainClient
+from store.management.commands.bid_loadtest import make_user
+from store.management.commands.blockchain_loadtest import percentile
+from store.models import Collection
+
+
+class Command(BaseCommand):
+    help = 'Compares the sync and async node-bound endpoints against a slow stub node, in a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', choices=['verify', 'create'], default='verify')
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=16,
+                            help='Request threads for the sync run, as in a threaded WSGI server')
+        parser.add_argument('--concurrency', type=int, default=1000,
+                            help='Requests in flight at once in the async run')
+        parser.add_argument('--delay', type=float, default=0.05,
+                            help='Seconds the stub node waits before answering')
+
+    def handle(self, *args, **options):
+        url, stub = self.start_stub(options['delay'])
+        # both runs get a client of their own on the stub, the pool sized for the run
+        sync_client = BlockchainClient(url, pool_size=options['workers'])
+        async_client = AsyncBlockchainClient(BlockchainClient(url, async_pool_size=options['concurrency']))
+
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            user = make_user('seller')
+            collection = Collection.objects.create(title='Bench')
+            requests = [self.request(options['endpoint'], i, collection.id) for i in range(options['requests'])]
+            token = 'JWT %s' % AccessToken.for_user(user)
+            with mock.patch.object(views, 'get_client', return_value=sync_client):
+                self.report('sync', options['workers'], *self.run_sync(requests, token, options['workers']))
+            # the second run must not trip over rows from the first
+            requests = [self.request(options['endpoint'], i, collection.id, 'async')
+                        for i in range(options['requests'])]
+            with mock.patch.object(async_api, 'get_async_client', return_value=async_client):
+                self.report('async', options['concurrency'],
+                            *asyncio.run(self.run_async(requests, token, options['concurrency'])))
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            stub.terminate()
+            stub.wait()
+
+    def start_stub(self, delay):
+        # in a process of its own, so that it does not compete for this one's GIL
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        stub = subprocess.Popen([sys.executable, sys.argv[0], 'blockchain_stub', '--port', str(port),
+                                 '--delay', str(delay), '--owner', 'hash-seller'], stdout=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        return 'http://127.0.0.1:%d' % port, stub
+
+    def request(self, endpoint, i, collection_id, prefix='sync'):
+        if endpoint == 'verify':
+            return 'POST', '/store/customers/verify_token/', {'signed_token': 'signed-%d' % i}
+        return 'POST', '/store/products/', {
+            'title': 'item %d' % i, 'description': 'benchmark', 'unit_price': '10.00',
+            'collection': collection_id, 'product_hash': '%s-%d' % (prefix, i)}
+
+    def run_sync(self, requests, token, workers):
+        local = threading.local()
+        lock = threading.Lock()
+        latencies = []
+        statuses = {}
+        peak_threads = threading.active_count()
+
+        def call(request):
+            nonlocal peak_threads
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client(raise_request_exception=False, HTTP_AUTHORIZATION=token)
+            method, path, data = request
+            started = time.perf_counter()
+            response = client.generic(method, path, json.dumps(data), 'application/json')
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                peak_threads = max(peak_threads, threading.active_count())
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(call, requests))
+        return time.perf_counter() - started, latencies, statuses, peak_threads
+
+    async def run_async(self, requests, token, concurrency):
+        application = AsyncApiApplication(ASGIHandler())
+        slots = asyncio.Semaphore(concurrency)
+        latencies = []
+        statuses = {}
+        peak_threads = threading.active_count()
+
+        async def call(request):
+            nonlocal peak_threads
+            method, path, data = request
+            body = json.dumps(data).encode()
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': [
+                (b'authorization', token.encode()), (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode())]}
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+
+            async def send(message):
+                sent.append(message)
+
+            async with slots:
+                started = time.perf_counter()
+                await application(scope, receive, send)
+                latencies.append(time.perf_counter() - started)
+            statuses[sent[0]['status']] = statuses.get(sent[0]['status'], 0) + 1
+            peak_threads = max(peak_threads, threading.active_count())
+
+        started = time.perf_counter()
+        await asyncio.gather(*[call(request) for request in requests])
+        elapsed = time.perf_counter() - started
+        # asyncio.run closes the loop next, so its connections go first
+        await async_api.get_async_client().close()
+        return elapsed, latencies, statuses, peak_threads
+
+    def report(self, mode, width, elapsed, latencies, statuses, threads):
+        self.stdout.write('%-5s %5d %s: %6.0f requests/s, p50 %6.1fms, p99 %6.1fms, %d threads, statuses %s' % (
+            mode, width, 'workers' if mode == 'sync' else 'in flight', len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, threads,
+            ', '.join('%s x%d' % item for item in sorted(statuses.items()))))
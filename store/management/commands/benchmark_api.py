@@ -0,0 +1,149 @@
+import json
+import statistics
+import time
+from os import path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (CaptureQueriesContext, setup_test_environment,
+                               teardown_test_environment)
+from rest_framework.test import APIClient
+
+from store.caching import get_cache
+from store.factories import VOCABULARY, seed_store
+from store.models import Customer, Product, Transfer
+from store.pagination import ProductKeysetPagination
+
+BASELINE = path.join(path.dirname(path.dirname(path.dirname(__file__))), 'benchmark_baseline.json')
+
+
+def endpoints():
+    """(name, url, authenticated) for every endpoint the benchmark covers."""
+    product_id = Product.objects.order_by('id').values_list('id', flat=True).first()
+    collection_id = Product.objects.filter(pk=product_id).values_list('collection_id', flat=True).first()
+    last_page = (Product.objects.count() + 9) // 10
+    title, last_id = Product.objects.order_by('-title', '-id').values_list('title', 'id')[10]
+    deep_cursor = ProductKeysetPagination.encode_position([title, str(last_id)])
+    return [
+        ('collections', '/store/collections/', False),
+        ('products', '/store/products/', False),
+        ('products_deep_page', '/store/products/?page=%d' % last_page, False),
+        ('products_cursor', '/store/products/?cursor=', False),
+        ('products_deep_cursor', '/store/products/?cursor=%s' % deep_cursor, False),
+        ('products_in_collection', '/store/products/?collection_id=%d' % collection_id, False),
+        # a word about as common as a typical search term
+        ('products_search', '/store/products/?search=%s' % VOCABULARY[100], False),
+        ('product_detail', '/store/products/%d/' % product_id, False),
+        ('product_comments', '/store/products/%d/comments/' % product_id, False),
+        ('product_bids', '/store/products/%d/bids/' % product_id, True),
+        ('transfers', '/store/transfers/', True),
+    ]
+
+
+def body_size(response):
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic store in a test database and benchmarks the API against a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--bids', type=int, default=1000000)
+        parser.add_argument('--comments', type=int, default=500000)
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--transfers', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Timed requests per endpoint; the median is reported')
+        parser.add_argument('--baseline', default=BASELINE)
+        parser.add_argument('--time-tolerance', type=float, default=0.5,
+                            help='Allowed relative slowdown before a timing counts as a regression')
+        parser.add_argument('--size-tolerance', type=float, default=0.05)
+        parser.add_argument('--update-baseline', action='store_true',
+                            help='Write the results as the new baseline instead of comparing')
+
+    def handle(self, *args, **options):
+        dataset = {key: options[key] for key in ('products', 'bids', 'comments', 'customers', 'transfers')}
+        # as under the test runner: no query log or debug toolbar skewing the numbers
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            started = time.perf_counter()
+            seed_store(**dataset)
+            self.stdout.write('Seeded %s in %.1fs' % (
+                ', '.join('%d %s' % (count, name) for name, count in dataset.items()),
+                time.perf_counter() - started))
+            results = self.run_endpoints(options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['update_baseline']:
+            with open(options['baseline'], 'w') as f:
+                json.dump({'dataset': dataset, 'endpoints': results}, f, indent=2, sort_keys=True)
+                f.write('\n')
+            self.stdout.write('Baseline written to %s' % options['baseline'])
+            return
+        if not path.exists(options['baseline']):
+            raise CommandError('No baseline at %s, run with --update-baseline first' % options['baseline'])
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+        regressions = self.compare(results, baseline, dataset, options)
+        if regressions:
+            raise CommandError('Performance regressions:\n  ' + '\n  '.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions against %s' % options['baseline']))
+
+    def run_endpoints(self, repeat):
+        client = APIClient()
+        user = Customer.objects.get(pk=Transfer.objects.values_list('buyer_id', flat=True).first()).user
+        results = {}
+        self.stdout.write('%-24s %8s %10s %10s' % ('endpoint', 'queries', 'ms', 'bytes'))
+        for name, url, authenticated in endpoints():
+            client.force_authenticate(user if authenticated else None)
+            # measure the database and serializer path, not the catalog cache
+            get_cache().clear()
+            with CaptureQueriesContext(connection) as context:
+                response = client.get(url)
+                size = body_size(response)
+            # read before the next request resets the query log
+            queries = len(context.captured_queries)
+            if response.status_code != 200:
+                raise CommandError('%s answered %s' % (url, response.status_code))
+            timings = []
+            for _ in range(repeat):
+                get_cache().clear()
+                started = time.perf_counter()
+                body_size(client.get(url))
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = {
+                'queries': queries,
+                'ms': round(statistics.median(timings), 2),
+                'bytes': size,
+            }
+            self.stdout.write('%-24s %8d %10.2f %10d' % (
+                name, results[name]['queries'], results[name]['ms'], size))
+        return results
+
+    def compare(self, results, baseline, dataset, options):
+        same_dataset = baseline['dataset'] == dataset
+        if not same_dataset:
+            self.stdout.write(self.style.WARNING(
+                'Dataset differs from the baseline, only query counts are compared'))
+        regressions = []
+        for name, result in results.items():
+            expected = baseline['endpoints'].get(name)
+            if expected is None:
+                continue
+            if result['queries'] > expected['queries']:
+                regressions.append('%s: %d queries, baseline %d' % (
+                    name, result['queries'], expected['queries']))
+            if not same_dataset:
+                continue
+            # a couple of milliseconds of slack keeps tiny endpoints from flapping
+            if result['ms'] > expected['ms'] * (1 + options['time_tolerance']) + 2:
+                regressions.append('%s: %.2fms, baseline %.2fms' % (name, result['ms'], expected['ms']))
+            if result['bytes'] > expected['bytes'] * (1 + options['size_tolerance']):
+                regressions.append('%s: %d bytes, baseline %d' % (name, result['bytes'], expected['bytes']))
+        return regressions
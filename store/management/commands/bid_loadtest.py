@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.test import APIClient
+
+from core.models import User
+from store.management.commands.blockchain_loadtest import percentile
+from store.models import Bid, Collection, Product
+
+
+def make_user(name):
+    return User.objects.create_user(username=name, email=name + '@example.com', password='secret',
+                                    wallet_address='wallet-' + name, public_key='key-' + name,
+                                    public_key_hash='hash-' + name)
+
+
+class Command(BaseCommand):
+    help = 'Fires concurrent bids at one product in a test database and checks the outcome'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bidders', type=int, default=200,
+                            help='Number of distinct customers bidding')
+        parser.add_argument('--bids', type=int, default=2000, help='Total bids to attempt')
+        parser.add_argument('--workers', type=int, default=32,
+                            help='Number of request threads, as in a threaded WSGI server')
+        parser.add_argument('--increment', type=Decimal, default=Decimal('1.00'),
+                            help="The product's minimum bid increment")
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            product, users = self.seed(options['bidders'], options['increment'])
+            self.run(product, users, options)
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def seed(self, bidders, increment):
+        seller = make_user('seller')
+        product = Product.objects.create(
+            title='hot item', unit_price=10, collection=Collection.objects.create(title='Hot'),
+            owner=seller.customer, photo='products/hot.jpg', product_hash='hot', min_bid_increment=increment)
+        users = [make_user('bidder%d' % i) for i in range(bidders)]
+        return product, users
+
+    def run(self, product, users, options):
+        url = '/store/products/%d/bids/' % product.id
+        increment = options['increment']
+        local = threading.local()
+        lock = threading.Lock()
+        latencies = []
+        statuses = Counter()
+
+        def bid(i):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = APIClient(raise_request_exception=False)
+            client.force_authenticate(users[i % len(users)])
+            # every bidder outbids what they last saw, so most lose a race for it
+            highest = Product.objects.filter(pk=product.id).values_list('highest_bid', flat=True).get()
+            price = (highest or product.unit_price) + increment
+            started = time.perf_counter()
+            response = client.post(url, {'price': str(price), 'description': 'bid %d' % i})
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] += 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            list(executor.map(bid, range(options['bids'])))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write('%d bids from %d bidders on %d threads in %.2fs: %.0f requests/s' % (
+            options['bids'], len(users), options['workers'], elapsed, options['bids'] / elapsed))
+        self.stdout.write('statuses: %s' % ', '.join('%s x%d' % item for item in sorted(statuses.items())))
+        self.stdout.write('latency p50 %.1fms, p99 %.1fms' % (
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+        self.check_outcome(product, increment, statuses)
+
+    def check_outcome(self, product, increment, statuses):
+        product.refresh_from_db()
+        prices = list(Bid.objects.filter(product=product).order_by('id').values_list('price', flat=True))
+        problems = []
+        if len(prices) != statuses[201]:
+            problems.append('%d bids stored, %d accepted' % (len(prices), statuses[201]))
+        if product.bid_count != len(prices):
+            problems.append('bid_count is %d, %d bids stored' % (product.bid_count, len(prices)))
+        if prices and product.highest_bid != max(prices):
+            problems.append('highest_bid is %s, best bid %s' % (product.highest_bid, max(prices)))
+        # in order of placement every bid must beat the one before it
+        for before, after in zip(prices, prices[1:]):
+            if after < before + increment:
+                problems.append('bid of %s placed after %s' % (after, before))
+                break
+        failed = sum(count for code, count in statuses.items() if code not in (201, 400))
+        if failed:
+            # lock timeouts under heavy contention; they must not leave anything behind
+            self.stdout.write(self.style.WARNING('%d requests failed outright' % failed))
+        if problems:
+            raise CommandError('Inconsistent outcome:\n  ' + '\n  '.join(problems))
+        self.stdout.write(self.style.SUCCESS(
+            '%d bids accepted, each beating the previous by at least %s' % (len(prices), increment)))
@@ -0,0 +1,83 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+
+from store.blockchain import BlockchainClient, BlockchainError
+from store.management.commands.blockchain_stub import make_server
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = 'Measures ownership lookups against a slow stub node'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=16,
+                            help='Number of request threads, as in a threaded WSGI server')
+        parser.add_argument('--delay', type=float, default=0.05,
+                            help='Seconds the stub node waits before answering')
+        parser.add_argument('--read-timeout', type=float, default=0.5)
+        parser.add_argument('--distinct', type=int, default=0,
+                            help='Cycle through this many product hashes (0 means every call is unique)')
+        parser.add_argument('--legacy', action='store_true',
+                            help='Use a fresh requests.get per call with no timeout, as the views used to')
+
+    def handle(self, *args, **options):
+        server = make_server(port=0, delay=options['delay'])
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%s' % server.server_address[1]
+
+        if options['legacy']:
+            def lookup(product_hash):
+                return requests.get(url + '/item/owner/' + product_hash).json().get('item_owner')
+        else:
+            client = BlockchainClient(url, read_timeout=options['read_timeout'],
+                                      pool_size=options['workers'])
+            lookup = client.item_owner
+
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        distinct = options['distinct']
+
+        def call(i):
+            started = time.perf_counter()
+            try:
+                lookup('hash-%d' % (i % distinct if distinct else i))
+            except (BlockchainError, requests.RequestException) as e:
+                with lock:
+                    errors.append(e)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            list(pool.map(call, range(options['requests'])))
+        wall = time.perf_counter() - started
+        server.shutdown()
+        server.server_close()
+
+        busy = sum(latencies)
+        self.stdout.write('mode:          %s' % ('legacy' if options['legacy'] else 'pooled client'))
+        self.stdout.write('requests:      %d (%d errors)' % (len(latencies), len(errors)))
+        self.stdout.write('node delay:    %.1f ms' % (options['delay'] * 1000))
+        self.stdout.write('throughput:    %.1f req/s' % (len(latencies) / wall))
+        self.stdout.write('p50 latency:   %.1f ms' % (percentile(latencies, 50) * 1000))
+        self.stdout.write('p99 latency:   %.1f ms' % (percentile(latencies, 99) * 1000))
+        self.stdout.write('worker use:    %.1f%% of %d workers blocked on the node' % (
+            100 * busy / (wall * options['workers']), options['workers']))
+        if not options['legacy']:
+            stats = client.owners.stats()
+            self.stdout.write('owner cache:   %d hits, %d misses' % (stats['hits'], stats['misses']))
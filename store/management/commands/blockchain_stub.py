@@ -0,0 +1,96 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+
+class StubNodeHandler(BaseHTTPRequestHandler):
+    """
+    Answers the two node endpoints the store uses. Every item is owned by
+    `server.owner` and every token verifies, except that the next
+    `server.failures` calls are answered 503 Service Unavailable.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.startswith('/item/owner/'):
+            self.reply({'item_owner': self.server.owner})
+        else:
+            self.reply({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.path == '/token/verify':
+            self.reply({'verified': True})
+        else:
+            self.reply({'error': 'not found'}, status=404)
+
+    def reply(self, data, status=200):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.failures:
+            self.server.failures -= 1
+            data, status = {'error': 'busy'}, 503
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class StubNodeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # async clients open hundreds of connections at once
+    request_queue_size = 1024
+
+    def get_request(self):
+        # counted so that tests can tell reused connections from new ones
+        self.connections += 1
+        return super().get_request()
+
+    def handle_error(self, request, client_address):
+        # clients that gave up on a slow answer close the socket under us
+        if self.verbose:
+            super().handle_error(request, client_address)
+
+
+def make_server(host='127.0.0.1', port=8080, delay=0.0, owner='stub-owner', verbose=False):
+    server = StubNodeServer((host, port), StubNodeHandler)
+    server.delay = delay
+    server.owner = owner
+    server.verbose = verbose
+    server.connections = 0
+    server.failures = 0
+    return server
+
+
+class Command(BaseCommand):
+    help = 'Runs a local stand-in for the blockchain node'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8080)
+        parser.add_argument('--delay', type=float, default=0.0,
+                            help='Seconds to wait before answering each call')
+        parser.add_argument('--owner', default='stub-owner',
+                            help='Public key hash reported as owner of every item')
+
+    def handle(self, *args, **options):
+        server = make_server(options['host'], options['port'], options['delay'],
+                             options['owner'], verbose=options['verbosity'] > 1)
+        self.stdout.write('Stub node listening on http://%s:%s (delay %.3fs)' % (
+            options['host'], options['port'], options['delay']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from store import views
+from store.models import Collection, Customer
+
+
+class Command(BaseCommand):
+    help = "Prints the database's query plan for each viewset's list query"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, default=1,
+                            help='Product id used for the nested bid and comment lists')
+        parser.add_argument('--collection', type=int,
+                            help='Collection id for the filtered product list, defaults to the first one')
+        parser.add_argument('--customer', type=int, default=1,
+                            help='Customer id whose transfers are listed')
+
+    def handle(self, *args, **options):
+        product = {'product_pk': options['product']}
+        # the transfer list only reads request.user.customer
+        user = SimpleNamespace(customer=Customer(pk=options['customer']), is_authenticated=True)
+        cases = [
+            ('products', views.ProductsViewSet, '/store/products/', {}, None),
+            ('products by cursor', views.ProductsViewSet, '/store/products/?cursor=', {}, None),
+            ('products search', views.ProductsViewSet, '/store/products/?search=oak', {}, None),
+            ('comments', views.CommentViewSet, '/store/products/1/comments/', product, None),
+            ('bids', views.BidViewSet, '/store/products/1/bids/', product, None),
+            ('transfers', views.TransferViewset, '/store/transfers/', {}, user),
+        ]
+        # the collection filter rejects ids that do not exist
+        collection = options['collection'] or Collection.objects.values_list('id', flat=True).first()
+        if collection is not None:
+            cases.insert(1, ('products by collection', views.ProductsViewSet,
+                             '/store/products/?collection_id=%d' % collection, {}, None))
+        factory = APIRequestFactory()
+        for name, viewset, url, kwargs, user in cases:
+            request = Request(factory.get(url))
+            if user is not None:
+                request.user = user
+            view = viewset(request=request, kwargs=kwargs, action='list', format_kwarg=None)
+            queryset = view.filter_queryset(view.get_queryset())
+            paginator = view.paginator
+            keyset = getattr(paginator, 'keyset_class', None)
+            if keyset is not None and keyset.cursor_query_param in request.query_params:
+                queryset = queryset.order_by(*keyset.ordering)
+            queryset = queryset[:10]
+
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(str(queryset.query))
+            for line in queryset.explain().splitlines():
+                self.stdout.write('    ' + line)
+            self.stdout.write('')
@@ -0,0 +1,28 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from store.images import generate_variants, prune_variants
+from store.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Generates the resized photo variants of products that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Regenerate the variants of every product with a photo')
+        parser.add_argument('--prune', action='store_true',
+                            help='Then delete the variant files no product uses any more')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(photo='').exclude(photo__isnull=True)
+        if not options['all']:
+            products = products.filter(photo_variants={})
+        done = 0
+        for product_id in products.values_list('id', flat=True).iterator():
+            generate_variants(product_id)
+            done += 1
+        self.stdout.write(self.style.SUCCESS('Generated variants for %d products' % done))
+        if options['prune']:
+            removed = prune_variants(default_storage)
+            self.stdout.write(self.style.SUCCESS('Deleted %d unused variant files' % removed))
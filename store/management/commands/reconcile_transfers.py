@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.blockchain import get_client
+from store.reconcile import TransferReconciler
+
+
+class Command(BaseCommand):
+    help = 'Completes open transfers the blockchain node already shows under their buyer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Node lookups in flight at once (the client pool size by default)')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, starting a pass every this many seconds')
+
+    def handle(self, *args, **options):
+        reconciler = TransferReconciler(get_client(), batch_size=options['batch_size'],
+                                        workers=options['workers'])
+        while True:
+            started = time.monotonic()
+            stats = reconciler.run_pass()
+            if stats is None:
+                self.stdout.write('Another runner holds the job')
+            else:
+                self.stdout.write('checked %(checked)d, completed %(completed)d, '
+                                  'pending %(pending)d, failed %(failed)d' % stats)
+            if not options['interval']:
+                return
+            time.sleep(max(options['interval'] - (time.monotonic() - started), 0))
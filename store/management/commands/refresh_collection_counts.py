@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.aggregates import refresh_collection_counts
+from store.models import Collection
+
+COUNTERS = ('id', 'product_count', 'visible_product_count')
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the product counters of every collection, a batch of collections per transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        checked = repaired = 0
+        last_id = 0
+        while True:
+            ids = list(Collection.objects.filter(pk__gt=last_id).order_by('pk')
+                       .values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            with transaction.atomic():
+                batch = Collection.objects.filter(pk__in=ids).order_by('pk')
+                before = list(batch.values_list(*COUNTERS))
+                refresh_collection_counts(batch)
+                repaired += len(set(before) - set(batch.values_list(*COUNTERS)))
+            checked += len(ids)
+            last_id = ids[-1]
+        self.stdout.write('checked %d collections, repaired %d' % (checked, repaired))
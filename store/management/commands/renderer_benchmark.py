@@ -0,0 +1,81 @@
+import statistics
+import time
+import tracemalloc
+from io import BytesIO
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from store.factories import seed_store
+from store.models import Product
+from store.renderers import ORJSONParser, ORJSONRenderer
+from store.rows import row_serializer
+from store.serializers import ProductSerializer
+
+
+def consume(chunks):
+    for _ in chunks:
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Compares JSONRenderer/JSONParser with the orjson ones on product list payloads, in a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10000,
+                            help='Products in the full list; pages are the first 10')
+        parser.add_argument('--repeat', type=int, default=7, help='Runs per case; the median is reported')
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            seed_store(products=options['products'], bids=0, comments=0, transfers=0)
+            rows = row_serializer(ProductSerializer)
+            products = rows.serialize(Product.objects.order_by('title').values(*rows.lookups))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        drf, fast = JSONRenderer(), ORJSONRenderer()
+        if drf.render(products) != fast.render(products):
+            raise CommandError('ORJSONRenderer output differs from JSONRenderer')
+        self.stdout.write('%-22s %10s %10s %10s %12s' % ('case', 'items', 'ms', 'MB/s', 'peak KiB'))
+        for name, payload in (('page', {'count': len(products), 'results': products[:10]}),
+                              ('list', products)):
+            size = len(drf.render(payload))
+            items = len(payload) if isinstance(payload, list) else len(payload['results'])
+            cases = [
+                ('render drf', lambda: drf.render(payload)),
+                ('render orjson', lambda: fast.render(payload)),
+                ('parse drf', lambda content=drf.render(payload): JSONParser().parse(BytesIO(content))),
+                ('parse orjson', lambda content=drf.render(payload): ORJSONParser().parse(BytesIO(content))),
+            ]
+            if isinstance(payload, list):
+                cases.insert(2, ('render orjson stream', lambda: consume(fast.stream(payload))))
+            for case, run in cases:
+                elapsed = self.measure(run, options['repeat'])
+                self.stdout.write('%-22s %10d %10.2f %10.1f %12.0f' % (
+                    '%s %s' % (name, case), items, elapsed * 1000, size / elapsed / 2 ** 20, self.peak(run) / 1024))
+
+    @staticmethod
+    def measure(run, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
+
+    @staticmethod
+    def peak(run):
+        """Most memory allocated at once while running, besides what was already there"""
+        tracemalloc.start()
+        try:
+            run()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
@@ -0,0 +1,75 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.renderers import JSONRenderer
+
+from store.factories import seed_store
+from store.models import Bid, Comment, Product, Transfer
+from store.rows import row_serializer
+from store.serializers import BidSerializer, CommentSerializer, ProductSerializer, TransferSerializer
+from store.views import CUSTOMER_FIELDS, SIMPLE_PRODUCT_FIELDS, related_fields, transfer_details
+
+
+def querysets():
+    """(name, serializer class, queryset) as the list endpoints fetch them"""
+    return [
+        ('products', ProductSerializer, Product.objects.select_related('collection', 'owner__user')),
+        ('bids', BidSerializer, Bid.objects.order_by('-placed_at').select_related('customer__user', 'product')
+            .only('price', 'description', 'placed_at', 'approved', 'customer', 'product',
+                  *related_fields('customer', CUSTOMER_FIELDS), *related_fields('product', SIMPLE_PRODUCT_FIELDS))),
+        ('comments', CommentSerializer, Comment.objects.order_by('-date').select_related('commentor__user', 'product')
+            .only('description', 'date', 'commentor', 'product',
+                  *related_fields('commentor', CUSTOMER_FIELDS), *related_fields('product', SIMPLE_PRODUCT_FIELDS))),
+        ('transfers', TransferSerializer, transfer_details(Transfer.objects.order_by('id'))),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Compares rows per second of the DRF serializers and store.rows on the list querysets, in a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='Rows serialized per run')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per serializer; the median is reported')
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            seed_store(products=rows, bids=rows, comments=rows, transfers=rows, customers=100)
+            self.stdout.write('%-10s %6s %14s %14s %14s %14s' % (
+                'queryset', 'rows', 'drf rows/s', 'values rows/s', 'drf +fetch', 'values +fetch'))
+            for name, serializer_class, queryset in querysets():
+                self.compare(name, serializer_class, queryset[:rows], repeat)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def compare(self, name, serializer_class, queryset, repeat):
+        rows = row_serializer(serializer_class)
+        drf = self.measure(lambda: list(queryset.all()), lambda page: serializer_class(page, many=True).data, repeat)
+        values = self.measure(lambda: list(queryset.values(*rows.lookups)), rows.serialize, repeat)
+        renderer = JSONRenderer()
+        if renderer.render(drf['data']) != renderer.render(values['data']):
+            raise CommandError('%s: store.rows output differs from %s' % (name, serializer_class.__name__))
+        count = len(values['data'])
+        self.stdout.write('%-10s %6d %14.0f %14.0f %14.0f %14.0f   x%.1f serializing, x%.1f with the fetch' % (
+            name, count, count / drf['serialize'], count / values['serialize'],
+            count / drf['total'], count / values['total'],
+            drf['serialize'] / values['serialize'], drf['total'] / values['total']))
+
+    @staticmethod
+    def measure(fetch, serialize, repeat):
+        serializing, totals = [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            page = fetch()
+            fetched = time.perf_counter()
+            data = serialize(page)
+            finished = time.perf_counter()
+            serializing.append(finished - fetched)
+            totals.append(finished - started)
+        return {'data': data, 'serialize': statistics.median(serializing), 'total': statistics.median(totals)}
@@ -0,0 +1,108 @@
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from rest_framework.exceptions import APIException
+
+from core.models import User
+from store.bidding import place_bid
+from store.factories import seed_store
+from store.management.commands.blockchain_loadtest import percentile
+from store.models import Bid, Product
+
+
+class Command(BaseCommand):
+    help = ('Runs concurrent bid inserts and catalog reads against a test SQLite database, '
+            "once with SQLite's defaults and once with settings.SQLITE_PRAGMAS")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=10, help='How long each run lasts')
+        parser.add_argument('--readers', type=int, default=8, help='Threads reading the catalog')
+        parser.add_argument('--writers', type=int, default=4, help='Threads placing bids')
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--customers', type=int, default=50)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The default database is not SQLite')
+        self.stdout.write('%-16s %10s %10s %10s %10s %12s %12s' % (
+            'pragmas', 'reads/s', 'bids/s', 'rejected', 'locked', 'read p99 ms', 'bid p99 ms'))
+        for name, pragmas in (('sqlite defaults', {}), ('SQLITE_PRAGMAS', settings.SQLITE_PRAGMAS)):
+            with override_settings(SQLITE_PRAGMAS=pragmas):
+                result = self.measure(options)
+            self.stdout.write('%-16s %10.0f %10.0f %10d %10d %12.1f %12.1f' % (
+                name, result['reads'] / options['seconds'], result['bids'] / options['seconds'],
+                result['rejected'], result['locked'],
+                percentile(result['read latencies'], 99) * 1000, percentile(result['bid latencies'], 99) * 1000))
+
+    def measure(self, options):
+        setup_test_environment(debug=False)
+        # a database of its own for each run: journal_mode=wal sticks to the file
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            seed_store(products=options['products'], customers=options['customers'],
+                       bids=options['products'], comments=0, transfers=0)
+            return self.run(options)
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def run(self, options):
+        product_ids = list(Product.objects.filter(visible=True).values_list('id', flat=True))
+        users = list(User.objects.select_related('customer'))
+        pages = max(1, len(product_ids) // 10)
+        # prices only go up, so most bids beat the one before them on their product
+        prices = itertools.count(10 ** 6, 10)
+        lock = threading.Lock()
+        counts = Counter()
+        latencies = {'read': [], 'bid': []}
+        deadline = time.perf_counter() + options['seconds']
+
+        def read(rng):
+            page = rng.randrange(pages)
+            list(Product.objects.select_related('collection', 'owner__user')
+                 .filter(visible=True).order_by('title')[page * 10:page * 10 + 10])
+            list(Bid.objects.filter(product_id=rng.choice(product_ids)).order_by('-price')[:20])
+            return 'reads'
+
+        def bid(rng):
+            try:
+                place_bid(rng.choice(product_ids), rng.choice(users), next(prices), 'benchmark')
+            except APIException:
+                # outbid by another thread in the meantime, or the bidder owns it
+                return 'rejected'
+            return 'bids'
+
+        def work(kind, action, seed):
+            rng = random.Random(seed)
+            try:
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        outcome = action(rng)
+                    except OperationalError:
+                        # 'database is locked' once the busy timeout runs out
+                        outcome = 'locked'
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        counts[outcome] += 1
+                        latencies[kind].append(elapsed)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=work, args=('read', read, i)) for i in range(options['readers'])]
+        threads += [threading.Thread(target=work, args=('bid', bid, -i - 1)) for i in range(options['writers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {'reads': counts['reads'], 'bids': counts['bids'], 'rejected': counts['rejected'],
+                'locked': counts['locked'], 'read latencies': latencies['read'],
+                'bid latencies': latencies['bid']}
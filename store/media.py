@@ -0,0 +1,155 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.views.decorators.http import require_safe
+
+from .storage import is_hashed
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=0, must-revalidate'
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+SHARD = re.compile(r'^[0-9a-f]{2}$')
+
+
+class FileRange:
+    """
+    Exposes `length` bytes of an open file from its current position. It keeps
+    fileno() so a WSGI server's file_wrapper can still sendfile() the range;
+    Content-Length tells the server where to stop.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """Returns (start, end) of a single byte range, None to send the whole file, or False if unsatisfiable"""
+    match = BYTE_RANGE.match(header.strip())
+    if match is None:
+        # several ranges or another unit, answering with the whole file is allowed
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def is_published(path):
+    """
+    Whether `path` may be served: nothing hidden, so in particular no upload
+    still in ContentAddressedStorage's incoming directory, and only finished
+    content addressed names inside its shard directories.
+    """
+    parts = path.split('/')
+    if any(part.startswith('.') for part in parts):
+        return False
+    return len(parts) < 2 or SHARD.match(parts[-2]) is None or is_hashed(path)
+
+
+def get_etag(name, stat):
+    if is_hashed(name):
+        return quote_etag(os.path.splitext(os.path.basename(name))[0])
+    return quote_etag('%x-%x' % (int(stat.st_mtime), stat.st_size))
+
+
+def not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag in parse_etags(if_none_match)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+@require_safe
+def serve(request, path):
+    """
+    Serves a file from MEDIA_ROOT. Content addressed files are cached by
+    clients for good. Single byte ranges are answered with 206, and the file
+    itself is handed to the server so it can send it without copying through
+    Python. With MEDIA_ACCEL_REDIRECT set, nginx sends it instead.
+    """
+    if not is_published(path):
+        raise Http404
+    try:
+        full_path = safe_join(default_storage.location, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    etag = get_etag(path, stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': IMMUTABLE if is_hashed(path) else REVALIDATE,
+        'Accept-Ranges': 'bytes',
+    }
+    if not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    accel = getattr(settings, 'MEDIA_ACCEL_REDIRECT', None)
+    if accel:
+        # nginx handles ranges and sendfile for internal locations itself
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = accel.rstrip('/') + '/' + path
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if 'HTTP_RANGE' in request.META and (if_range is None or if_range.strip() == etag):
+        byte_range = parse_range(request.META['HTTP_RANGE'], stat.st_size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % stat.st_size
+        return response
+
+    file = open(full_path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        file.seek(start)
+        response = FileResponse(FileRange(file, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+        response['Content-Length'] = end - start + 1
+    for header, value in headers.items():
+        response[header] = value
+    return response
@@ -0,0 +1,186 @@
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_safe
+from rest_framework.exceptions import APIException
+
+from .authentication import CachedJWTAuthentication
+
+# In-process request metrics. ProfilingMiddleware opens a RequestProfile per
+# request; the database, serializers, permission checks, renderer and
+# blockchain client add the time they take to it through timed(), the
+# serializers and views through the mixins below. At the end of the
+# request the totals go into histograms per view, served by `metrics` in
+# the Prometheus text format.
+
+PHASES = ('db', 'serialize', 'permissions', 'node')
+MS_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+current = ContextVar('request_profile', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one count per bucket plus the overflow (+Inf) bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class Registry:
+    """Histograms by metric name and labels, created on first use"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name, buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def observe(self, name, buckets, value, **labels):
+        self.histogram(name, buckets, **labels).observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        """The histograms in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        seen = set()
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            counts, total = histogram.snapshot()
+            label_text = ','.join('%s="%s"' % (key, escape(value)) for key, value in labels)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket{%s%sle="%s"} %d' % (
+                    name, label_text, ',' if label_text else '', bound, cumulative))
+            lines.append('%s_sum{%s} %s' % (name, label_text, round(total, 3)))
+            lines.append('%s_count{%s} %d' % (name, label_text, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+class RequestProfile:
+    def __init__(self):
+        self.durations = dict.fromkeys(PHASES, 0.0)
+        self.depth = dict.fromkeys(PHASES, 0)
+        self.queries = 0
+
+    def execute(self, execute, sql, params, many, context):
+        """connection.execute_wrapper hook counting and timing every query"""
+        self.queries += 1
+        with timed('db'):
+            return execute(sql, params, many, context)
+
+
+@contextmanager
+def timed(phase):
+    """Adds the time spent in the block to the current request's `phase`, once however deeply nested"""
+    profile = current.get()
+    if profile is None or profile.depth[phase]:
+        yield
+        return
+    profile.depth[phase] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.durations[phase] += time.perf_counter() - started
+        profile.depth[phase] -= 1
+
+
+class TimedViewMixin:
+    """Adds a view's permission checks to the request's permissions time"""
+
+    def check_permissions(self, request):
+        with timed('permissions'):
+            super().check_permissions(request)
+
+    def check_object_permissions(self, request, obj):
+        with timed('permissions'):
+            super().check_object_permissions(request, obj)
+
+
+class TimedSerializerMixin:
+    """
+    Adds a serializer's output to the request's serialize time. Nested and
+    listed serializers count once, as part of the outermost one.
+    """
+
+    def to_representation(self, instance):
+        with timed('serialize'):
+            return super().to_representation(instance)
+
+
+def is_internal(request):
+    """
+    Metrics, profiles and Server-Timing are for staff, signed in or sending
+    their JWT, and for scrapers sending settings.METRICS_TOKEN in an
+    X-Metrics-Token header. Needs AuthenticationMiddleware to have run.
+    """
+    internal = getattr(request, '_metrics_internal', None)
+    if internal is None:
+        internal = request._metrics_internal = has_metrics_token(request) or is_staff(request)
+    return internal
+
+
+def has_metrics_token(request):
+    expected = getattr(settings, 'METRICS_TOKEN', None)
+    sent = request.META.get('HTTP_X_METRICS_TOKEN')
+    return bool(expected and sent) and hmac.compare_digest(expected.encode(), sent.encode())
+
+
+def is_staff(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.is_staff
+    # API clients authenticate with a JWT, which only DRF's views look at
+    try:
+        authenticated = CachedJWTAuthentication().authenticate(request)
+    except APIException:
+        return False
+    return authenticated is not None and authenticated[0].is_staff
+
+
+@require_safe
+def metrics(request):
+    if not is_internal(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
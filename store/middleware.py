@@ -0,0 +1,140 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+from contextlib import ExitStack
+from hashlib import sha256
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.http import HttpResponse
+from rest_framework.permissions import SAFE_METHODS
+
+from . import metrics
+from .routers import REPLICA, reads_from_replica
+
+
+class ProfilingMiddleware:
+    """
+    Records every request in the metrics registry: total time and the time
+    spent in the database, serializers, permission checks and calls to the
+    blockchain node, the number of queries and the response size, labelled
+    by view and method. The phases overlap, a query made by a permission
+    check counts in both. Internal callers (see metrics.is_internal) get the
+    same numbers back in a Server-Timing header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = metrics.RequestProfile()
+        token = metrics.current.set(profile)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile.execute))
+                started = time.perf_counter()
+                response = self.get_response(request)
+                elapsed = time.perf_counter() - started
+        finally:
+            metrics.current.reset(token)
+        self.record(request, response, profile, elapsed)
+        # the middleware below has authenticated the request by now
+        if metrics.is_internal(request):
+            response['Server-Timing'] = ', '.join(
+                ['%s;dur=%.2f' % (phase, duration * 1000) for phase, duration in profile.durations.items()] +
+                ['total;dur=%.2f' % (elapsed * 1000)])
+        return response
+
+    def record(self, request, response, profile, elapsed):
+        match = request.resolver_match
+        labels = {'view': match.view_name if match else 'unmatched', 'method': request.method}
+        registry = metrics.registry
+        registry.observe('store_request_ms', metrics.MS_BUCKETS, elapsed * 1000, **labels)
+        for phase, duration in profile.durations.items():
+            registry.observe('store_%s_ms' % phase, metrics.MS_BUCKETS, duration * 1000, **labels)
+        registry.observe('store_queries', metrics.QUERY_BUCKETS, profile.queries, **labels)
+        if not response.streaming:
+            registry.observe('store_response_bytes', metrics.BYTE_BUCKETS, len(response.content), **labels)
+
+
+class OnDemandProfilingMiddleware:
+    """
+    Internal callers (see metrics.is_internal) may send `X-Profile: 1` to
+    run the request under cProfile and get the statistics back instead of
+    the response. With PROFILING_DIR set they are also saved there for
+    snakeviz and the like. Goes after AuthenticationMiddleware, which
+    is_internal relies on.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.META.get('HTTP_X_PROFILE') and metrics.is_internal(request):
+            return self.profiled(request)
+        return self.get_response(request)
+
+    def profiled(self, request):
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+        directory = getattr(settings, 'PROFILING_DIR', None)
+        if directory:
+            profiler.dump_stats(os.path.join(directory, '%s.prof' % uuid4().hex))
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(60)
+        profiled = HttpResponse(output.getvalue(), content_type='text/plain; charset=utf-8')
+        profiled['X-Profiled-Status'] = response.status_code
+        return profiled
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets ReplicaRouter send the catalog reads of GET, HEAD and OPTIONS
+    requests to the replica. A client that has just written reads from the
+    primary for REPLICA_STICKY_SECONDS afterwards, so that replication lag
+    does not hide its own writes from it. Clients are recognised by their
+    Authorization header, pinned in REPLICA_PIN_CACHE, or failing that by a
+    cookie.
+    """
+    cookie_name = 'primary_pin'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+        self.cache = caches[getattr(settings, 'REPLICA_PIN_CACHE', 'default')]
+
+    def __call__(self, request):
+        if REPLICA not in connections.databases:
+            return self.get_response(request)
+        safe = request.method in SAFE_METHODS
+        token = reads_from_replica.set(safe and not self.pinned(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            reads_from_replica.reset(token)
+        if not safe and response.status_code < 400:
+            self.pin(request, response)
+        return response
+
+    def pin_key(self, request):
+        authorization = request.META.get('HTTP_AUTHORIZATION')
+        if not authorization:
+            return None
+        return 'primary-pin:' + sha256(authorization.encode()).hexdigest()
+
+    def pinned(self, request):
+        if self.cookie_name in request.COOKIES:
+            return True
+        key = self.pin_key(request)
+        return key is not None and self.cache.get(key) is not None
+
+    def pin(self, request, response):
+        key = self.pin_key(request)
+        if key is not None:
+            self.cache.set(key, 1, self.seconds)
+        response.set_cookie(self.cookie_name, '1', max_age=self.seconds, httponly=True, samesite='Lax')
@@ -0,0 +1,61 @@
+# Generated by Django 3.2.8 on 2026-10-18 01:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+from collections import Counter
+
+# store.search as of this migration, frozen here so that later changes to
+# the tokenizer or weights do not change what this migration writes
+TOKEN_RE = re.compile(r'\w+')
+MAX_TERM_LENGTH = 64
+TITLE_WEIGHT = 3
+
+
+def tokenize(text):
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall((text or '').lower())]
+
+
+def term_weights(title, description):
+    weights = Counter()
+    for token in tokenize(title):
+        weights[token] += TITLE_WEIGHT
+    weights.update(tokenize(description))
+    return weights
+
+
+def index_existing_products(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    ProductSearchTerm = apps.get_model('store', 'ProductSearchTerm')
+    batch = []
+    for product in Product.objects.only('title', 'description').iterator():
+        batch.extend(ProductSearchTerm(term=term, product_id=product.id, weight=weight)
+                     for term, weight in term_weights(product.title, product.description).items())
+        if len(batch) >= 1000:
+            ProductSearchTerm.objects.bulk_create(batch)
+            batch = []
+    ProductSearchTerm.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_product_product_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.PositiveIntegerField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='store.product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productsearchterm',
+            constraint=models.UniqueConstraint(fields=('term', 'product'), name='unique_search_term_per_product'),
+        ),
+        migrations.RunPython(index_existing_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.8 on 2026-10-18 01:41
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def compute_aggregates(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    Bid = apps.get_model('store', 'Bid')
+    Comment = apps.get_model('store', 'Comment')
+    bids = Bid.objects.filter(product_id=OuterRef('pk')).values('product_id')
+    comments = Comment.objects.filter(product_id=OuterRef('pk')).values('product_id')
+    Product.objects.update(
+        highest_bid=Subquery(bids.annotate(highest=Max('price')).values('highest')),
+        bid_count=Coalesce(Subquery(bids.annotate(count=Count('id')).values('count')), 0),
+        comment_count=Coalesce(Subquery(comments.annotate(count=Count('id')).values('count')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='bid_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='highest_bid',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.RunPython(compute_aggregates, migrations.RunPython.noop),
+    ]
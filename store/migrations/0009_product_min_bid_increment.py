@@ -0,0 +1,20 @@
+# Generated by Django 3.2.8 on 2026-10-18 02:02
+
+from decimal import Decimal
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_product_photo_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='min_bid_increment',
+            field=models.DecimalField(decimal_places=2, default=Decimal('1.00'), max_digits=10, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.8 on 2026-10-18 02:48
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_products(apps, schema_editor):
+    Collection = apps.get_model('store', 'Collection')
+    Product = apps.get_model('store', 'Product')
+    products = Product.objects.filter(collection_id=OuterRef('pk')).order_by().values('collection_id')
+    Collection.objects.update(
+        product_count=Coalesce(Subquery(products.annotate(count=Count('id')).values('count')), 0),
+        visible_product_count=Coalesce(Subquery(
+            products.filter(visible=True).annotate(count=Count('id')).values('count')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_job_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='visible_product_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
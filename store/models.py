@@ -1,3 +1,4 @@
+from decimal import Decimal
 from statistics import mode
 from django.db import models
 from django.core.validators import MaxLengthValidator, MinValueValidator
@@ -12,6 +13,9 @@ from playground.settings import MEDIA_ROOT
 # Create your models here.
 class Collection(models.Model):
     title = models.CharField(max_length=255)
+    # kept up to date by store.aggregates, never written by clients
+    product_count = models.PositiveIntegerField(default=0)
+    visible_product_count = models.PositiveIntegerField(default=0)
 
     def __str__(self) -> str:
         return self.title
@@ -42,13 +46,29 @@ class Product(models.Model):
     owner = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='products')
     visible = models.BooleanField(default=True)
     photo = models.ImageField(upload_to='products', default=None)
+    # resized copies of photo by variant name, written by store.images
+    photo_variants = models.JSONField(default=dict, blank=True)
     product_hash = models.CharField(max_length=64, unique=True)
+    # a new bid must beat highest_bid by at least this much
+    min_bid_increment = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('1.00'),
+                                            validators=[MinValueValidator(0)])
+    # kept up to date by store.aggregates, never written by clients
+    highest_bid = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    bid_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
 
     def __str__(self) -> str:
         return self.title
 
     class Meta:
         ordering = ['title']
+        indexes = [
+            # catalog pages: ?collection_id= lists only visible products, by title
+            models.Index(fields=['collection', 'title'], condition=models.Q(visible=True),
+                         name='product_visible_collection_idx'),
+            # unfiltered listing and keyset pages ordered by (title, id)
+            models.Index(fields=['title', 'id'], name='product_title_idx'),
+        ]
 
 
 class Comment(models.Model):
@@ -60,6 +80,11 @@ class Comment(models.Model):
     def __str__(self) -> str:
         return self.description
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', '-date', '-id'], name='comment_product_date_idx'),
+        ]
+
 # Later ==========================
 class Bid(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
@@ -71,10 +96,46 @@ class Bid(models.Model):
     placed_at = models.DateTimeField(auto_now_add=True)
     approved = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', '-placed_at', '-id'], name='bid_product_placed_at_idx'),
+        ]
+
 # Once a bid is approved, delete all other bids of that product
 
 class Transfer(models.Model):
     completed = models.BooleanField(default=False)
     buyer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='incoming_transfers')
     seller = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='outgoing_transfers')
-    product = models.OneToOneField(Product, on_delete=models.PROTECT, related_name='transfer')
\ No newline at end of file
+    product = models.OneToOneField(Product, on_delete=models.PROTECT, related_name='transfer')
+
+class ProductSearchTerm(models.Model):
+    """Inverted index over product titles and descriptions, kept by store.search"""
+    term = models.CharField(max_length=64)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='search_terms')
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['term', 'product'], name='unique_search_term_per_product'),
+        ]
+
+
+class JobCheckpoint(models.Model):
+    """
+    Progress of a resumable background job such as store.reconcile, saved
+    after every batch. The lease keeps a second runner from working the same
+    job while the first is alive.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    # last row handled in the current pass, the next batch starts after it
+    position = models.PositiveBigIntegerField(default=0)
+    stats = models.JSONField(default=dict, blank=True)
+    pass_started_at = models.DateTimeField(null=True, blank=True)
+    last_pass_finished_at = models.DateTimeField(null=True, blank=True)
+    lease_owner = models.CharField(max_length=64, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.name
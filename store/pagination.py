@@ -1,4 +1,159 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import reduce
+from operator import or_
+from types import SimpleNamespace
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
 
 class DefaultPagination(PageNumberPagination):
-    page_size = 10
\ No newline at end of file
+    page_size = 10
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pages through a queryset by the values of the last row seen instead of an
+    offset, so every page costs the same however deep it is. The ordering
+    must end in a unique column. Cursors are opaque base64 strings.
+    """
+    page_size = 10
+    cursor_query_param = 'cursor'
+    ordering = ('-id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.fields = [queryset.model._meta.get_field(name.lstrip('-')) for name in self.ordering]
+        position, reverse = self.decode_cursor(request)
+
+        ordering = [self.flip(name) for name in self.ordering] if reverse else list(self.ordering)
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(position, ordering))
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        self.rows = rows
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if not self.has_next or not self.rows:
+            return None
+        return self.encode_cursor(self.rows[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.rows:
+            # an empty cursor is the first page; dropping the parameter
+            # would switch SelectablePagination to page numbers
+            return replace_query_param(self.base_url, self.cursor_query_param, '')
+        return self.encode_cursor(self.rows[0], reverse=True)
+
+    @staticmethod
+    def flip(name):
+        return name[1:] if name.startswith('-') else '-' + name
+
+    def after(self, position, ordering):
+        """Rows strictly past `position` in `ordering`: (a, b) > (x, y) spelled out for any direction"""
+        clauses = []
+        for i, name in enumerate(ordering):
+            column = name.lstrip('-')
+            lookup = '__lt' if name.startswith('-') else '__gt'
+            equal = {field.name: value for field, value in zip(self.fields[:i], position[:i])}
+            clauses.append(Q(**equal, **{column + lookup: position[i]}))
+        # the redundant bound on the leading column lets the index seek to the cursor
+        first = ordering[0]
+        bound = '__lte' if first.startswith('-') else '__gte'
+        return Q(**{first.lstrip('-') + bound: position[0]}) & reduce(or_, clauses)
+
+    def encode_cursor(self, row, reverse):
+        if isinstance(row, dict):
+            # a values() row from store.rows, keyed by field name
+            row = SimpleNamespace(**{field.attname: row[field.name] for field in self.fields})
+        values = [field.value_to_string(row) for field in self.fields]
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   self.encode_position(values, reverse))
+
+    @staticmethod
+    def encode_position(values, reverse=False):
+        return urlsafe_b64encode(json.dumps({'p': values, 'r': reverse}).encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode()))
+            position = [field.to_python(value) for field, value in zip(self.fields, cursor['p'])]
+            if len(position) != len(self.fields):
+                raise ValueError
+            return position, bool(cursor['r'])
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+
+class SelectablePagination(BasePagination):
+    """
+    Keyset pagination for requests that ask for it with ?cursor= (an empty
+    value starts at the first page), `fallback_class` for everybody else.
+    A fallback of None leaves those responses unpaginated.
+    """
+    keyset_class = KeysetPagination
+    fallback_class = DefaultPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.keyset_class.cursor_query_param in request.query_params:
+            self.paginator = self.keyset_class()
+        elif self.fallback_class is not None:
+            self.paginator = self.fallback_class()
+        else:
+            return None
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+
+class ProductKeysetPagination(KeysetPagination):
+    ordering = ('title', 'id')
+
+
+class BidKeysetPagination(KeysetPagination):
+    ordering = ('-placed_at', '-id')
+
+
+class CommentKeysetPagination(KeysetPagination):
+    ordering = ('-date', '-id')
+
+
+class ProductPagination(SelectablePagination):
+    keyset_class = ProductKeysetPagination
+
+
+class BidPagination(SelectablePagination):
+    keyset_class = BidKeysetPagination
+    fallback_class = None
+
+
+class CommentPagination(SelectablePagination):
+    keyset_class = CommentKeysetPagination
+    fallback_class = None
@@ -51,18 +51,6 @@ class IsItemOwner(permissions.BasePermission):
         return request.user and bid.product.owner.user == request.user
 
 
-class NotIsItemOwner(permissions.BasePermission):
-    def has_permission(self, request, view):
-        if request.method in permissions.SAFE_METHODS:
-            return True
-        pk = view.kwargs['product_pk']
-        product = Product.objects.get(pk=pk)
-        return bool(product.visible and request.user and request.user.is_authenticated and product.owner.user != request.user)
-
-    def has_object_permission(self, request, view, bid):
-        return bid.product.visible and request.user and bid.product.owner.user != request.user
-
-
 class IsBuyer(permissions.BasePermission):
     # def has_permission(self, request, view):
     #     if request.method in permissions.SAFE_METHODS:
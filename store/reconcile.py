@@ -0,0 +1,114 @@
+import logging
+from datetime import timedelta
+from uuid import uuid4
+
+from django.db import DatabaseError, IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+
+from .blockchain import BlockchainError
+from .models import JobCheckpoint, Transfer
+from .transfers import complete_transfer
+
+logger = logging.getLogger(__name__)
+
+JOB = 'reconcile-transfers'
+
+
+class TransferReconciler:
+    """
+    Completes open transfers whose product the node already shows under the
+    buyer, as if the buyer had confirmed them with PUT /store/transfers/<id>/.
+
+    A pass walks the open transfers in id order, `batch_size` at a time, and
+    asks the node for the owners of a batch at most `workers` at a time.
+    Progress is checkpointed in a JobCheckpoint row after every batch, so an
+    interrupted pass resumes where it stopped. The row is leased, so runners
+    in other processes leave the job alone while this one holds it.
+    """
+
+    def __init__(self, client, batch_size=100, workers=None, lease=timedelta(minutes=5), name=JOB):
+        self.client = client
+        self.batch_size = batch_size
+        self.workers = workers
+        self.lease = lease
+        self.name = name
+        self.token = uuid4().hex
+
+    def acquire(self):
+        try:
+            JobCheckpoint.objects.get_or_create(name=self.name)
+        except IntegrityError:
+            # another runner created it first
+            pass
+        now = timezone.now()
+        return bool(JobCheckpoint.objects
+                    .filter(Q(lease_owner='') | Q(lease_owner=self.token) | Q(lease_expires_at__lt=now),
+                            name=self.name)
+                    .update(lease_owner=self.token, lease_expires_at=now + self.lease))
+
+    def release(self):
+        JobCheckpoint.objects.filter(name=self.name, lease_owner=self.token) \
+            .update(lease_owner='', lease_expires_at=None)
+
+    def save(self, **fields):
+        """Writes progress and renews the lease; False if the lease was lost"""
+        return bool(JobCheckpoint.objects.filter(name=self.name, lease_owner=self.token)
+                    .update(lease_expires_at=timezone.now() + self.lease, updated_at=timezone.now(), **fields))
+
+    def run_pass(self):
+        """
+        Works through the open transfers from the checkpoint on. Returns the
+        pass's counts, or None if another runner holds the job.
+        """
+        if not self.acquire():
+            return None
+        try:
+            checkpoint = JobCheckpoint.objects.get(name=self.name)
+            position, stats = checkpoint.position, checkpoint.stats
+            if not position:
+                stats = {'checked': 0, 'completed': 0, 'pending': 0, 'failed': 0}
+                self.save(stats=stats, pass_started_at=timezone.now())
+            while True:
+                transfers = list(Transfer.objects.filter(pk__gt=position).order_by('pk')
+                                 .select_related('product', 'buyer__user')
+                                 .only('product', 'buyer', 'product__product_hash',
+                                       'buyer__user', 'buyer__user__public_key_hash')[:self.batch_size])
+                if not transfers:
+                    self.save(position=0, stats=stats, last_pass_finished_at=timezone.now())
+                    return stats
+                counts = self.reconcile_batch(transfers)
+                if counts['failed'] == len(transfers):
+                    # the node is unreachable, keep the position and try again next run
+                    self.save(stats=stats)
+                    return stats
+                for key, count in counts.items():
+                    stats[key] += count
+                position = transfers[-1].pk
+                if not self.save(position=position, stats=stats):
+                    logger.warning('Lost the %s lease after transfer %s', self.name, position)
+                    return stats
+        finally:
+            self.release()
+
+    def reconcile_batch(self, transfers):
+        # cached owners may predate the transfer on chain, always ask the node
+        owners = self.client.item_owners([transfer.product.product_hash for transfer in transfers],
+                                         workers=self.workers, refresh=True)
+        counts = {'checked': len(transfers), 'completed': 0, 'pending': 0, 'failed': 0}
+        for transfer in transfers:
+            owner = owners[transfer.product.product_hash]
+            if isinstance(owner, BlockchainError):
+                counts['failed'] += 1
+            elif owner is None or owner != transfer.buyer.user.public_key_hash:
+                counts['pending'] += 1
+            else:
+                try:
+                    # False when the buyer confirmed it meanwhile
+                    completed = complete_transfer(transfer, self.client)
+                except DatabaseError:
+                    logger.exception('Could not complete transfer %s', transfer.pk)
+                    counts['failed'] += 1
+                else:
+                    counts['completed'] += completed
+        return counts
@@ -0,0 +1,89 @@
+import codecs
+from decimal import Decimal
+
+import orjson
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import metrics
+
+# JSON through orjson. It encodes str, numbers, dicts, lists, datetimes and
+# UUIDs itself; whatever else DRF's encoder knows (Decimal as a number,
+# lazy strings, timedeltas, querysets) goes through its default().
+
+LINE_SEPARATORS = (b'\xe2\x80\xa8', b'\xe2\x80\xa9')
+encoder_default = JSONEncoder().default
+
+
+def default(obj):
+    # prices are most of what orjson hands back, check for them first
+    if type(obj) is Decimal:
+        return float(obj)
+    return encoder_default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    Renders the same JSON as JSONRenderer, several times faster. Indented
+    output is always indented by two spaces. Lists of at least
+    `stream_threshold` items can be streamed `chunk_size` items at a time,
+    see list_response.
+    """
+    options = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+    stream_threshold = 1000
+    chunk_size = 500
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        options = self.options
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            options |= orjson.OPT_INDENT_2
+        with metrics.timed('serialize'):
+            content = orjson.dumps(data, default=default, option=options)
+        # like JSONRenderer, keep the output a strict subset of javascript
+        if LINE_SEPARATORS[0] in content or LINE_SEPARATORS[1] in content:
+            content = content.replace(LINE_SEPARATORS[0], b'\\u2028').replace(LINE_SEPARATORS[1], b'\\u2029')
+        return content
+
+    def stream(self, items, accepted_media_type=None, renderer_context=None):
+        """Renders the list `items` in chunks; only one chunk is encoded at a time"""
+        yield b'['
+        for start in range(0, len(items), self.chunk_size):
+            chunk = self.render(items[start:start + self.chunk_size], accepted_media_type, renderer_context)
+            # each chunk renders as a list of its own, drop its brackets
+            yield (b',' if start else b'') + chunk[1:-1]
+        yield b']'
+
+
+def list_response(request, items):
+    """
+    A response for the list `items`: streamed when it is long and rendered
+    by ORJSONRenderer, a plain Response otherwise.
+    """
+    renderer = getattr(request, 'accepted_renderer', None)
+    if not isinstance(renderer, ORJSONRenderer) or len(items) < renderer.stream_threshold:
+        return Response(items)
+    return StreamingHttpResponse(renderer.stream(items, request.accepted_media_type),
+                                 content_type=renderer.media_type)
+
+
+class ORJSONParser(JSONParser):
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        content = stream.read()
+        try:
+            # orjson reads UTF-8 bytes, anything else is decoded first
+            if codecs.lookup(encoding).name != 'utf-8':
+                content = content.decode(encoding)
+            return orjson.loads(content)
+        except (ValueError, LookupError) as exc:
+            raise ParseError('JSON parse error - %s' % exc)
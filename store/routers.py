@@ -0,0 +1,36 @@
+from contextvars import ContextVar
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Catalog reads of read-only requests go to a replica, everything else to the
+# primary. ReplicaRoutingMiddleware decides per request whether its reads
+# may use the replica; outside requests (commands, background workers) they
+# never do.
+
+REPLICA = 'replica'
+# what anonymous visitors browse; users, customers, bids and transfers
+# decide who may do what and are always read fresh
+CATALOG_MODELS = {'store.collection', 'store.product', 'store.productsearchterm', 'store.comment'}
+
+reads_from_replica = ContextVar('reads_from_replica', default=False)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not reads_from_replica.get() or model._meta.label_lower not in CATALOG_MODELS:
+            return DEFAULT_DB_ALIAS
+        # a transaction on the primary reads what it is about to write
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the same rows whichever database they were read from
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica follows the primary's schema through replication
+        return db != REPLICA
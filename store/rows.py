@@ -0,0 +1,139 @@
+from functools import lru_cache
+from operator import itemgetter
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import serializers
+
+from . import metrics
+from .models import Product
+from .renderers import list_response
+from .serializers import CustomerSerializer, ProductSerializer, SimpleProductSerializer
+
+# A read-only path for list endpoints: rows come from values() and go into
+# response dicts through a plan compiled once per serializer class, instead
+# of through model instances and DRF's per-field machinery. The output is
+# the same as the serializer's, field for field.
+
+
+def photo_url(name):
+    # imported products have no photo until one is uploaded
+    return photo_storage().url(name) if name else None
+
+
+def photo_variant_urls(variants):
+    storage = photo_storage()
+    return {variant: storage.url(name) for variant, name in variants.items()}
+
+
+def photo_storage():
+    return Product._meta.get_field('photo').storage
+
+
+# What each SerializerMethodField reads, as (lookup, conversion); a None
+# conversion copies the value as it is
+METHOD_FIELDS = {
+    (CustomerSerializer, 'firstname'): ('user__first_name', None),
+    (CustomerSerializer, 'lastname'): ('user__last_name', None),
+    (CustomerSerializer, 'wallet_address'): ('user__wallet_address', None),
+    (CustomerSerializer, 'public_key'): ('user__public_key', None),
+    (CustomerSerializer, 'verified'): ('user__verified', None),
+    (ProductSerializer, 'image'): ('photo', photo_url),
+    (ProductSerializer, 'image_variants'): ('photo_variants', photo_variant_urls),
+    (SimpleProductSerializer, 'image'): ('photo', photo_url),
+    (SimpleProductSerializer, 'image_variants'): ('photo_variants', photo_variant_urls),
+}
+
+# fields whose representation of a database value is the value itself
+VERBATIM_FIELDS = (serializers.CharField, serializers.IntegerField, serializers.BooleanField,
+                   serializers.ReadOnlyField)
+
+
+def converted(lookup, convert):
+    def get(row):
+        value = row[lookup]
+        # as Serializer.to_representation, None is never passed to a field
+        return None if value is None else convert(value)
+    return get
+
+
+def nested(lookup, plan):
+    def get(row):
+        return None if row[lookup] is None else {key: value(row) for key, value in plan}
+    return get
+
+
+class RowSerializer:
+    """
+    Serializes values() rows as `serializer_class` serializes instances.
+    `lookups` are the values() arguments the rows must be fetched with.
+    Nested serializers follow their foreign key, method fields must be
+    described in METHOD_FIELDS.
+    """
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self.lookups = []
+        self.plan = self.compile(serializer_class(), '')
+
+    def compile(self, serializer, prefix):
+        plan = []
+        for key, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                try:
+                    source, convert = METHOD_FIELDS[type(serializer), key]
+                except KeyError:
+                    raise ImproperlyConfigured('%s.%s has no row source in store.rows.METHOD_FIELDS' % (
+                        type(serializer).__name__, key))
+                lookup = self.lookup(prefix + source)
+                plan.append((key, itemgetter(lookup) if convert is None else converted(lookup, convert)))
+                continue
+            if field.source == '*' or isinstance(field, (serializers.ListSerializer, serializers.ManyRelatedField)):
+                raise ImproperlyConfigured('%s.%s cannot be read from a values() row' % (
+                    type(serializer).__name__, key))
+            lookup = self.lookup(prefix + field.source.replace('.', '__'))
+            if isinstance(field, serializers.BaseSerializer):
+                # the foreign key itself tells a missing row from a present one
+                plan.append((key, nested(lookup, self.compile(field, lookup + '__'))))
+            elif isinstance(field, serializers.PrimaryKeyRelatedField) and field.pk_field is None:
+                plan.append((key, itemgetter(lookup)))
+            elif isinstance(field, VERBATIM_FIELDS):
+                plan.append((key, itemgetter(lookup)))
+            else:
+                plan.append((key, converted(lookup, field.to_representation)))
+        return plan
+
+    def lookup(self, lookup):
+        if lookup not in self.lookups:
+            self.lookups.append(lookup)
+        return lookup
+
+    def serialize(self, rows):
+        plan = self.plan
+        return [{key: value(row) for key, value in plan} for row in rows]
+
+
+@lru_cache(maxsize=None)
+def row_serializer(serializer_class):
+    return RowSerializer(serializer_class)
+
+
+class RowListMixin:
+    """
+    Lists a viewset's queryset through RowSerializer. The queryset's filters
+    and ordering apply as they are; its select_related() and only() are
+    replaced by the values() the serializer needs. Long unpaginated lists
+    are streamed.
+    """
+
+    def list(self, request, *args, **kwargs):
+        serializer = row_serializer(self.get_serializer_class())
+        queryset = self.filter_queryset(self.get_queryset()).values(*serializer.lookups)
+        page = self.paginate_queryset(queryset)
+        rows = list(queryset) if page is None else page
+        with metrics.timed('serialize'):
+            data = serializer.serialize(rows)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return list_response(request, data)
@@ -0,0 +1,89 @@
+import re
+from collections import Counter
+from functools import reduce
+from operator import or_
+
+from django.db.models import Case, IntegerField, Max, OuterRef, Q, Subquery, Sum, When
+
+from .models import ProductSearchTerm
+
+TOKEN_RE = re.compile(r'\w+')
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+TITLE_WEIGHT = 3
+# sorts after every string that starts with the prefix it is appended to
+PREFIX_END = chr(0x10FFFF)
+
+
+def tokenize(text):
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall((text or '').lower())]
+
+
+def term_weights(title, description):
+    weights = Counter()
+    for token in tokenize(title):
+        weights[token] += TITLE_WEIGHT
+    weights.update(tokenize(description))
+    return weights
+
+
+def index_terms(product):
+    return [ProductSearchTerm(term=term, product_id=product.id, weight=weight)
+            for term, weight in term_weights(product.title, product.description).items()]
+
+
+def index_product(product):
+    ProductSearchTerm.objects.filter(product_id=product.id).delete()
+    ProductSearchTerm.objects.bulk_create(index_terms(product))
+
+
+def index_products(queryset, batch_size=1000):
+    """Rebuilds the index entries of every product in `queryset`."""
+    batch = []
+    for product in queryset.only('title', 'description').order_by('id').iterator(chunk_size=batch_size):
+        batch.append(product)
+        if len(batch) >= batch_size:
+            reindex_batch(batch)
+            batch = []
+    if batch:
+        reindex_batch(batch)
+
+
+def reindex_batch(products):
+    ProductSearchTerm.objects.filter(product_id__in=[product.id for product in products]).delete()
+    ProductSearchTerm.objects.bulk_create(
+        [term for product in products for term in index_terms(product)], batch_size=1000)
+
+
+def prefix_match(token):
+    # a range rather than LIKE 'token%' so the lookup stays on the term index
+    return Q(term__gte=token, term__lt=token + PREFIX_END)
+
+
+def search_products(queryset, query):
+    """
+    Narrows `queryset` to products matching every word of `query`, each word
+    also matching as a prefix, ordered by relevance. Title matches outrank
+    description matches.
+    """
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not tokens:
+        return queryset
+    matches = [prefix_match(token) for token in tokens]
+    hits = ProductSearchTerm.objects \
+        .filter(reduce(or_, matches)) \
+        .values('product_id') \
+        .annotate(**{
+            'matched_%d' % i: Max(Case(When(match, then=1), default=0, output_field=IntegerField()))
+            for i, match in enumerate(matches)
+        }) \
+        .filter(**{'matched_%d' % i: 1 for i in range(len(matches))})
+    rank = ProductSearchTerm.objects \
+        .filter(reduce(or_, matches), product_id=OuterRef('pk')) \
+        .values('product_id') \
+        .annotate(rank=Sum('weight')) \
+        .values('rank')
+    return queryset \
+        .filter(pk__in=hits.values('product_id')) \
+        .annotate(search_rank=Subquery(rank)) \
+        .order_by('-search_rank', 'title', 'id')
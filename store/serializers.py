@@ -8,11 +8,13 @@ from django.db import transaction
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 
+from .bidding import place_bid
+from .metrics import TimedSerializerMixin
 from .models import Bid, Collection, Customer, Product, Comment, Transfer
 from .signals import order_created
 
 
-class CustomerSerializer(serializers.ModelSerializer):
+class CustomerSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     firstname = serializers.SerializerMethodField('get_firstname')
     lastname = serializers.SerializerMethodField('get_lastname')
     wallet_address = serializers.SerializerMethodField('get_wallet_address')
@@ -48,17 +50,17 @@ class CustomerSerializer(serializers.ModelSerializer):
         return obj.user.verified
 
 
-class CollectionSerializer(serializers.ModelSerializer):
+class CollectionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Collection
         fields = ['id', 'title']
 
 
-class CreateProductSerializer(serializers.ModelSerializer):
+class CreateProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = ['id', 'title', 'description',
-                  'unit_price', 'collection', 'photo', 'product_hash']
+                  'unit_price', 'collection', 'photo', 'product_hash', 'min_bid_increment']
 
     def create(self, validated_data):
         user = self.context['user']
@@ -66,32 +68,78 @@ class CreateProductSerializer(serializers.ModelSerializer):
         return Product.objects.create(owner=customer, **validated_data)
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class CollectionLookupField(serializers.PrimaryKeyRelatedField):
+    """Resolves collection ids from the `collections` map in the context instead of one query per row"""
+
+    def to_internal_value(self, data):
+        try:
+            return self.context['collections'][int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class ImportProductSerializer(CreateProductSerializer):
+    """
+    Validates one row of a bulk import without touching the database. The
+    importer checks product_hash uniqueness for a whole batch at once, and
+    photos are uploaded afterwards by updating each product.
+    """
+    collection = CollectionLookupField(queryset=Collection.objects.all())
+
+    class Meta(CreateProductSerializer.Meta):
+        fields = ['title', 'description', 'unit_price', 'collection', 'product_hash', 'min_bid_increment']
+        extra_kwargs = {'product_hash': {'validators': []}}
+
+
+def image_variant_urls(product):
+    # variants appear once the background worker has made them
+    storage = product.photo.storage
+    return {variant: storage.url(name) for variant, name in product.photo_variants.items()}
+
+
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     collection = CollectionSerializer()
     owner = CustomerSerializer()
     image = serializers.SerializerMethodField('get_image_url')
+    image_variants = serializers.SerializerMethodField('get_image_variants')
 
     class Meta:
         model = Product
         fields = [
-            'id', 'title', 'description', 'unit_price', 'collection', 'owner', 'image', 'visible', 'product_hash'
+            'id', 'title', 'description', 'unit_price', 'collection', 'owner', 'image', 'image_variants',
+            'visible', 'product_hash', 'min_bid_increment', 'highest_bid', 'bid_count', 'comment_count',
         ]
 
     def get_image_url(self, obj):
-        return obj.photo.url
+        # imported products have no photo until one is uploaded
+        return obj.photo.url if obj.photo else None
+
+    def get_image_variants(self, obj):
+        return image_variant_urls(obj)
+
 
+class BulkVisibilitySerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=500)
+    visible = serializers.BooleanField()
 
-class SimpleProductSerializer(serializers.ModelSerializer):
+
+class SimpleProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     image = serializers.SerializerMethodField('get_image_url')
+    image_variants = serializers.SerializerMethodField('get_image_variants')
     class Meta:
         model = Product
-        fields = ['id', 'title', 'unit_price', 'image', 'product_hash']
+        fields = ['id', 'title', 'unit_price', 'image', 'image_variants', 'product_hash']
 
     def get_image_url(self, obj):
-        return obj.photo.url
+        return obj.photo.url if obj.photo else None
+
+    def get_image_variants(self, obj):
+        return image_variant_urls(obj)
 
 
-class CreateCommentSerializer(serializers.ModelSerializer):
+class CreateCommentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Comment
         fields = ['id', 'date', 'description',]
@@ -99,10 +147,11 @@ class CreateCommentSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         product_id = self.context['product_id']
         commentor = Customer.objects.get(user=self.context['user'])
-        return Comment.objects.create(product_id=product_id, commentor=commentor, **validated_data)
+        with transaction.atomic():
+            return Comment.objects.create(product_id=product_id, commentor=commentor, **validated_data)
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     commentor = CustomerSerializer()
     product = SimpleProductSerializer()
 
@@ -111,18 +160,16 @@ class CommentSerializer(serializers.ModelSerializer):
         fields = ['id', 'date', 'description', 'product', 'commentor']
 
 
-class CreateBidSerializer(serializers.ModelSerializer):
+class CreateBidSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Bid
         fields = ['id', 'price', 'description']
 
     def create(self, validated_data):
-        product_id = self.context['product_id']
-        bidder = Customer.objects.get(user=self.context['user'])
-        return Bid.objects.create(product_id=product_id, customer=bidder, **validated_data)
+        return place_bid(self.context['product_id'], self.context['user'], **validated_data)
 
 
-class BidSerializer(serializers.ModelSerializer):
+class BidSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     customer = CustomerSerializer()
     product = SimpleProductSerializer()
 
@@ -131,13 +178,13 @@ class BidSerializer(serializers.ModelSerializer):
         fields = ['id', 'placed_at', 'price', 'description', 'product', 'customer', 'approved']
 
 
-class ApproveBidSerializer(serializers.ModelSerializer):
+class ApproveBidSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Bid
         fields = ['approved']
 
 
-class TransferSerializer(serializers.ModelSerializer):
+class TransferSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     product = SimpleProductSerializer()
     seller = CustomerSerializer()
     buyer = CustomerSerializer()
@@ -146,7 +193,7 @@ class TransferSerializer(serializers.ModelSerializer):
         fields = [ 'id', 'buyer', 'seller', 'product', 'completed' ]
 
 
-class ApproveTransferSerializer(serializers.ModelSerializer):
+class ApproveTransferSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Transfer
         fields = [ 'completed' ]
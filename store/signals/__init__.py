@@ -1,3 +1,5 @@
 from django.dispatch import Signal
 
-order_created = Signal()
\ No newline at end of file
+order_created = Signal()
+# sent by the bid approval view, which updates rows without saving models
+bid_approved = Signal()
@@ -1,10 +1,144 @@
-from ..models import Customer
+from ..models import Bid, Collection, Comment, Customer, Product
+from .. import aggregates, authentication, caching, feed, images, sqlite
+from . import bid_approved
+from ..search import index_product
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.conf import settings
 
 # Signal Handler
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_customer_for_new_user(sender, **kwargs):
     if kwargs['created']:
-        customer = Customer.objects.create(user=kwargs['instance'])
\ No newline at end of file
+        customer = Customer.objects.create(user=kwargs['instance'])
+
+
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, instance, update_fields=None, **kwargs):
+    # index rows go away with the product through the cascade
+    if update_fields is None or {'title', 'description'} & set(update_fields):
+        index_product(instance)
+
+
+@receiver(post_save, sender=Bid)
+def count_new_bid(sender, instance, created, **kwargs):
+    if created and not aggregates.is_paused():
+        aggregates.bid_added(instance)
+        caching.products_changed([instance.product_id])
+
+
+@receiver(post_delete, sender=Bid)
+def count_deleted_bid(sender, instance, **kwargs):
+    if not aggregates.is_paused():
+        aggregates.bid_removed(instance)
+        caching.products_changed([instance.product_id])
+
+
+@receiver(post_save, sender=Comment)
+def count_new_comment(sender, instance, created, **kwargs):
+    if created and not aggregates.is_paused():
+        aggregates.comment_added(instance)
+        caching.products_changed([instance.product_id])
+
+
+@receiver(post_save, sender=Bid)
+def publish_new_bid(sender, instance, created, **kwargs):
+    if created:
+        feed.publish(instance.product_id, 'bid', feed.bid_event(instance))
+
+
+@receiver(bid_approved)
+def publish_approval(sender, bid_id, product_id, transfer_id, buyer_id, **kwargs):
+    feed.publish(product_id, 'approval', {'bid': bid_id, 'transfer': transfer_id, 'buyer': buyer_id})
+
+
+@receiver(post_save, sender=Comment)
+def publish_new_comment(sender, instance, created, **kwargs):
+    if created:
+        feed.publish(instance.product_id, 'comment', feed.comment_event(instance))
+
+
+@receiver(post_delete, sender=Comment)
+def count_deleted_comment(sender, instance, **kwargs):
+    if not aggregates.is_paused():
+        aggregates.comment_removed(instance)
+        caching.products_changed([instance.product_id])
+
+
+@receiver(pre_save, sender=Product)
+def remember_previous_values(sender, instance, **kwargs):
+    # a product moved to another collection also leaves the old one's listing and counters
+    if not instance._state.adding:
+        instance._previous_collection_id, instance._previous_photo, instance._previous_visible = Product.objects \
+            .filter(pk=instance.pk).values_list('collection_id', 'photo', 'visible').first() or (None, None, None)
+
+
+@receiver(post_save, sender=Product)
+def count_saved_product(sender, instance, created, **kwargs):
+    aggregates.product_saved(instance, created, getattr(instance, '_previous_collection_id', None),
+                             getattr(instance, '_previous_visible', None))
+
+
+@receiver(post_delete, sender=Product)
+def count_deleted_product(sender, instance, **kwargs):
+    aggregates.product_deleted(instance)
+
+
+@receiver(post_save, sender=Product)
+def resize_new_photo(sender, instance, created, **kwargs):
+    if instance.photo and (created or instance.photo.name != getattr(instance, '_previous_photo', None)):
+        images.schedule_variants(instance.id)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    caching.product_changed(instance.id, instance.collection_id,
+                            getattr(instance, '_previous_collection_id', None))
+
+
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+def invalidate_collections(sender, **kwargs):
+    caching.touch(caching.COLLECTIONS)
+
+
+@receiver(pre_save, sender=Customer)
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def remember_owner_values(sender, instance, update_fields=None, **kwargs):
+    # token and login bookkeeping saves only their own fields, and show nowhere
+    fields = caching.OWNER_FIELDS[sender._meta.label_lower]
+    if instance._state.adding or (update_fields is not None and not set(fields) & set(update_fields)):
+        return
+    instance._previous_owner_values = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_owned_products(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_owner_values', None)
+    instance._previous_owner_values = None
+    if previous is None or previous == caching.owner_values(instance):
+        return
+    if sender is Customer:
+        caching.owner_changed(Product.objects.filter(owner_id=instance.pk))
+    else:
+        caching.owner_changed(Product.objects.filter(owner__user_id=instance.pk))
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_authenticated_user(sender, instance, **kwargs):
+    user_id = instance.user_id if sender is Customer else instance.pk
+    authentication.forget_user(user_id)
+    # and again once committed, a request may have cached the old row meanwhile
+    transaction.on_commit(lambda: authentication.forget_user(user_id))
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    sqlite.apply_pragmas(connection)
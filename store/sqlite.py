@@ -0,0 +1,24 @@
+import re
+
+from django.conf import settings
+
+# Tuning applied to every new SQLite connection, from settings.SQLITE_PRAGMAS.
+# In WAL mode readers keep reading while a bid is written instead of waiting
+# for it, and with synchronous=NORMAL a commit no longer waits on fsync (a
+# power loss may drop the last commits, it cannot corrupt the database).
+
+PRAGMA_NAME = re.compile(r'^[a-z_]+$')
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+
+def apply_pragmas(connection):
+    """connection_created handler; other backends are left alone"""
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+        value = str(value)
+        # pragmas cannot take parameters, so only plain names and numbers get in
+        if not PRAGMA_NAME.match(name) or not PRAGMA_VALUE.match(value):
+            raise ValueError('Invalid SQLite pragma %s = %s' % (name, value))
+        # on the raw connection, so that query logs and counts do not see it
+        connection.connection.execute('PRAGMA %s = %s' % (name, value)).fetchall()
@@ -0,0 +1,71 @@
+import hashlib
+import os
+import re
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+HASHED_NAME = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{64}(\.[\w]+)?$')
+
+
+def is_hashed(name):
+    """Whether `name` was given by ContentAddressedStorage, so its bytes never change"""
+    return HASHED_NAME.search(name) is not None
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores each file under the SHA-256 of its content, in the directory the
+    field asked for: products/ab/ab12...ef.jpg. Uploading the same bytes twice
+    stores them once and returns the same name.
+
+    Uploads are streamed in chunks to a temporary file next to the final one
+    and renamed into place, so readers never see a partial file. Because files
+    may be shared between rows, deleting one row's file affects the others;
+    the models here never delete photos.
+    """
+    chunk_size = 64 * 1024
+    incoming_directory = '.incoming'
+
+    def get_available_name(self, name, max_length=None):
+        # the final name is only known once the content has been hashed
+        return name
+
+    def hashed_name(self, name, digest):
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        return '/'.join(part for part in (directory, digest[:2], digest + extension) if part)
+
+    def _save(self, name, content):
+        incoming = os.path.join(self.location, self.incoming_directory)
+        os.makedirs(incoming, exist_ok=True)
+        temporary = os.path.join(incoming, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        # created like FileSystemStorage does, so the process umask applies
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                for chunk in content.chunks(self.chunk_size):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    output.write(chunk)
+                output.flush()
+                os.fsync(output.fileno())
+
+            name = self.hashed_name(name, digest.hexdigest())
+            full_path = self.path(name)
+            if os.path.exists(full_path):
+                os.remove(temporary)
+                return name
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary, self.file_permissions_mode)
+            os.replace(temporary, full_path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return name
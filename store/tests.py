@@ -1,3 +1,1464 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from hashlib import sha256
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, connections, router, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from requests import Response as NodeResponse
+from django.utils.translation import gettext_lazy
+from rest_framework import serializers
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from rest_framework.viewsets import ReadOnlyModelViewSet
+
+from core.models import User
+from asgiref.sync import SyncToAsync, async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+
+from store import async_api, bulk, feed, images, metrics
+from store.authentication import CachedJWTAuthentication, get_user_cache, user_key
+from store.async_api import AsyncApiApplication
+from store.blockchain import (AsyncBlockchainClient, BlockchainClient, BlockchainError, BlockchainUnavailable,
+                              CircuitBreaker)
+from store.cache import TTLCache
+from store.management.commands.blockchain_stub import make_server
+from store.caching import CatalogCacheMixin, get_cache
+from store.middleware import ReplicaRoutingMiddleware
+from store.models import Bid, Collection, Comment, Customer, JobCheckpoint, Product, Transfer
+from store.pagination import KeysetPagination
+from store.reconcile import JOB, TransferReconciler
+from store.renderers import ORJSONParser, ORJSONRenderer
+from store.routers import REPLICA, reads_from_replica
+from store.rows import RowSerializer
+from store.serializers import (BidSerializer, CollectionSerializer, CommentSerializer, ProductSerializer,
+                               SimpleProductSerializer, TransferSerializer)
+from store.transfers import buyer_owns, complete_transfer
+
+
+def make_user(name):
+    return User.objects.create_user(
+        username=name, email=name + '@example.com', password='secret',
+        first_name=name, last_name='Tester', wallet_address='wallet-' + name,
+        public_key='key-' + name, public_key_hash='hash-' + name)
+
+
+# configured by playground.test_settings, which manage.py test uses by default
+needs_replica = skipUnless(REPLICA in settings.DATABASES, 'no replica database configured')
+
+
+class StoreTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.collection = Collection.objects.create(title='Art')
+        cls.seller = make_user('seller').customer
+        cls.buyer = make_user('buyer').customer
+
+    def setUp(self):
+        get_cache().clear()
+
+    @classmethod
+    def make_product(cls, title, owner=None, description='', product_hash=None, photo=None, **kwargs):
+        return Product.objects.create(
+            title=title, description=description, unit_price=10,
+            collection=cls.collection, owner=owner or cls.seller,
+            photo=photo or 'products/' + title + '.jpg', product_hash=product_hash or 'hash-' + title, **kwargs)
+
+
+class ListQueryCountTests(StoreTestCase):
+    """
+    The number of queries behind a list endpoint must not depend on how many
+    rows end up on the page.
+    """
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url, add_row, rows=10):
+        add_row(0)
+        single = self.count_queries(url)
+        for i in range(1, rows):
+            add_row(i)
+        self.assertEqual(self.count_queries(url), single)
+
+    def test_products(self):
+        self.assertConstantQueries(
+            '/store/products/', lambda i: self.make_product('product-%d' % i))
+
+    def test_products_in_collection(self):
+        self.assertConstantQueries(
+            '/store/products/?collection_id=%d' % self.collection.id,
+            lambda i: self.make_product('product-%d' % i))
+
+    def test_comments(self):
+        product = self.make_product('commented')
+        self.assertConstantQueries(
+            '/store/products/%d/comments/' % product.id,
+            lambda i: Comment.objects.create(
+                product=product, commentor=self.buyer, description='comment %d' % i))
+
+    def test_bids(self):
+        product = self.make_product('bidden')
+        self.client.force_authenticate(self.seller.user)
+        self.assertConstantQueries(
+            '/store/products/%d/bids/' % product.id,
+            lambda i: Bid.objects.create(
+                product=product, customer=self.buyer, price=10 + i, description='bid %d' % i))
+
+    def test_transfers(self):
+        self.client.force_authenticate(self.buyer.user)
+        self.assertConstantQueries(
+            '/store/transfers/',
+            lambda i: Transfer.objects.create(
+                product=self.make_product('sold-%d' % i), seller=self.seller, buyer=self.buyer))
+
+    def test_customer_detail_is_one_query(self):
+        self.client.force_authenticate(self.buyer.user)
+        self.assertEqual(self.count_queries('/store/customers/%d/' % self.seller.id), 1)
+        # the caller's own customer comes with the authenticated user
+        self.assertEqual(self.count_queries('/store/customers/me/'), 0)
+
+
+class RowSerializerTests(StoreTestCase):
+    """List endpoints serialize values() rows; the JSON must match the DRF serializers'"""
+
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product('lamp', photo_variants={'thumb': 'products/thumb/lamp.jpg'})
+        # no photo and no bids: the None paths
+        Product.objects.filter(pk=self.make_product('imported').pk).update(photo='')
+        self.bid = Bid.objects.create(product=self.product, customer=self.buyer, price='12.50', description='mine')
+        Comment.objects.create(product=self.product, commentor=self.buyer, description='nice')
+        Transfer.objects.create(product=self.make_product('sold'), seller=self.seller, buyer=self.buyer)
+
+    def assertSerializedAs(self, data, serializer_class, queryset):
+        expected = JSONRenderer().render(serializer_class(queryset, many=True).data)
+        self.assertEqual(data, json.loads(expected))
+
+    def test_products(self):
+        results = self.client.get('/store/products/').json()['results']
+        self.assertSerializedAs(results, ProductSerializer, Product.objects.order_by('title'))
+        self.assertIsNone(results[0]['image'])
+        self.assertEqual(results[1]['highest_bid'], 12.5)
+
+    def test_bids_comments_and_transfers(self):
+        self.client.force_authenticate(self.buyer.user)
+        self.assertSerializedAs(self.client.get('/store/products/%d/bids/' % self.product.id).json(),
+                                BidSerializer, Bid.objects.all())
+        self.assertSerializedAs(self.client.get('/store/products/%d/comments/' % self.product.id).json(),
+                                CommentSerializer, Comment.objects.all())
+        self.assertSerializedAs(self.client.get('/store/transfers/').json(),
+                                TransferSerializer, Transfer.objects.all())
+
+    def test_method_fields_need_a_row_source(self):
+        class AnnotatedSerializer(SimpleProductSerializer):
+            note = serializers.SerializerMethodField()
+
+            class Meta(SimpleProductSerializer.Meta):
+                fields = SimpleProductSerializer.Meta.fields + ['note']
+
+        with self.assertRaises(ImproperlyConfigured):
+            RowSerializer(AnnotatedSerializer)
+
+
+class ORJSONTests(StoreTestCase):
+    def test_renders_what_drf_renders(self):
+        data = {'price': Decimal('12.50'), 'at': datetime(2022, 1, 2, 3, 4, 5, 6, tzinfo=timezone.utc),
+                'day': date(2022, 1, 2), 'id': uuid.UUID(int=1), 'label': gettext_lazy('Art'),
+                1: ['line\u2028break', None, True]}
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_parses_json(self):
+        parser = ORJSONParser()
+        self.assertEqual(parser.parse(BytesIO('{"title": "caf\u00e9"}'.encode('latin-1')), None,
+                                      {'encoding': 'latin-1'}), {'title': 'caf\u00e9'})
+        with self.assertRaises(ParseError):
+            parser.parse(BytesIO(b'{"title": NaN}'))
+
+    def test_streams_long_lists(self):
+        for i in range(5):
+            Transfer.objects.create(product=self.make_product('sold-%d' % i), seller=self.seller, buyer=self.buyer)
+        self.client.force_authenticate(self.buyer.user)
+        expected = self.client.get('/store/transfers/').json()
+        with mock.patch.multiple(ORJSONRenderer, stream_threshold=5, chunk_size=2):
+            response = self.client.get('/store/transfers/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), expected)
+
+
+class CachedAuthenticationTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        get_user_cache().clear()
+        self.client.credentials(HTTP_AUTHORIZATION='JWT %s' % AccessToken.for_user(self.buyer.user))
+
+    def test_read_only_requests_do_not_touch_the_database_once_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/store/customers/me/').json()['id'], self.buyer.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/store/customers/me/').json()['id'], self.buyer.id)
+
+    def test_saving_the_user_or_customer_is_seen_at_once(self):
+        self.client.get('/store/customers/me/')
+        user = User.objects.get(pk=self.buyer.user.id)
+        user.first_name = 'Renamed'
+        user.save()
+        self.assertEqual(self.client.get('/store/customers/me/').json()['firstname'], 'Renamed')
+        Customer.objects.filter(pk=self.buyer.id).update(phone='555')
+        self.buyer.refresh_from_db()
+        self.buyer.save()
+        self.assertEqual(self.client.get('/store/customers/me/').json()['phone'], '555')
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.client.get('/store/customers/me/').status_code, 401)
+
+    @override_settings(JWT_USER_CACHE='catalog')
+    def test_users_are_kept_in_the_shared_cache(self):
+        self.client.get('/store/customers/me/')
+        key = user_key(self.buyer.user.id)
+        self.assertIsNotNone(caches['catalog'].get(key))
+        # what another worker's save does to the cache this one reads
+        User.objects.filter(pk=self.buyer.user.id).update(first_name='Renamed')
+        caches['catalog'].delete(key)
+        self.assertEqual(self.client.get('/store/customers/me/').json()['firstname'], 'Renamed')
+
+    def test_verification_reads_the_token_just_issued(self):
+        self.client.get('/store/customers/me/')
+        # issued through another worker, whose save this worker's cache did not see
+        User.objects.filter(pk=self.buyer.user.id).update(randomString='issued-elsewhere')
+        with mock.patch('store.views.get_client') as get_client:
+            get_client.return_value.verify_token.return_value = True
+            response = self.client.post('/store/customers/verify_token/', {'signed_token': 'signed'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(get_client.return_value.verify_token.call_args[0][0], 'issued-elsewhere')
+
+    def test_requests_do_not_share_user_instances(self):
+        authentication = CachedJWTAuthentication()
+        token = authentication.get_validated_token(str(AccessToken.for_user(self.buyer.user)).encode())
+        first = authentication.get_user(token)
+        first.first_name = 'changed by a view'
+        with self.assertNumQueries(0):
+            second = authentication.get_user(token)
+            self.assertEqual(second.customer.id, self.buyer.id)
+        self.assertEqual(second.first_name, 'buyer')
+        self.assertIsNot(second.customer, first.customer)
+
+
+class ProductSearchTests(StoreTestCase):
+    def search(self, query):
+        response = self.client.get('/store/products/', {'search': query})
+        self.assertEqual(response.status_code, 200)
+        return [product['title'] for product in response.json()['results']]
+
+    def test_title_matches_rank_first(self):
+        self.make_product('lamp', description='goes well with an oak table')
+        self.make_product('oak table')
+        self.assertEqual(self.search('oak'), ['oak table', 'lamp'])
+
+    def test_prefix_and_every_word_must_match(self):
+        self.make_product('vintage guitar')
+        self.make_product('vintage camera')
+        self.assertEqual(self.search('vint gui'), ['vintage guitar'])
+
+    def test_index_follows_updates_and_deletes(self):
+        product = self.make_product('chair')
+        product.title = 'stool'
+        product.save()
+        self.assertEqual(self.search('chair'), [])
+        self.assertEqual(self.search('stool'), ['stool'])
+        product.delete()
+        self.assertEqual(self.search('stool'), [])
+
+
+class KeysetPaginationTests(StoreTestCase):
+    def walk(self, url, direction='next'):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append([row['id'] for row in response.json()['results']])
+            url = response.json()[direction]
+        return pages
+
+    def test_products_walk_forward_and_back(self):
+        # duplicate titles make the id tie breaker matter
+        products = [self.make_product('product-%d' % (i // 3), product_hash='hash-%d' % i)
+                    for i in range(25)]
+        expected = [product.id for product in sorted(products, key=lambda p: (p.title, p.id))]
+
+        pages = self.walk('/store/products/?cursor=')
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), expected)
+
+        last_page = self.client.get('/store/products/?cursor=').json()['next']
+        last_page = self.client.get(last_page).json()['next']
+        backwards = self.walk(last_page, direction='previous')
+        self.assertEqual(sum(reversed(backwards), []), expected)
+
+    def test_bids_newest_first(self):
+        product = self.make_product('bidden')
+        bids = [Bid.objects.create(product=product, customer=self.buyer, price=10, description='')
+                for i in range(12)]
+        self.client.force_authenticate(self.seller.user)
+        pages = self.walk('/store/products/%d/bids/?cursor=' % product.id)
+        self.assertEqual(sum(pages, []), [bid.id for bid in reversed(bids)])
+
+    def test_page_numbers_remain_the_default(self):
+        self.make_product('chair')
+        self.assertEqual(self.client.get('/store/products/').json()['count'], 1)
+        product = self.make_product('commented')
+        Comment.objects.create(product=product, commentor=self.buyer, description='hi')
+        self.assertIsInstance(self.client.get('/store/products/%d/comments/' % product.id).json(), list)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/store/products/?cursor=garbage').status_code, 404)
+
+    def test_past_the_end_links_back_to_the_first_keyset_page(self):
+        self.make_product('chair')
+        cursor = KeysetPagination.encode_position(['zzz', 10 ** 6])
+        response = self.client.get('/store/products/?cursor=' + cursor).json()
+        self.assertEqual(response['results'], [])
+        first = self.client.get(response['previous']).json()
+        self.assertNotIn('count', first)
+        self.assertEqual([row['title'] for row in first['results']], ['chair'])
+
+
+class ProductAggregateTests(StoreTestCase):
+    def bid(self, product, price):
+        return Bid.objects.create(product=product, customer=self.buyer, price=price, description='')
+
+    def assertAggregates(self, product, highest_bid, bid_count, comment_count=0):
+        product.refresh_from_db()
+        self.assertEqual((product.highest_bid, product.bid_count, product.comment_count),
+                         (highest_bid, bid_count, comment_count))
+
+    def test_bids_and_comments_update_counters(self):
+        product = self.make_product('lamp')
+        self.bid(product, 20)
+        top = self.bid(product, 35)
+        self.bid(product, 25)
+        Comment.objects.create(product=product, commentor=self.buyer, description='nice')
+        self.assertAggregates(product, 35, 3, 1)
+
+        top.delete()
+        self.assertAggregates(product, 25, 2, 1)
+
+    def test_hiding_a_product_clears_bids(self):
+        product = self.make_product('lamp')
+        self.bid(product, 20)
+        self.client.force_authenticate(self.seller.user)
+        response = self.client.put('/store/products/%d/visibility/?visible=false' % product.id)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['bid_count'], 0)
+        self.assertFalse(Bid.objects.filter(product=product).exists())
+        self.assertAggregates(product, None, 0)
+
+    def test_listed_with_products(self):
+        product = self.make_product('lamp')
+        self.bid(product, 20)
+        listed = self.client.get('/store/products/').json()['results'][0]
+        self.assertEqual((listed['highest_bid'], listed['bid_count']), (20, 1))
+
+
+class CollectionCounterTests(StoreTestCase):
+    def assertCounts(self, collection, product_count, visible_product_count):
+        collection.refresh_from_db()
+        self.assertEqual((collection.product_count, collection.visible_product_count),
+                         (product_count, visible_product_count))
+
+    def test_products_added_moved_hidden_and_deleted(self):
+        other = Collection.objects.create(title='Books')
+        lamp = self.make_product('lamp')
+        chair = self.make_product('chair')
+        self.assertCounts(self.collection, 2, 2)
+
+        chair.visible = False
+        chair.save()
+        self.assertCounts(self.collection, 2, 1)
+        lamp.collection = other
+        lamp.save()
+        self.assertCounts(self.collection, 1, 0)
+        self.assertCounts(other, 1, 1)
+        lamp.delete()
+        self.assertCounts(other, 0, 0)
+
+    @mock.patch.object(BlockchainClient, 'item_owner', return_value='hash-seller')
+    def test_bulk_import(self, item_owner):
+        self.client.force_authenticate(self.seller.user)
+        body = ''.join(json.dumps({'title': 'item %d' % i, 'description': '', 'unit_price': '10',
+                                   'collection': self.collection.id, 'product_hash': 'hash-seller-%d' % i}) + '\n'
+                       for i in range(3))
+        response = self.client.generic('POST', '/store/products/import/', body, 'application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertCounts(self.collection, 3, 3)
+
+    def test_listing_and_deleting_read_the_counters(self):
+        self.make_product('lamp')
+        self.client.force_authenticate(User.objects.create_superuser('admin', 'admin@example.com', 'secret'))
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get('/store/collections/').status_code, 200)
+        self.assertEqual([query['sql'] for query in context.captured_queries if 'JOIN' in query['sql']], [])
+        self.assertEqual(self.client.delete('/store/collections/%d/' % self.collection.id).status_code, 405)
+        # drifted to zero, the foreign key still protects the products
+        Collection.objects.update(product_count=0)
+        self.assertEqual(self.client.delete('/store/collections/%d/' % self.collection.id).status_code, 405)
+
+    def test_repair_command(self):
+        self.make_product('lamp')
+        self.make_product('chair', visible=False)
+        Collection.objects.update(product_count=7, visible_product_count=0)
+        output = StringIO()
+        call_command('refresh_collection_counts', batch_size=1, stdout=output)
+        self.assertCounts(self.collection, 2, 1)
+        self.assertIn('repaired 1', output.getvalue())
+
+
+class BulkVisibilityTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.seller.user)
+
+    def put(self, ids, visible):
+        return self.client.put('/store/products/visibility/', {'ids': ids, 'visible': visible}, format='json')
+
+    def test_hides_own_products_and_clears_their_bids_and_transfers(self):
+        lamp, chair = self.make_product('lamp'), self.make_product('chair')
+        hidden = self.make_product('hidden', visible=False)
+        theirs = self.make_product('theirs', owner=self.buyer)
+        Bid.objects.create(product=lamp, customer=self.buyer, price=20, description='')
+        Transfer.objects.create(product=chair, seller=self.seller, buyer=self.buyer)
+
+        response = self.put([lamp.id, chair.id, hidden.id, theirs.id, 0], False)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['updated'], json.loads(JSONRenderer().render(
+            ProductSerializer(Product.objects.filter(pk__in=[lamp.id, chair.id]).order_by('id'), many=True).data)))
+        self.assertEqual(response.json()['skipped'], [hidden.id, theirs.id, 0])
+        self.assertFalse(Bid.objects.filter(product=lamp).exists())
+        self.assertFalse(Transfer.objects.exists())
+        self.assertTrue(Product.objects.get(pk=theirs.id).visible)
+        self.collection.refresh_from_db()
+        self.assertEqual(self.collection.visible_product_count, 1)
+
+    def test_query_count_does_not_grow_with_the_products(self):
+        def queries(count):
+            ids = [self.make_product('product-%d-%d' % (count, i)).id for i in range(count)]
+            for product_id in ids:
+                Bid.objects.create(product_id=product_id, customer=self.buyer, price=20, description='')
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(len(self.put(ids, False).json()['updated']), count)
+            return len(context.captured_queries)
+
+        self.assertEqual(queries(2), queries(6))
+
+    def test_bids_are_cleared_without_loading_them(self):
+        def queries(bids):
+            ids = [self.make_product('product-%d-%d' % (bids, i)).id for i in range(3)]
+            Bid.objects.bulk_create([Bid(product_id=product_id, customer=self.buyer, price=20 + i, description='')
+                                     for product_id in ids for i in range(bids)])
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(len(bulk.set_visibility(self.seller.user.id, ids, False)), 3)
+            self.assertFalse(Bid.objects.filter(product_id__in=ids).exists())
+            bid_queries = [query['sql'] for query in context.captured_queries if '"store_bid"' in query['sql']]
+            self.assertEqual([sql.split()[0] for sql in bid_queries], ['DELETE'])
+            return len(context.captured_queries)
+
+        self.assertEqual(queries(1), queries(50))
+
+    def test_validates_the_body(self):
+        self.assertEqual(self.put([], False).status_code, 400)
+        self.assertEqual(self.client.put('/store/products/visibility/', {'ids': [1]}, format='json').status_code, 400)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.put([1], False).status_code, 401)
+
+
+class CatalogCacheTests(StoreTestCase):
+    def test_cached_until_a_product_changes(self):
+        product = self.make_product('lamp')
+        first = self.client.get('/store/products/')
+        with self.assertNumQueries(0):
+            second = self.client.get('/store/products/')
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+        product.title = 'desk lamp'
+        product.save()
+        third = self.client.get('/store/products/')
+        self.assertNotEqual(third['ETag'], first['ETag'])
+        self.assertEqual(third.json()['results'][0]['title'], 'desk lamp')
+
+    def test_conditional_request_is_not_modified(self):
+        self.make_product('lamp')
+        etag = self.client.get('/store/products/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/store/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_validators_survive_a_cache_flush(self):
+        self.make_product('lamp')
+        first = self.client.get('/store/products/')
+        get_cache().clear()
+        later = time.time() + 10
+        with mock.patch('store.caching.time.time', return_value=later):
+            response = self.client.get('/store/products/', HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], first['ETag'])
+            # versions start again at the current time, so dates never match stale content
+            modified = self.client.get('/store/products/', HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+            self.assertEqual(modified.status_code, 200)
+
+    def test_viewsets_without_scopes_are_not_cached(self):
+        class Uncached(CatalogCacheMixin, ReadOnlyModelViewSet):
+            queryset = Collection.objects.all()
+            serializer_class = CollectionSerializer
+
+        view = Uncached.as_view({'get': 'list'})
+        request = APIRequestFactory().get('/store/collections/')
+        self.assertNotIn('ETag', view(request))
+        with self.assertNumQueries(1):
+            view(request)
+
+    def test_new_bid_refreshes_the_listing(self):
+        product = self.make_product('lamp')
+        self.client.get('/store/products/?collection_id=%d' % self.collection.id)
+        Bid.objects.create(product=product, customer=self.buyer, price=42, description='')
+        listed = self.client.get('/store/products/?collection_id=%d' % self.collection.id).json()
+        self.assertEqual(listed['results'][0]['highest_bid'], 42)
+
+    def test_other_collections_stay_cached(self):
+        other = Collection.objects.create(title='Music')
+        self.make_product('lamp')
+        url = '/store/products/?collection_id=%d' % other.id
+        etag = self.client.get(url)['ETag']
+        self.make_product('chair')
+        self.assertEqual(self.client.get(url)['ETag'], etag)
+
+    def test_owner_changes_refresh_only_their_products(self):
+        mine = '/store/products/%d/' % self.make_product('lamp').id
+        theirs = '/store/products/%d/' % self.make_product('chair', owner=self.buyer).id
+        etags = {url: self.client.get(url)['ETag'] for url in (mine, theirs)}
+
+        # token bookkeeping, a new registration and an unchanged save show nowhere
+        user = User.objects.get(pk=self.seller.user.id)
+        user.randomString = 'challenge'
+        user.save(update_fields=['randomString'])
+        make_user('newcomer')
+        user.save()
+        self.assertEqual({url: self.client.get(url)['ETag'] for url in (mine, theirs)}, etags)
+
+        user.first_name = 'Renamed'
+        user.save()
+        self.assertNotEqual(self.client.get(mine)['ETag'], etags[mine])
+        self.assertEqual(self.client.get(mine).json()['owner']['firstname'], 'Renamed')
+        self.assertEqual(self.client.get(theirs)['ETag'], etags[theirs])
+
+
+class ThreadedTestCase(TransactionTestCase):
+    """
+    For tests whose requests run on other threads, which only see committed
+    data. Every thread closes its database connection when done, asgiref's
+    sync_to_async executor included, or the test database's WAL files
+    outlive the run.
+    """
+
+    def setUp(self):
+        self.addCleanup(lambda: SyncToAsync.single_thread_executor.submit(connections.close_all).result())
+
+    @staticmethod
+    def client_for(user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def run_together(self, function, arguments):
+        """Calls `function` with each argument on a thread of its own, all at once; returns the results"""
+        barrier = threading.Barrier(len(arguments))
+        results = []
+
+        def run(argument):
+            barrier.wait()
+            try:
+                results.append(function(argument))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run, args=(argument,)) for argument in arguments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+def use_temporary_media(test, **settings):
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root)
+    overridden = override_settings(MEDIA_ROOT=media_root, **settings)
+    overridden.enable()
+    test.addCleanup(overridden.disable)
+
+
+class ImageVariantTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        use_temporary_media(self, PRODUCT_IMAGE_VARIANTS={'thumb': (50, 50)})
+
+    def make_photo(self, color='red'):
+        buffer = BytesIO()
+        Image.new('RGB', (400, 200), color).save(buffer, 'PNG')
+        return ContentFile(buffer.getvalue(), name='lamp.png')
+
+    def test_new_photo_is_resized(self):
+        with mock.patch.object(images, 'schedule_variants') as schedule:
+            product = self.make_product('lamp', photo=self.make_photo())
+        schedule.assert_called_once_with(product.id)
+
+        names = images.generate_variants(product.id)
+        product.refresh_from_db()
+        self.assertEqual(product.photo_variants, names)
+        with product.photo.storage.open(names['thumb']) as thumb:
+            self.assertEqual(Image.open(thumb).size, (50, 25))
+        listed = self.client.get('/store/products/').json()['results'][0]
+        self.assertTrue(listed['image_variants']['thumb'].endswith(names['thumb']))
+
+    def test_unchanged_photo_is_not_resized_again(self):
+        product = self.make_product('lamp', photo=self.make_photo())
+        with mock.patch.object(images, 'schedule_variants') as schedule:
+            product.title = 'desk lamp'
+            product.save()
+        schedule.assert_not_called()
+
+    def test_variants_of_replaced_photos_are_pruned(self):
+        with mock.patch.object(images, 'schedule_variants'):
+            products = [self.make_product(title, photo=self.make_photo()) for title in ('lamp', 'twin')]
+        old = [images.generate_variants(product.id)['thumb'] for product in products][0]
+        storage = products[0].photo.storage
+
+        for product in products:
+            with mock.patch.object(images, 'schedule_variants'):
+                product.photo = self.make_photo('blue')
+                product.save()
+            new = images.generate_variants(product.id)['thumb']
+            # the twin still shows the old photo the first time round
+            self.assertEqual(images.prune_variants(storage, grace=0), int(product is products[1]))
+        self.assertFalse(storage.exists(old))
+        self.assertTrue(storage.exists(new))
+
+
+class MediaTests(APITestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        self.content = bytes(range(256)) * 8
+        self.name = default_storage.save('products/photo.jpg', ContentFile(self.content))
+
+    def test_same_content_is_stored_once(self):
+        digest = sha256(self.content).hexdigest()
+        self.assertEqual(self.name, 'products/%s/%s.jpg' % (digest[:2], digest))
+        self.assertEqual(default_storage.save('products/other.JPG', ContentFile(self.content)), self.name)
+        self.assertEqual(os.listdir(os.path.dirname(default_storage.path(self.name))), [digest + '.jpg'])
+
+    def test_serves_immutable_file(self):
+        response = self.client.get('/media/' + self.name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertIn('immutable', response['Cache-Control'])
+        revalidated = self.client.get('/media/' + self.name, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_range_requests(self):
+        response = self.client.get('/media/' + self.name, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/%d' % len(self.content))
+
+        suffix = self.client.get('/media/' + self.name, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(suffix.streaming_content), self.content[-5:])
+        outside = self.client.get('/media/' + self.name, HTTP_RANGE='bytes=99999-')
+        self.assertEqual(outside.status_code, 416)
+
+    def test_paths_outside_media_root_are_not_served(self):
+        self.assertEqual(self.client.get('/media/../settings.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/products/missing.jpg').status_code, 404)
+
+    def test_unfinished_uploads_are_not_served(self):
+        incoming = os.path.join(default_storage.location, default_storage.incoming_directory)
+        os.makedirs(incoming, exist_ok=True)
+        with open(os.path.join(incoming, 'partial'), 'wb') as partial:
+            partial.write(self.content[:100])
+        self.assertEqual(self.client.get('/media/.incoming/partial').status_code, 404)
+        shard = os.path.dirname(default_storage.path(self.name))
+        with open(os.path.join(shard, 'partial.jpg'), 'wb') as partial:
+            partial.write(self.content[:100])
+        self.assertEqual(self.client.get('/media/%s/partial.jpg' % os.path.dirname(self.name)).status_code, 404)
+        self.assertEqual(self.client.get('/media/' + self.name).status_code, 200)
+
+
+def node_owner(product_hash, refresh=False):
+    if product_hash.startswith('down-'):
+        raise BlockchainUnavailable('node is down')
+    return 'hash-seller' if product_hash.startswith('mine-') else 'hash-someone'
+
+
+@mock.patch.object(BlockchainClient, 'item_owner', side_effect=node_owner)
+class BulkImportTests(StoreTestCase):
+    def row(self, title, product_hash, unit_price='12.50'):
+        return dict(title=title, unit_price=unit_price, collection=self.collection.id, product_hash=product_hash)
+
+    def post_rows(self, body, content_type):
+        self.client.force_authenticate(self.seller.user)
+        return self.client.generic('POST', '/store/products/import/', body, content_type)
+
+    def test_ndjson_import_reports_rows_that_fail(self, item_owner):
+        self.make_product('lamp', product_hash='mine-taken')
+        rows = [
+            self.row('oak chair', 'mine-1'),
+            self.row('no price', 'mine-2', unit_price='free'),
+            self.row('theirs', 'other-1'),
+            self.row('offline', 'down-1'),
+            self.row('again', 'mine-taken'),
+            self.row('twice', 'mine-1'),
+        ]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\nnot json\n'
+        response = self.post_rows(body, 'application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        report = response.json()
+        self.assertEqual(report['created'], 1)
+        self.assertEqual([error['row'] for error in report['errors']], [2, 6, 7, 3, 4, 5])
+
+        product = Product.objects.get(product_hash='mine-1')
+        self.assertEqual((product.owner, product.title), (self.seller, 'oak chair'))
+        search = self.client.get('/store/products/?search=oak').json()['results']
+        self.assertEqual([listed['title'] for listed in search], ['oak chair'])
+
+    def test_csv_import(self, item_owner):
+        body = 'title,description,unit_price,collection,product_hash\n' + ''.join(
+            'lamp %d,,10,%d,mine-%d\n' % (i, self.collection.id, i) for i in range(3))
+        response = self.post_rows(body, 'text/csv')
+        self.assertEqual(response.json(), {'created': 3, 'errors': []})
+        self.assertEqual(Product.objects.filter(owner=self.seller).count(), 3)
+
+    def test_reports_rows_that_are_not_utf8(self, item_owner):
+        body = (json.dumps(self.row('lamp', 'mine-1')) + '\n').encode() + b'{"title": "caf\xe9"}\n'
+        response = self.post_rows(body, 'application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'created': 1, 'errors': [
+            {'row': 2, 'errors': {'non_field_errors': ['Invalid UTF-8']}}]})
+
+        body = ('title,unit_price,collection,product_hash\nchair,10,%d,mine-2\n' % self.collection.id).encode()
+        response = self.post_rows(body + b'"caf\xe9\nau lait",10,1,mine-3\n', 'text/csv')
+        self.assertEqual(response.json(), {'created': 1, 'errors': [
+            {'row': 2, 'errors': {'non_field_errors': ['Invalid UTF-8']}}]})
+
+    def test_export_streams_own_products(self, item_owner):
+        self.make_product('lamp')
+        self.make_product('chair', owner=self.buyer)
+        self.client.force_authenticate(self.seller.user)
+        response = self.client.get('/store/products/export/')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([(row['title'], row['unit_price']) for row in rows], [('lamp', 10.0)])
+        self.assertIsInstance(rows[0]['unit_price'], float)
+        listed = self.client.get('/store/products/').json()['results']
+        self.assertEqual(type(listed[0]['unit_price']), type(rows[0]['unit_price']))
+
+        csv_lines = b''.join(self.client.get('/store/products/export/?output=csv').streaming_content)
+        self.assertEqual(csv_lines.decode().splitlines()[0],
+                         'id,title,description,unit_price,collection,product_hash,visible')
+
+
+class BidApprovalTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product('lamp')
+        self.bids = [Bid.objects.create(product=self.product, customer=self.buyer, price=price, description='')
+                     for price in (20, 30)]
+
+    def approve(self, bid, user=None):
+        self.client.force_authenticate(user or self.seller.user)
+        return self.client.put('/store/products/%d/bids/%d/' % (self.product.id, bid.id), {'approved': True})
+
+    def test_approval_opens_a_transfer(self):
+        with self.assertNumQueries(8):
+            response = self.approve(self.bids[1])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['data']['buyer']['id'], self.buyer.id)
+        self.product.refresh_from_db()
+        self.assertFalse(self.product.visible)
+        self.collection.refresh_from_db()
+        self.assertEqual((self.collection.product_count, self.collection.visible_product_count), (1, 0))
+        self.assertTrue(Bid.objects.get(pk=self.bids[1].id).approved)
+        self.assertEqual(Transfer.objects.get().seller, self.seller)
+
+    def test_second_approval_conflicts(self):
+        self.approve(self.bids[0])
+        response = self.approve(self.bids[1])
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Bid.objects.get(pk=self.bids[1].id).approved)
+
+    def test_only_the_owner_approves(self):
+        self.assertEqual(self.approve(self.bids[0], user=self.buyer.user).status_code, 403)
+        other = self.make_product('chair')
+        self.client.force_authenticate(self.seller.user)
+        url = '/store/products/%d/bids/%d/' % (other.id, self.bids[0].id)
+        self.assertEqual(self.client.put(url, {'approved': True}).status_code, 404)
+
+
+@override_settings(METRICS_TOKEN='scraper-secret')
+class MetricsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.registry.clear()
+        self.make_product('lamp')
+        staff = make_user('ops')
+        staff.is_staff = True
+        staff.save()
+        self.staff_jwt = 'JWT %s' % AccessToken.for_user(staff)
+
+    def test_records_time_queries_and_bytes_by_view(self):
+        response = self.client.get('/store/products/', HTTP_AUTHORIZATION=self.staff_jwt)
+        phases = dict(item.split(';dur=') for item in response['Server-Timing'].split(', '))
+        self.assertEqual(set(phases), {'db', 'serialize', 'permissions', 'node', 'total'})
+        self.assertGreater(float(phases['serialize']), 0)
+
+        exposition = self.client.get('/metrics/', HTTP_X_METRICS_TOKEN='scraper-secret').content.decode()
+        labels = '{method="GET",view="products-list"}'
+        self.assertIn('store_request_ms_count%s 1' % labels, exposition)
+        self.assertIn('store_response_bytes_sum%s %d' % (labels, len(response.content)), exposition)
+        self.assertIn('store_queries_bucket{method="GET",view="products-list",le="+Inf"} 1', exposition)
+
+    def test_times_serializers_and_permission_checks(self):
+        product = Product.objects.get(title='lamp')
+        self.client.force_authenticate(self.seller.user)
+        response = self.client.patch('/store/products/%d/' % product.id, {'title': 'lamp 2'},
+                                     HTTP_X_METRICS_TOKEN='scraper-secret')
+        self.assertEqual(response.status_code, 200)
+        phases = dict(item.split(';dur=') for item in response['Server-Timing'].split(', '))
+        self.assertGreater(float(phases['serialize']), 0)
+        self.assertGreater(float(phases['permissions']), 0)
+
+    def test_times_calls_to_the_node(self):
+        def slow_node(method, url, **kwargs):
+            time.sleep(0.02)
+            return mock.Mock(status_code=200, json=lambda: {'item_owner': 'someone else'})
+
+        self.client.force_authenticate(self.seller.user)
+        with mock.patch('requests.Session.request', side_effect=slow_node):
+            response = self.client.post('/store/products/', {'product_hash': 'timed-hash'},
+                                        HTTP_X_METRICS_TOKEN='scraper-secret')
+        self.assertEqual(response.status_code, 400)
+        node = dict(item.split(';dur=') for item in response['Server-Timing'].split(', '))['node']
+        self.assertGreaterEqual(float(node), 20)
+
+    def test_profiles_requests_on_demand(self):
+        response = self.client.get('/store/products/', HTTP_X_PROFILE='1', HTTP_AUTHORIZATION=self.staff_jwt)
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(response['X-Profiled-Status'], '200')
+        self.assertIn('function calls', response.content.decode())
+
+    def test_keeps_metrics_and_profiles_internal(self):
+        # the address of every client behind the local proxy
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', HTTP_X_METRICS_TOKEN='guess').status_code, 403)
+        customer = 'JWT %s' % AccessToken.for_user(self.buyer.user)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION=customer).status_code, 403)
+        response = self.client.get('/store/products/', HTTP_X_PROFILE='1', HTTP_AUTHORIZATION=customer)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION=self.staff_jwt).status_code, 200)
+
+
+class BlockchainClientTests(StoreTestCase):
+    """The sync client, its circuit breaker and owner cache, against a stub node"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = make_server(port=0)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.server.owner = 'hash-seller'
+        self.server.delay = 0
+        self.server.failures = 0
+        self.node = self.make_client()
+
+    def make_client(self, **kwargs):
+        url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        node = BlockchainClient(url, **dict({'backoff_factor': 0, 'failure_threshold': 2}, **kwargs))
+        self.addCleanup(node.session.close)
+        return node
+
+    def test_retries_a_busy_node(self):
+        self.server.failures = 2
+        self.assertEqual(self.node.item_owner('busy'), 'hash-seller')
+        self.server.failures = 3
+        with self.assertRaisesMessage(BlockchainUnavailable, 'returned 503'):
+            self.node.item_owner('busier')
+        self.assertEqual(self.server.failures, 0)
+
+    def test_gives_up_on_a_slow_node(self):
+        self.server.delay = 0.5
+        node = self.make_client(read_timeout=0.1, retries=0)
+        started = time.monotonic()
+        with self.assertRaises(BlockchainUnavailable):
+            node.item_owner('slow')
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_stops_calling_a_failing_node(self):
+        node = self.make_client(retries=0)
+        self.server.failures = 3
+        for _ in range(2):
+            with self.assertRaisesMessage(BlockchainUnavailable, 'returned 503'):
+                node.item_owner('item')
+        with self.assertRaisesMessage(BlockchainUnavailable, 'circuit is open'):
+            node.item_owner('item')
+        self.assertEqual(self.server.failures, 1)
+
+    def test_quotes_the_product_hash(self):
+        session = self.node.session
+        with mock.patch.object(session, 'request', wraps=session.request) as request:
+            self.assertEqual(self.node.item_owner('a/../../token/verify?x#y%'), 'hash-seller')
+        self.assertTrue(request.call_args[0][1].endswith('/item/owner/a%2F..%2F..%2Ftoken%2Fverify%3Fx%23y%25'))
+
+    def test_answers_that_are_not_objects_are_errors(self):
+        reply = NodeResponse()
+        reply.status_code, reply._content = 200, b'["hash-seller"]'
+        with mock.patch.object(self.node.session, 'request', return_value=reply):
+            with self.assertRaisesMessage(BlockchainError, 'list instead of an object'):
+                self.node.item_owner('item')
+
+    def test_unexpected_errors_end_the_trial_call(self):
+        node = self.make_client(failure_threshold=1)
+        breaker = node.breaker
+        with mock.patch.object(node.session, 'request', side_effect=RuntimeError('unwrapped')):
+            with self.assertRaises(RuntimeError):
+                node.item_owner('first')
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            breaker.opened_at -= breaker.reset_timeout
+            with self.assertRaises(RuntimeError):
+                node.item_owner('trial')
+        self.assertFalse(breaker.trial_running)
+        breaker.opened_at -= breaker.reset_timeout
+        self.assertEqual(node.item_owner('second trial'), 'hash-seller')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        with mock.patch('store.blockchain.time.monotonic', return_value=100):
+            breaker.record_failure()
+            self.assertEqual((breaker.state, breaker.allow()), (CircuitBreaker.CLOSED, True))
+            breaker.record_failure()
+            self.assertEqual((breaker.state, breaker.allow()), (CircuitBreaker.OPEN, False))
+        with mock.patch('store.blockchain.time.monotonic', return_value=130):
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            # a single trial call at a time
+            self.assertEqual((breaker.allow(), breaker.allow()), (True, False))
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with mock.patch('store.blockchain.time.monotonic', return_value=160):
+            self.assertTrue(breaker.allow())
+            breaker.record_success()
+            self.assertEqual((breaker.state, breaker.allow()), (CircuitBreaker.CLOSED, True))
+
+    def test_ttl_cache(self):
+        cache = TTLCache(maxsize=2, ttl=10)
+        with mock.patch('store.cache.time.monotonic', return_value=0):
+            cache.set('a', 1)
+            cache.set('b', 2)
+            self.assertEqual(cache.get('a'), 1)
+            # 'b' is now the least recently used
+            cache.set('c', 3)
+            self.assertEqual((cache.get('b'), cache.get('c')), (None, 3))
+        with mock.patch('store.cache.time.monotonic', return_value=10):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'size': 1, 'maxsize': 2, 'ttl': 10, 'hits': 2, 'misses': 2})
+
+    def test_transfers_drop_the_cached_owner(self):
+        product = self.make_product('lamp', visible=False)
+        transfer = Transfer.objects.create(product=product, buyer=self.buyer, seller=self.seller)
+        self.assertEqual(self.node.item_owner('hash-lamp'), 'hash-seller')
+        self.server.owner = 'hash-buyer'
+        # the cached owner predates the transfer, the node has the current one
+        self.assertEqual(self.node.item_owner('hash-lamp'), 'hash-seller')
+        self.assertTrue(buyer_owns(self.node, 'hash-lamp', 'hash-buyer'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(complete_transfer(transfer, self.node))
+        self.assertEqual(len(self.node.owners), 0)
+
+
+class TransferCompletionTests(StoreTestCase):
+    def test_only_the_buyer_completes_a_transfer(self):
+        product = self.make_product('lamp', visible=False)
+        transfer = Transfer.objects.create(product=product, buyer=self.buyer, seller=self.seller)
+        path = '/store/transfers/%d/' % transfer.id
+        with mock.patch('store.views.get_client') as get_client:
+            get_client.return_value.item_owner.return_value = 'hash-buyer'
+            for user in (make_user('stranger'), self.seller.user):
+                self.client.force_authenticate(user)
+                self.assertEqual(self.client.put(path).status_code, 403)
+            get_client.return_value.item_owner.assert_not_called()
+            self.assertTrue(Transfer.objects.exists())
+
+            self.client.force_authenticate(self.buyer.user)
+            self.assertEqual(self.client.put(path).status_code, 200)
+        product.refresh_from_db()
+        self.assertEqual(product.owner, self.buyer)
+
+
+class TransferReconcileTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transfers = []
+        for title in ('paid', 'unpaid', 'also-paid'):
+            product = self.make_product(title, visible=False)
+            Bid.objects.create(product=product, customer=self.buyer, price=20, description='bid')
+            self.transfers.append(Transfer.objects.create(product=product, buyer=self.buyer, seller=self.seller))
+        self.client_node = BlockchainClient('http://node.invalid')
+        self.owners = {'hash-paid': 'hash-buyer', 'hash-unpaid': 'hash-seller', 'hash-also-paid': 'hash-buyer'}
+        patcher = mock.patch.object(BlockchainClient, 'item_owner', side_effect=self.node_owner)
+        self.item_owner = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def node_owner(self, product_hash, refresh=False):
+        if self.owners is None:
+            raise BlockchainUnavailable('node is down')
+        return self.owners[product_hash]
+
+    def reconciler(self, **kwargs):
+        return TransferReconciler(self.client_node, batch_size=2, **kwargs)
+
+    def test_completes_transfers_the_node_shows_under_the_buyer(self):
+        stats = self.reconciler().run_pass()
+        self.assertEqual(stats, {'checked': 3, 'completed': 2, 'pending': 1, 'failed': 0})
+        self.assertEqual(list(Transfer.objects.values_list('product__title', flat=True)), ['unpaid'])
+        self.assertEqual(set(Product.objects.filter(owner=self.buyer).values_list('title', flat=True)),
+                         {'paid', 'also-paid'})
+        self.assertEqual(Product.objects.get(title='paid').bid_count, 0)
+        checkpoint = JobCheckpoint.objects.get(name=JOB)
+        self.assertEqual((checkpoint.position, checkpoint.lease_owner), (0, ''))
+        self.assertIsNotNone(checkpoint.last_pass_finished_at)
+
+    def test_resumes_from_the_checkpoint(self):
+        JobCheckpoint.objects.create(name=JOB, position=self.transfers[1].pk,
+                                     stats={'checked': 2, 'completed': 0, 'pending': 2, 'failed': 0})
+        stats = self.reconciler().run_pass()
+        self.assertEqual(stats, {'checked': 3, 'completed': 1, 'pending': 2, 'failed': 0})
+        self.assertEqual(Transfer.objects.count(), 2)
+
+    def test_keeps_its_place_while_the_node_is_down(self):
+        self.owners = None
+        stats = self.reconciler().run_pass()
+        self.assertEqual(stats['checked'], 0)
+        self.assertEqual(Transfer.objects.count(), 3)
+        self.assertEqual(JobCheckpoint.objects.get(name=JOB).position, 0)
+
+    def test_leaves_the_job_to_the_runner_holding_it(self):
+        holder = self.reconciler()
+        self.assertTrue(holder.acquire())
+        self.assertIsNone(self.reconciler().run_pass())
+        self.assertEqual(Transfer.objects.count(), 3)
+        holder.release()
+        self.assertIsNotNone(self.reconciler().run_pass())
+
+
+class ConcurrentBidApprovalTests(ThreadedTestCase):
+    def test_exactly_one_parallel_approval_succeeds(self):
+        collection = Collection.objects.create(title='Art')
+        seller = make_user('seller').customer
+        product = Product.objects.create(title='lamp', unit_price=10, collection=collection, owner=seller,
+                                         photo='products/lamp.jpg', product_hash='hash-lamp')
+        bids = [Bid.objects.create(product=product, customer=make_user('buyer%d' % i).customer,
+                                   price=20 + i, description='') for i in range(8)]
+
+        def approve(approval):
+            client, bid = approval
+            return client.put('/store/products/%d/bids/%d/' % (product.id, bid.id), {'approved': True}).status_code
+
+        statuses = self.run_together(approve, [(self.client_for(seller.user), bid) for bid in bids])
+
+        self.assertEqual(sorted(statuses), [201] + [409] * (len(bids) - 1))
+        self.assertEqual(Transfer.objects.count(), 1)
+        self.assertEqual(Bid.objects.filter(approved=True).count(), 1)
+
+
+class BidPlacementTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product('lamp', min_bid_increment=5)
+
+    def place(self, price, user=None, product=None):
+        self.client.force_authenticate(user or self.buyer.user)
+        return self.client.post('/store/products/%d/bids/' % (product or self.product).id,
+                                {'price': price, 'description': 'bid'})
+
+    def test_bids_must_beat_the_high_bid(self):
+        self.assertEqual(self.place(20).status_code, 201)
+        response = self.place(24)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'price': ['Must be at least 25.00']})
+        self.assertEqual(self.place(25).status_code, 201)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.highest_bid, self.product.bid_count), (25, 2))
+
+    def test_owner_and_hidden_products_are_refused(self):
+        self.assertEqual(self.place(20, user=self.seller.user).status_code, 403)
+        hidden = self.make_product('chair', visible=False)
+        self.assertEqual(self.place(20, product=hidden).status_code, 403)
+        self.client.force_authenticate(self.buyer.user)
+        missing = self.client.post('/store/products/0/bids/', {'price': 20, 'description': 'bid'})
+        self.assertEqual(missing.status_code, 404)
+        self.assertFalse(Bid.objects.exists())
+
+
+class ConcurrentBidPlacementTests(ThreadedTestCase):
+    def test_only_one_of_equal_parallel_bids_wins(self):
+        seller = make_user('seller').customer
+        product = Product.objects.create(title='lamp', unit_price=10, collection=Collection.objects.create(title='Art'),
+                                         owner=seller, photo='products/lamp.jpg', product_hash='hash-lamp')
+        clients = [self.client_for(make_user('bidder%d' % i)) for i in range(8)]
+
+        statuses = self.run_together(lambda client: client.post(
+            '/store/products/%d/bids/' % product.id, {'price': 50, 'description': 'bid'}).status_code, clients)
+
+        self.assertEqual(sorted(statuses), [201] + [400] * (len(clients) - 1))
+        product.refresh_from_db()
+        self.assertEqual((product.highest_bid, product.bid_count), (50, 1))
+
+
+class ProductFeedTests(ThreadedTestCase):
+    """Feed reads run on other threads, so the data has to be committed"""
+
+    def setUp(self):
+        super().setUp()
+        get_cache().clear()
+        self.seller = make_user('seller').customer
+        self.buyer = make_user('buyer').customer
+        self.product = Product.objects.create(
+            title='lamp', unit_price=10, collection=Collection.objects.create(title='Art'),
+            owner=self.seller, photo='products/lamp.jpg', product_hash='hash-lamp')
+        self.application = feed.ProductFeedApplication(None)
+
+    def scope(self, product_id, token=None):
+        query = 'token=%s' % token if token else ''
+        return {'type': 'http', 'method': 'GET', 'path': '/store/products/%d/events/' % product_id,
+                'query_string': query.encode(), 'headers': []}
+
+    def test_streams_bids_comments_and_approvals(self):
+        token = AccessToken.for_user(self.seller.user)
+
+        def act():
+            try:
+                bid = Bid.objects.create(product=self.product, customer=self.buyer, price=20, description='bid')
+                Comment.objects.create(product=self.product, commentor=self.buyer, description='nice')
+                client = APIClient()
+                client.force_authenticate(self.seller.user)
+                client.put('/store/products/%d/bids/%d/' % (self.product.id, bid.id), {'approved': True})
+            finally:
+                connections.close_all()
+
+        async def listen():
+            communicator = ApplicationCommunicator(self.application, self.scope(self.product.id, token))
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            start = await communicator.receive_output(5)
+            await communicator.receive_output(5)
+            await sync_to_async(act, thread_sensitive=False)()
+            events = [(await communicator.receive_output(5))['body'].decode() for _ in range(3)]
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(5)
+            return start, events
+
+        start, events = async_to_sync(listen)()
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+        self.assertEqual([event.split('\n')[0] for event in events],
+                         ['event: bid', 'event: comment', 'event: approval'])
+        self.assertEqual(json.loads(events[0].split('\n')[1][len('data: '):])['price'], 20)
+        self.assertEqual(feed.get_broker().subscriptions, {})
+
+    def test_refuses_anonymous_and_missing_products(self):
+        token = AccessToken.for_user(self.buyer.user)
+
+        async def status(scope):
+            communicator = ApplicationCommunicator(self.application, scope)
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            return (await communicator.receive_output(5))['status']
+
+        self.assertEqual(async_to_sync(status)(self.scope(self.product.id)), 401)
+        self.assertEqual(async_to_sync(status)(self.scope(0, token)), 404)
+
+    def test_slow_subscriber_is_told_to_reset(self):
+        async def overflow():
+            subscription = feed.LocalBroker(maxsize=2).subscribe('product:1')
+            for i in range(3):
+                subscription.put('event %d' % i)
+            return [await subscription.get() for _ in range(subscription.queue.qsize())]
+
+        self.assertEqual(async_to_sync(overflow)(), [feed.RESET])
+
+
+class AsyncApiTests(ThreadedTestCase):
+    """The async endpoints answer like the viewsets, against a stub node"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = make_server(port=0)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        get_cache().clear()
+        self.collection = Collection.objects.create(title='Art')
+        self.seller = make_user('seller').customer
+        self.buyer = make_user('buyer').customer
+        self.server.owner = 'hash-seller'
+        self.node = AsyncBlockchainClient(BlockchainClient('http://127.0.0.1:%d' % self.server.server_address[1]))
+        patcher = mock.patch.object(async_api, 'get_async_client', return_value=self.node)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.passed_on = []
+        self.application = AsyncApiApplication(self.django_application)
+
+    async def django_application(self, scope, receive, send):
+        self.passed_on.append(scope['path'])
+
+    def call(self, method, path, data=None, user=None):
+        body = json.dumps(data or {}).encode()
+        headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+        if user is not None:
+            self.authorization = 'JWT %s' % AccessToken.for_user(user)
+            headers.append((b'authorization', self.authorization.encode()))
+
+        async def request():
+            communicator = ApplicationCommunicator(self.application, {
+                'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': headers})
+            await communicator.send_input({'type': 'http.request', 'body': body})
+            try:
+                start = await communicator.receive_output(5)
+                content = await communicator.receive_output(5)
+            finally:
+                # async_to_sync closes its loop on the way out
+                await self.node.close()
+            self.headers = dict(start['headers'])
+            return start['status'], json.loads(content['body'])
+
+        return async_to_sync(request)()
+
+    def test_creates_products_the_node_has_on_record(self):
+        data = {'title': 'lamp', 'unit_price': '10.00', 'collection': self.collection.id, 'product_hash': 'h1'}
+        status, product = self.call('POST', '/store/products/', data, self.seller.user)
+        self.assertEqual(status, 201)
+        self.assertEqual(Product.objects.get(pk=product['id']).owner, self.seller)
+
+        status, body = self.call('POST', '/store/products/', dict(data, product_hash='h2'), self.buyer.user)
+        self.assertEqual((status, body), (400, {'error': 'Item not registered under the provided user\'s address'}))
+        status, body = self.call('POST', '/store/products/', dict(data, product_hash='h1'), self.seller.user)
+        self.assertEqual(status, 400)
+        self.assertIn('product_hash', body)
+
+    def test_verifies_tokens(self):
+        status, body = self.call('POST', '/store/customers/verify_token/', {'signed_token': 's'}, self.buyer.user)
+        self.assertEqual(status, 202)
+        self.assertTrue(User.objects.get(pk=self.buyer.user.id).verified)
+
+    def test_completes_transfers_once_the_buyer_owns_the_item(self):
+        product = Product.objects.create(title='lamp', unit_price=10, collection=self.collection, owner=self.seller,
+                                         photo='products/lamp.jpg', product_hash='hash-lamp', visible=False)
+        transfer = Transfer.objects.create(product=product, buyer=self.buyer, seller=self.seller)
+        path = '/store/transfers/%d/' % transfer.id
+
+        self.assertEqual(self.call('PUT', path, user=self.buyer.user)[0], 402)
+        self.server.owner = 'hash-buyer'
+        self.assertEqual(self.call('PUT', path, user=make_user('stranger'))[0], 403)
+        status, body = self.call('PUT', path, user=self.buyer.user)
+        self.assertEqual(status, 200)
+        self.assertEqual(body['id'], product.id)
+        product.refresh_from_db()
+        self.assertEqual(product.owner, self.buyer)
+        self.assertFalse(Transfer.objects.exists())
+        self.assertEqual(self.call('PUT', path, user=self.buyer.user)[0], 404)
+
+    @needs_replica
+    def test_pins_writers_to_the_primary(self):
+        data = {'title': 'lamp', 'unit_price': '10.00', 'collection': self.collection.id, 'product_hash': 'h1'}
+        self.assertEqual(self.call('POST', '/store/products/', data, self.buyer.user)[0], 400)
+        self.assertNotIn(b'set-cookie', self.headers)
+
+        self.assertEqual(self.call('POST', '/store/products/', data, self.seller.user)[0], 201)
+        self.assertIn(b'primary_pin=1', self.headers[b'set-cookie'])
+        request = APIRequestFactory().get('/store/products/', HTTP_AUTHORIZATION=self.authorization)
+        self.assertTrue(ReplicaRoutingMiddleware(None).pinned(request))
+
+    def test_refuses_anonymous_requests_and_passes_others_on(self):
+        status, body = self.call('POST', '/store/customers/verify_token/', {'signed_token': 's'})
+        self.assertEqual(status, 401)
+        async_to_sync(self.application.__call__)({'type': 'http', 'method': 'GET', 'path': '/store/products/'}, None, None)
+        self.assertEqual(self.passed_on, ['/store/products/'])
+
+    def test_reports_an_unreachable_node(self):
+        self.node = AsyncBlockchainClient(BlockchainClient('http://127.0.0.1:9', retries=0))
+        with mock.patch.object(async_api, 'get_async_client', return_value=self.node):
+            status, body = self.call('POST', '/store/customers/verify_token/', {'signed_token': 's'}, self.buyer.user)
+        self.assertEqual((status, body), (503, {'error': 'Could not reach the blockchain node'}))
+
+    def test_client_retries_a_busy_node(self):
+        self.node.client.backoff_factor = 0
+        replies = [(503, b''), (200, b'{"item_owner": "hash-buyer"}')]
+        with mock.patch.object(AsyncBlockchainClient, 'send', side_effect=replies) as send:
+            self.assertEqual(async_to_sync(self.node.item_owner)('busy-item'), 'hash-buyer')
+        self.assertEqual(send.call_count, 2)
+        with mock.patch.object(AsyncBlockchainClient, 'send', return_value=(200, b'<html>')):
+            with self.assertRaisesMessage(BlockchainError, 'invalid JSON'):
+                async_to_sync(self.node.item_owner)('garbled-item')
+
+    def test_closes_the_node_connections_on_shutdown(self):
+        async def serve():
+            await self.node.item_owner('item')
+            session = self.node.session()
+            communicator = ApplicationCommunicator(self.application, {'type': 'lifespan'})
+            await communicator.send_input({'type': 'lifespan.startup'})
+            started = await communicator.receive_output(5)
+            await communicator.send_input({'type': 'lifespan.shutdown'})
+            return started, await communicator.receive_output(5), session.closed
+
+        started, stopped, closed = async_to_sync(serve)()
+        self.assertEqual((started['type'], stopped['type']),
+                         ('lifespan.startup.complete', 'lifespan.shutdown.complete'))
+        self.assertTrue(closed)
+
+    def test_client_reuses_connections(self):
+        async def lookups():
+            owners = [await self.node.item_owner('item-%d' % i) for i in range(3)]
+            await self.node.close()
+            return owners
+
+        connections = self.server.connections
+        self.assertEqual(async_to_sync(lookups)(), ['hash-seller'] * 3)
+        self.assertEqual(self.server.connections - connections, 1)
+
+
+@needs_replica
+@override_settings(DATABASE_ROUTERS=['store.routers.ReplicaRouter'])
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = '__all__'
+    client_class = APIClient
+
+    def setUp(self):
+        get_cache().clear()
+        self.seller = make_user('seller').customer
+        self.buyer = make_user('buyer').customer
+        self.product = Product.objects.create(
+            title='lamp', unit_price=10, collection=Collection.objects.create(title='Art'),
+            owner=self.seller, photo='products/lamp.jpg', product_hash='hash-lamp')
+        self.replicate()
+
+    def replicate(self):
+        """Copies the primary to the replica, as replication would have by now"""
+        for alias in ('default', REPLICA):
+            connections[alias].ensure_connection()
+        connections['default'].connection.backup(connections[REPLICA].connection)
+
+    # cached pages are read from the primary for this long after a change
+    @override_settings(REPLICA_STICKY_SECONDS=0)
+    def test_catalog_reads_of_safe_requests_use_the_replica(self):
+        Product.objects.filter(pk=self.product.pk).update(title='renamed')
+        Transfer.objects.create(product=self.product, seller=self.seller, buyer=self.buyer)
+        self.assertEqual(self.client.get('/store/products/').json()['results'][0]['title'], 'lamp')
+        self.assertEqual(self.client.get('/store/products/%d/' % self.product.id).json()['title'], 'lamp')
+        # transfers are not catalog data
+        self.client.force_authenticate(self.buyer.user)
+        self.assertEqual(len(self.client.get('/store/transfers/').json()), 1)
+
+    def test_pages_cached_after_a_change_come_from_the_primary(self):
+        self.assertEqual(self.client.get('/store/products/').json()['results'][0]['title'], 'lamp')
+        seller = APIClient(HTTP_AUTHORIZATION='JWT %s' % AccessToken.for_user(self.seller.user))
+        self.assertEqual(seller.patch('/store/products/%d/' % self.product.id, {'title': 'renamed'}).status_code, 200)
+        # another client, not pinned, while the replica still has the old title
+        for _ in range(2):
+            self.assertEqual(self.client.get('/store/products/').json()['results'][0]['title'], 'renamed')
+        with override_settings(REPLICA_STICKY_SECONDS=0):
+            self.assertEqual(self.client.get('/store/products/%d/' % self.product.id).json()['title'], 'lamp')
+
+    def test_writers_read_their_writes(self):
+        client = APIClient(HTTP_AUTHORIZATION='JWT %s' % AccessToken.for_user(self.buyer.user))
+        url = '/store/products/%d/comments/' % self.product.id
+        self.assertEqual(client.post(url, {'description': 'nice'}).status_code, 201)
+        self.assertEqual(len(client.get(url).json()), 1)
+        # pinned by the token as well as by the cookie
+        client.cookies.clear()
+        self.assertEqual(len(client.get(url).json()), 1)
+        self.assertEqual(self.client.get(url).json(), [])
+
+    def test_routing(self):
+        self.assertEqual(router.db_for_read(Product), 'default')
+        token = reads_from_replica.set(True)
+        try:
+            self.assertEqual(router.db_for_read(Product), REPLICA)
+            self.assertEqual(router.db_for_read(Transfer), 'default')
+            self.assertEqual(router.db_for_write(Product), 'default')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Product), 'default')
+        finally:
+            reads_from_replica.reset(token)
+
+
+class SqlitePragmaTests(APITestCase):
+    def connect(self):
+        new = connections.create_connection('default')
+        self.addCleanup(new.close)
+        new.ensure_connection()
+        return new
+
+    def pragma(self, new, name):
+        with new.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_new_connections_are_tuned(self):
+        new = self.connect()
+        self.assertEqual(self.pragma(new, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(new, 'busy_timeout'), settings.SQLITE_PRAGMAS['busy_timeout'])
+        with override_settings(SQLITE_PRAGMAS={'busy_timeout': 250}):
+            self.assertEqual(self.pragma(self.connect(), 'busy_timeout'), 250)
+
+    def test_rejects_what_is_not_a_pragma(self):
+        with override_settings(SQLITE_PRAGMAS={'cache_size = 1; DROP TABLE store_product; --': 1}):
+            with self.assertRaises(ValueError):
+                self.connect()
+        with override_settings(SQLITE_PRAGMAS={'cache_size': '1; DROP TABLE store_product'}):
+            with self.assertRaises(ValueError):
+                self.connect()
@@ -0,0 +1,39 @@
+from django.db import transaction
+
+from .aggregates import clear_bids
+from .models import Product, Transfer
+
+
+def buyer_owns(client, product_hash, public_key_hash):
+    """Whether the node has `public_key_hash` on record as owner of the item"""
+    owner = client.item_owner(product_hash)
+    if owner != public_key_hash:
+        # a cached answer may predate the on-chain transfer
+        owner = client.item_owner(product_hash, refresh=True)
+    return owner is not None and owner == public_key_hash
+
+
+async def buyer_owns_async(client, product_hash, public_key_hash):
+    owner = await client.item_owner(product_hash)
+    if owner != public_key_hash:
+        owner = await client.item_owner(product_hash, refresh=True)
+    return owner is not None and owner == public_key_hash
+
+
+def complete_transfer(transfer, client):
+    """
+    Hands the product over to the buyer and clears its bids, once the node
+    shows the buyer as owner. Deleting the transfer claims it, so when two
+    callers complete the same transfer only one moves the product; returns
+    whether this one did.
+    """
+    with transaction.atomic():
+        deleted, _ = Transfer.objects.filter(pk=transfer.pk).delete()
+        if not deleted:
+            return False
+        product = Product.objects.get(pk=transfer.product_id)
+        product.owner_id = transfer.buyer_id
+        product.save()
+        clear_bids([product.id])
+        transaction.on_commit(lambda: client.forget_owner(product.product_hash))
+    return True
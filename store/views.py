@@ -1,17 +1,17 @@
 from http import HTTPStatus
+from io import BytesIO
 from os import stat
 import random
 from urllib import request
-import requests
 from uuid import uuid1
-from django.db import DatabaseError, transaction
-from django.db.models import Count
-from django.http import Http404
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import ProtectedError, Q
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions, status
 from rest_framework.decorators import action
-from rest_framework.filters import SearchFilter
 from rest_framework.mixins import (CreateModelMixin,
                                    RetrieveModelMixin, UpdateModelMixin)
 from rest_framework.permissions import AllowAny, IsAuthenticated
@@ -19,61 +19,111 @@ from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 from core.models import User
 
-from store.filters import ProductFilter
-from store.pagination import DefaultPagination
+from store import bulk
+from store.aggregates import clear_bids, count_products
+from store.blockchain import BlockchainError, get_client
+from store.caching import (COLLECTIONS, PRODUCTS, CatalogCacheMixin,
+                           collection_products_scope, product_changed, product_scope)
+from store.filters import ProductFilter, ProductSearchFilter
+from store.metrics import TimedViewMixin
+from store.pagination import BidPagination, CommentPagination, ProductPagination
+from store.rows import RowListMixin, row_serializer
 from store.permissions import (IsAdminOrReadOnly, IsBidder, IsBuyer, IsCommentor,
-                               IsItemOwner, IsProductOwner, NotIsItemOwner)
+                               IsItemOwner, IsProductOwner)
+from store.transfers import buyer_owns, complete_transfer
 
 from .models import Bid, Collection, Comment, Customer, Product, Transfer
 from .serializers import (ApproveBidSerializer, ApproveTransferSerializer, BidSerializer,
-                          CollectionSerializer, CommentSerializer,
+                          BulkVisibilitySerializer, CollectionSerializer, CommentSerializer,
                           CreateBidSerializer, CreateCommentSerializer,
                           CreateProductSerializer, CustomerSerializer,
                           ProductSerializer, TransferSerializer)
+from .signals import bid_approved
 
 
-class CollectionViewSet(ModelViewSet):
-    queryset = Collection.objects.annotate(
-        products_count=Count('products')).all()
+# Columns read by CustomerSerializer, used with only() wherever a customer is
+# joined in so that list pages never fall back to per-row user queries
+CUSTOMER_FIELDS = ['id', 'phone', 'user', 'user__id', 'user__first_name', 'user__last_name',
+                   'user__wallet_address', 'user__public_key', 'user__verified']
+SIMPLE_PRODUCT_FIELDS = ['id', 'title', 'unit_price', 'photo', 'photo_variants', 'product_hash']
+# what ProductSerializer reads of the product row itself
+PRODUCT_FIELDS = ['title', 'description', 'unit_price', 'last_update', 'visible', 'photo', 'photo_variants',
+                  'product_hash', 'min_bid_increment', 'highest_bid', 'bid_count', 'comment_count',
+                  'collection', 'owner']
+
+
+def related_fields(prefix, fields):
+    return [prefix + '__' + field for field in fields]
+
+
+def transfer_details(queryset):
+    """Joins in everything TransferSerializer reads"""
+    return queryset.select_related('product', 'buyer__user', 'seller__user') \
+        .only('completed', 'product', 'buyer', 'seller',
+              *related_fields('product', SIMPLE_PRODUCT_FIELDS),
+              *related_fields('buyer', CUSTOMER_FIELDS),
+              *related_fields('seller', CUSTOMER_FIELDS))
+
+
+class CollectionViewSet(TimedViewMixin, CatalogCacheMixin, ModelViewSet):
+    queryset = Collection.objects.all()
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly]
 
-    def delete(self, request, pk):
+    def cache_scopes(self, request, pk=None):
+        return [COLLECTIONS]
+
+    def destroy(self, request, pk):
         collection = get_object_or_404(Collection, pk=pk)
-        if collection.products.count() > 0:
-            return Response(
-                {
-                    'error': 'Collection cannot be deleted because it includes products'
-                },
-                status=status.HTTP_405_METHOD_NOT_ALLOWED)
-        collection.delete()
+        in_use = Response(
+            {
+                'error': 'Collection cannot be deleted because it includes products'
+            },
+            status=status.HTTP_405_METHOD_NOT_ALLOWED)
+        if collection.product_count > 0:
+            return in_use
+        try:
+            collection.delete()
+        except ProtectedError:
+            # a product the counter has not caught up with
+            return in_use
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class ProductsViewSet(ModelViewSet):
+class ProductsViewSet(TimedViewMixin, CatalogCacheMixin, RowListMixin, ModelViewSet):
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter]
     filterset_class = ProductFilter
-    search_fields = ['title', 'description']
-    pagination_class = DefaultPagination
+    pagination_class = ProductPagination
+
+    def cache_scopes(self, request, pk=None):
+        if pk is not None:
+            products = product_scope(pk)
+        elif request.query_params.get('collection_id'):
+            products = collection_products_scope(request.query_params['collection_id'])
+        else:
+            products = PRODUCTS
+        return [products, COLLECTIONS]
 
     def create(self, request, *args, **kwargs):
         productHash = request.data.get('product_hash')
+        if not productHash:
+            return Response({'error': 'product_hash is required'}, status=status.HTTP_400_BAD_REQUEST)
 
         # send request data, receive pubkey hash, compare with following
         try:
-            # use productHash later
-            response = requests.get(
-                'http://localhost:8080/item/owner/' + productHash)
-            if 'item_owner' in response.json().keys() and request.user.public_key_hash == response.json()['item_owner']:
-                serializer = self.get_serializer(data=request.data)
-                serializer.is_valid(raise_exception=True)
-                self.perform_create(serializer)
-                headers = self.get_success_headers(serializer.data)
-                return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-            return Response({'error': 'Item not registered under the provided user\'s address'}, status=status.HTTP_400_BAD_REQUEST)
-        except Exception as e:
-            return Response({'error': 'An unknown error occured'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            owner = get_client().item_owner(productHash)
+        except BlockchainError:
+            return Response({'error': 'Could not reach the blockchain node'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if owner is None or request.user.public_key_hash != owner:
+            return Response({'error': 'Item not registered under the provided user\'s address'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
     def get_serializer_class(self):
         if self.request.method in permissions.SAFE_METHODS:
@@ -81,6 +131,8 @@ class ProductsViewSet(ModelViewSet):
         return CreateProductSerializer
 
     def get_permissions(self):
+        if self.action == 'export':
+            return [IsAuthenticated()]
         if self.request.method in permissions.SAFE_METHODS:
             return [AllowAny()]
         elif self.request.method == 'POST':
@@ -89,7 +141,9 @@ class ProductsViewSet(ModelViewSet):
             return [IsProductOwner()]
 
     def get_queryset(self):
-        queryset = Product.objects.filter().prefetch_related('collection', 'owner__user')
+        queryset = Product.objects \
+            .select_related('collection', 'owner__user') \
+            .only(*PRODUCT_FIELDS, 'collection__title', *related_fields('owner', CUSTOMER_FIELDS))
         collection_id = self.request.query_params.get('collection_id')
         if collection_id is not None:
             queryset = queryset.filter(
@@ -108,28 +162,77 @@ class ProductsViewSet(ModelViewSet):
                 product.visible = False
             else:
                 return Response({})
-            product.save()
-            Bid.objects.filter(product=product).delete()
-            Transfer.objects.filter(product=product).delete()
+            with transaction.atomic():
+                product.save()
+                clear_bids([product.id])
+                Transfer.objects.filter(product=product).delete()
             product = Product.objects.get(pk=pk)
             serializer = ProductSerializer(product)
             return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
+    @action(detail=False, methods=['put'], url_path='visibility')
+    def bulk_visibility(self, request):
+        """
+        Shows or hides many of the caller's products at once, with a body of
+        {"ids": [...], "visible": false}. Products that are not the caller's
+        or already in that state are reported as skipped.
+        """
+        serializer = BulkVisibilitySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids, visible = serializer.validated_data['ids'], serializer.validated_data['visible']
+        rows = bulk.set_visibility(request.user.id, ids, visible)
+        changed = {row['id'] for row in rows}
+        return Response({
+            'updated': row_serializer(ProductSerializer).serialize(rows),
+            'skipped': [id for id in dict.fromkeys(ids) if id not in changed],
+        }, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['post'], url_path='import')
+    def bulk_import(self, request):
+        """
+        Creates the caller's products from an NDJSON (application/x-ndjson)
+        or CSV (text/csv) body, read as it streams in. Rows that fail are
+        reported by row number; the others are created.
+        """
+        if request.content_type not in (bulk.NDJSON, bulk.CSV):
+            return Response({'error': 'Send products as %s or %s' % (bulk.NDJSON, bulk.CSV)},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        customer = get_object_or_404(Customer, user_id=request.user.id)
+        importer = bulk.ProductImport(customer, request.user.public_key_hash, get_client())
+        report = importer.run(bulk.read_rows(request.stream or BytesIO(), request.content_type))
+        return Response(report,
+                        status=status.HTTP_201_CREATED if report['created'] else status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Streams the caller's products as NDJSON, or CSV with ?output=csv"""
+        content_type = bulk.CSV if request.query_params.get('output') == 'csv' else bulk.NDJSON
+        products = Product.objects.filter(owner__user_id=request.user.id)
+        response = StreamingHttpResponse(bulk.export_rows(products, content_type), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="products.%s"' % (
+            'csv' if content_type == bulk.CSV else 'ndjson')
+        return response
+
     def get_serializer_context(self):
         return {'user': self.request.user}
 
 
-class CustomerViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, GenericViewSet):
-    queryset = Customer.objects.all()
+class CustomerViewSet(TimedViewMixin, CreateModelMixin, RetrieveModelMixin, UpdateModelMixin,
+                      GenericViewSet):
+    queryset = Customer.objects.select_related('user').only(*CUSTOMER_FIELDS)
     serializer_class = CustomerSerializer
 
     @action(detail=False, methods=['GET', 'PUT'])
     def me(self, request):
-        customer = get_object_or_404(Customer, user_id=request.user.id)
         if request.method == 'GET':
+            # loaded with the user by the authentication class
+            customer = getattr(request.user, 'customer', None)
+            if customer is None:
+                raise Http404
             serializer = CustomerSerializer(customer)
             return Response(serializer.data)
-        elif request.method == 'PUT':
+        customer = get_object_or_404(self.get_queryset(), user_id=request.user.id)
+        if request.method == 'PUT':
             serializer = CustomerSerializer(customer, data=request.data)
             serializer.is_valid(raise_exception=True)
             serializer.save()
@@ -137,44 +240,41 @@ class CustomerViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Ge
 
     @action(detail=False, methods=['GET'])
     def get_token(self, request):
-        user = get_object_or_404(User, pk=request.user.id)
+        user = request.user
+        if not user.is_authenticated:
+            raise Http404
         if (user.verified):
-            customer = Customer.object.get(user=user)
+            customer = getattr(user, 'customer', None)
+            if customer is None:
+                raise Http404
             serializer = CustomerSerializer(customer)
             return Response(serializer.data, status=status.HTTP_200_OK)
         user.randomString = uuid1(random.randint(0, 281474976710655))
-        user.save()
+        user.save(update_fields=['randomString'])
         return Response({'token': user.randomString}, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['POST'])
     def verify_token(self, request):
-        # To be implemented
-        originalToken = request.user.randomString
+        # read fresh, get_token may have just issued it through another worker
+        originalToken = User.objects.filter(pk=request.user.pk).values_list('randomString', flat=True).get()
         publicKey = request.user.public_key
-        # Make request
+        signedToken = request.data.get('signed_token')
         try:
-            signedToken = request.data.get('signed_token')
-            payload = {
-                "token": str(originalToken),
-                "signed_token": str(signedToken),
-                "public_key": publicKey,
-            }
-            response = requests.post(
-                'http://localhost:8080/token/verify', json=payload)
-            if 'verified' in response.json().keys():
-                user = User.objects.get(pk=request.user.id)
-                user.verified = True
-                user.save()
-                return Response({'success': 'User Verified Successfully '}, status=status.HTTP_202_ACCEPTED)
-            else:
-                raise Response(
-                    {'error': 'Token could not be verified '}, status=status.HTTP_400_BAD_REQUEST)
-        except Exception as e:
-            return Response({'error': 'Some unknown error occured'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            verified = get_client().verify_token(originalToken, signedToken, publicKey)
+        except BlockchainError:
+            return Response({'error': 'Could not reach the blockchain node'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if not verified:
+            return Response(
+                {'error': 'Token could not be verified '}, status=status.HTTP_400_BAD_REQUEST)
+        request.user.verified = True
+        request.user.save(update_fields=['verified'])
+        return Response({'success': 'User Verified Successfully '}, status=status.HTTP_202_ACCEPTED)
 
 
-class CommentViewSet(ModelViewSet):
+class CommentViewSet(TimedViewMixin, RowListMixin, ModelViewSet):
     http_method_names = ['get', 'post', 'put', 'delete']
+    pagination_class = CommentPagination
 
     def get_permissions(self):
         if self.request.method in permissions.SAFE_METHODS:
@@ -189,7 +289,11 @@ class CommentViewSet(ModelViewSet):
         return CreateCommentSerializer
 
     def get_queryset(self):
-        return Comment.objects.filter(product_id=self.kwargs['product_pk']).order_by('-date').prefetch_related('commentor__user', 'product')
+        return Comment.objects.filter(product_id=self.kwargs['product_pk']).order_by('-date') \
+            .select_related('commentor__user', 'product') \
+            .only('description', 'date', 'commentor', 'product',
+                  *related_fields('commentor', CUSTOMER_FIELDS),
+                  *related_fields('product', SIMPLE_PRODUCT_FIELDS))
 
     def get_serializer_context(self):
         return {
@@ -197,15 +301,21 @@ class CommentViewSet(ModelViewSet):
             'user': self.request.user,
         }
 
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        instance.delete()
 
-class BidViewSet(ModelViewSet):
+
+class BidViewSet(TimedViewMixin, RowListMixin, ModelViewSet):
     http_method_names = ['get', 'post', 'put', 'delete']
+    pagination_class = BidPagination
 
     def get_permissions(self):
         if self.request.method in permissions.SAFE_METHODS:
             return [IsAuthenticated(), ]
         elif self.request.method == 'POST':
-            return [NotIsItemOwner()]
+            # visibility and ownership are checked by place_bid with the bid itself
+            return [IsAuthenticated()]
         elif self.request.method == 'PUT':
             return [IsItemOwner()]
         return [IsBidder()]
@@ -218,7 +328,11 @@ class BidViewSet(ModelViewSet):
         return CreateBidSerializer
 
     def get_queryset(self):
-        return Bid.objects.filter(product_id=self.kwargs['product_pk']).order_by('-placed_at').prefetch_related('customer__user', 'product')
+        return Bid.objects.filter(product_id=self.kwargs['product_pk']).order_by('-placed_at') \
+            .select_related('customer__user', 'product') \
+            .only('price', 'description', 'placed_at', 'approved', 'customer', 'product',
+                  *related_fields('customer', CUSTOMER_FIELDS),
+                  *related_fields('product', SIMPLE_PRODUCT_FIELDS))
 
     def get_serializer_context(self):
         return {
@@ -227,26 +341,45 @@ class BidViewSet(ModelViewSet):
         }
 
     def update(self, request, *args, **kwargs):
-        bid = get_object_or_404(Bid, pk=self.kwargs['pk'])
-        user = request.user
+        """
+        Approves a bid: hides the product, marks the bid approved and opens a
+        transfer to the bidder. The product is claimed with a conditional
+        UPDATE on visible, so of two approvals racing for the same product
+        exactly one gets it and the other gets a 409.
+        """
+        bid = Bid.objects.filter(pk=kwargs['pk'], product_id=kwargs['product_pk']) \
+            .values('customer_id', 'product__owner_id', 'product__owner__user_id', 'product__collection_id') \
+            .first()
+        if bid is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        if bid['product__owner__user_id'] != request.user.id:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        product_id = kwargs['product_pk']
         try:
             with transaction.atomic():
+                claimed = Product.objects \
+                    .filter(pk=product_id, visible=True, owner_id=bid['product__owner_id']) \
+                    .update(visible=False, last_update=timezone.now())
+                if not claimed:
+                    return Response({'error': 'Product is no longer available'},
+                                    status=status.HTTP_409_CONFLICT)
+                count_products({bid['product__collection_id']: (0, -1)})
+                Bid.objects.filter(pk=kwargs['pk']).update(approved=True)
                 transfer = Transfer.objects.create(
-                    product=bid.product, seller=user.customer, buyer=bid.customer)
-                product = Product.objects.get(pk=bid.product.id)
-                product.visible = False
-                bid.approved = True
-                transfer.save()
-                product.save()
-                bid.save()
-        except (DatabaseError):
+                    product_id=product_id, seller_id=bid['product__owner_id'], buyer_id=bid['customer_id'])
+                product_changed(product_id, bid['product__collection_id'])
+                bid_approved.send(sender=Bid, bid_id=int(kwargs['pk']), product_id=int(product_id),
+                                  transfer_id=transfer.id, buyer_id=bid['customer_id'])
+        except IntegrityError:
+            # the product already has a transfer
+            return Response({'error': 'Product is no longer available'}, status=status.HTTP_409_CONFLICT)
+        except DatabaseError:
             return Response(
                 {
                     "error": "Internal Server Error while performing transaction"
                 },
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        transfer = Transfer.objects.get(
-            product=bid.product, seller=user.customer, buyer=bid.customer)
+        transfer = transfer_details(Transfer.objects.filter(pk=transfer.pk)).get()
         serializer = TransferSerializer(transfer)
         return Response({'data': serializer.data, }, status=status.HTTP_201_CREATED)
 
@@ -254,14 +387,16 @@ class BidViewSet(ModelViewSet):
         try:
             instance = self.get_object()
             if (instance.approved):
-                return Response({'error': "Cannot delete approved bid"}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
-            self.perform_destroy(instance=instance)
+                return Response({'error': "Cannot delete approved bid"},
+                                status=status.HTTP_405_METHOD_NOT_ALLOWED)
+            with transaction.atomic():
+                self.perform_destroy(instance=instance)
         except Http404:
             return Response(status=status.HTTP_404_NOT_FOUND)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class TransferViewset(ModelViewSet):
+class TransferViewset(TimedViewMixin, RowListMixin, ModelViewSet):
     http_method_names = ['get', 'put']
 
     def get_permissions(self):
@@ -270,10 +405,8 @@ class TransferViewset(ModelViewSet):
         return [IsBuyer()]
 
     def get_queryset(self):
-        user = self.request.user
-        myPurchaseTransfers = Transfer.objects.filter(buyer=user.customer)
-        mySalesTransfers = Transfer.objects.filter(seller=user.customer)
-        return myPurchaseTransfers | mySalesTransfers
+        customer = self.request.user.customer
+        return transfer_details(Transfer.objects.filter(Q(buyer=customer) | Q(seller=customer)))
 
     def get_serializer_class(self):
         if self.request.method == 'PUT':
@@ -281,25 +414,26 @@ class TransferViewset(ModelViewSet):
         return TransferSerializer
 
     def update(self, request, *args, **kwargs):
-        transfer = get_object_or_404(Transfer, pk=self.kwargs['pk'])
+        transfer = get_object_or_404(Transfer.objects.select_related('product', 'buyer__user'),
+                                     pk=self.kwargs['pk'])
+        # IsBuyer, which get_object() would have checked
+        self.check_object_permissions(request, transfer)
         product_id = transfer.product.id
         productHash = transfer.product.product_hash
         # check if the transfer is done in blockchain
-        response = requests.get('http://localhost:8080/item/owner/' + productHash)
-        if 'item_owner' in response.json().keys() and request.user.public_key_hash == response.json()['item_owner']:
-            try:
-                with transaction.atomic():
-                    product = Product.objects.get(pk=product_id)
-                    product.owner = transfer.buyer
-                    product.save()
-                    transfer.delete()
-                    # Delete related bids
-                    bids = Bid.objects.filter(product=transfer.product)
-                    bids.delete()
-            except DatabaseError:
-                return Response({'error': 'Internal Server Error'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        else:
-            return Response({ 'error': 'Error verifying from blockchain'}, status=status.HTTP_402_PAYMENT_REQUIRED);
+        client = get_client()
+        try:
+            owned = buyer_owns(client, productHash, request.user.public_key_hash)
+        except BlockchainError:
+            return Response({'error': 'Could not reach the blockchain node'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if not owned:
+            return Response({'error': 'Error verifying from blockchain'},
+                            status=status.HTTP_402_PAYMENT_REQUIRED)
+        try:
+            complete_transfer(transfer, client)
+        except DatabaseError:
+            return Response({'error': 'Internal Server Error'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         product = Product.objects.get(pk=product_id)
         serializer = ProductSerializer(product)